@@ -1,6 +1,7 @@
 import random
 from csrec import Recommender
 import math
+import time
 import numpy as np
 
 engine = Recommender()
@@ -17,13 +18,18 @@ publishers = ['P' + str(i) for i in range(1, n_publishers + 1)]
 
 print ("Info: insertion of random generated items: %d" % n_books)
 # generate books
+books = {}
 for b in range(0, n_books + 1):
     # Author "AnN" is n^2 times more productive than "AN".
     attributes = {'author': authors[int(math.sqrt(random.randrange(0, n_authors)**2))], 'publisher': publishers[int(math.sqrt(random.randrange(0, n_publishers)**2))]}
-    engine.db.insert_item(item_id=str(b), attributes=attributes)
+    books[str(b)] = attributes
+start = time.time()
+engine.db.insert_items_bulk(books)
+print ("Info: %d items in %.2fs" % (len(books), time.time() - start))
 
 print ("Info: generation and insert of random generated preferences: %d" % n_purchases)
 purchase = 0
+purchases = []
 
 while purchase < n_purchases:
     book_n = np.random.zipf(1.05)
@@ -33,15 +39,25 @@ while purchase < n_purchases:
         user_id = str(user_n)
         item_id = str(book_n)
         rating = random.randrange(1, 6)
-        #print 'user', user_id, 'rated', code, 'stars item', item_id
-        engine.db.insert_item_action(user_id=user_id, item_id=item_id, code=3.0)
+        #print ('user', user_id, 'rated', rating, 'stars item', item_id)
+        purchases.append((user_id, item_id, 3.0))
+start = time.time()
+engine.db.insert_item_actions_bulk(purchases)
+print ("Info: %d actions in %.2fs" % (len(purchases), time.time() - start))
 
 print ("Info: compute_items_by_popularity")
 engine.compute_items_by_popularity()
 
 for i in [1, 10, 100, 1000, 10000]:
     print ("Info: generating recommendations for user: " + str(i))
-    print engine.get_recommendations(str(i))
+    print (engine.get_recommendations(str(i)))
+
+print ("Info: generating recommendations in bulk for all the users")
+start = time.time()
+engine.get_recommendations_bulk(engine.db.get_item_actions().keys())
+elapsed = time.time() - start
+print ("Info: %d users in %.2fs (%.1f users/s)" % (engine.db.get_user_count(), elapsed,
+                                                 engine.db.get_user_count() / elapsed))
 
 print ("Serialization")
 engine.db.serialize(filepath="database.bin")
@@ -49,5 +65,5 @@ engine.db.serialize(filepath="database.bin")
 print ("Restore")
 engine.db.restore(filepath="database.bin")
 
-print "End"
+print ("End")
 
@@ -1,2 +1,3 @@
 from csrec.factory_dal import Dal
 from csrec.recommender import Recommender
+from csrec.scoring_pool import ScoringPool
@@ -0,0 +1,278 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import json
+import logging
+import os
+import threading
+from time import time
+
+from csrec.tools import snapshot
+from csrec.exceptions import *
+
+LOG_VERSION = 1
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _json_default(o):
+    # numpy scalars, e.g. the codes of actions inserted from arrays
+    if hasattr(o, 'item'):
+        return o.item()
+    raise TypeError("%r is not JSON serializable" % (o,))
+
+
+class ActionLog(object):
+    """
+    Append-only log of the changes of a datastore (write-ahead log), so that the changes made after
+    the last serialization are not lost if the process dies.
+
+    The log is attached to the observable methods of the datastore: each change is appended
+    as a JSON line {"op": method, "args": {...}} and the file is synced to disk every sync_every
+    changes or every sync_interval seconds, whichever comes first.
+    The first line of the file holds the fingerprint of the snapshot the changes apply to: recover()
+    restores the snapshot and replays the changes, compact() writes a new snapshot and starts a new log.
+    """
+    # logged methods: name -> function which returns the JSON serializable arguments of a call
+    operations = {
+        'insert_item': lambda db, args: {'item_id': args['item_id'], 'attributes': args['attributes']},
+        'remove_item': lambda db, args: {'item_id': args['item_id']},
+        # the attributes are read from the datastore, the argument could be an iterator already consumed
+        'insert_items_bulk': lambda db, args: {'items': [[i, db.get_items(item_id=i).get(i) or {}]
+                                                         for i in args['return_value']]},
+        # the timestamp given by the datastore to the action is returned by insert_item_action
+        'insert_item_action': lambda db, args: dict([(k, args[k]) for k in ('user_id', 'item_id', 'code',
+                                                                           'item_meaningful_info', 'only_info')] +
+                                                    [('timestamp', args['return_value'])]),
+        # the timestamps given by the datastore to the actions are returned by insert_item_actions_bulk
+        'insert_item_actions_bulk': lambda db, args: {
+            'actions': dict(zip(('user_id', 'item_id', 'code', 'timestamp'),
+                                db._actions_columns(args['actions'], args['code'])[:3] +
+                                (args['return_value'][1],))),
+            'item_meaningful_info': args['item_meaningful_info'], 'only_info': args['only_info']},
+        'remove_item_action': lambda db, args: {'user_id': args['user_id'], 'item_id': args['item_id']},
+        'insert_social_action': lambda db, args: {'user_id': args['user_id'], 'user_id_to': args['user_id_to'],
+                                                  'code': args['code']},
+        'remove_social_action': lambda db, args: {'user_id': args['user_id'], 'user_id_to': args['user_id_to']},
+        'remove_user': lambda db, args: {'user_id': args['user_id']},
+        'reconcile_user': lambda db, args: {'old_user_id': args['old_user_id'], 'new_user_id': args['new_user_id']},
+        'reset': lambda db, args: {},
+    }
+
+    def __init__(self, filepath, sync_every=100, sync_interval=1.0):
+        """
+        :param filepath: the path of the log, it is created if it does not exist
+        :param sync_every: number of changes after which the log is synced to disk
+        :param sync_interval: seconds after which the changes not yet synced are synced to disk
+        """
+        self.filepath = filepath
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.logger = logging.getLogger("csrc")
+
+        self._lock = threading.Lock()
+        self._observers = {}
+        self._replaying = False
+        self._pending = 0
+        self._last_sync = time()
+        if os.path.exists(filepath):
+            self._truncate_torn_line()
+        if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+            self._write_new(None)
+        self._file = open(filepath, 'a')
+
+        self._stopped = threading.Event()
+        self._syncer = threading.Thread(target=self._sync_loop, name="csrec-action-log")
+        self._syncer.daemon = True
+        self._syncer.start()
+
+    def _write_new(self, snapshot_fingerprint):
+        # the new log replaces the old one only when complete
+        temporary = self.filepath + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(json.dumps({'version': LOG_VERSION, 'snapshot': snapshot_fingerprint}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(temporary, self.filepath)
+
+    def _truncate_torn_line(self):
+        # a last line without newline was not completely written: the new changes must not be appended to it
+        with open(self.filepath, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                block = f.read(step)
+                newline = block.rfind(b'\n')
+                if newline >= 0:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position < end:
+                self.logger.warning("[ActionLog] truncated last line of %s removed", self.filepath)
+                f.truncate(position)
+
+    def append(self, op, args):
+        """
+        append a change to the log
+
+        :param op: the name of the method of the datastore
+        :param args: the arguments of the method
+        """
+        line = json.dumps({'op': op, 'args': args}, default=_json_default) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        if self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+        self._last_sync = time()
+
+    def sync(self):
+        """
+        write to disk the changes not yet synced
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync_loop(self):
+        while not self._stopped.wait(self.sync_interval):
+            with self._lock:
+                if self._pending and time() - self._last_sync >= self.sync_interval:
+                    self._sync()
+
+    def close(self):
+        """
+        sync and close the log, the log must be detached from the datastore
+        """
+        self._stopped.set()
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _observer(self, db, op):
+        serialize = self.operations[op]
+
+        def observer(**kwargs):
+            if not self._replaying:
+                self.append(op, serialize(db, kwargs))
+        return observer
+
+    def attach(self, db):
+        """
+        log the changes of a datastore
+
+        :param db: the datastore, e.g. Recommender().db
+        """
+        for op in self.operations:
+            observer = self._observer(db, op)
+            self._observers[op] = observer
+            db.register(getattr(db, op), observer)
+
+    def detach(self, db):
+        """
+        stop logging the changes of a datastore
+
+        :param db: the datastore
+        """
+        for op, observer in self._observers.items():
+            db.unregister(getattr(db, op), observer)
+        self._observers = {}
+
+    def records(self):
+        """
+        read the log, a truncated last line (e.g. the process died while writing it) is ignored
+
+        exception: raise a RestoreException if the log is corrupted
+
+        :return: a tuple (header, generator of the changes as (op, args))
+        """
+        with self._lock:
+            self._file.flush()
+        with open(self.filepath, 'r') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                raise RestoreException("corrupted header of the action log %s" % self.filepath)
+
+        def changes():
+            # the file is opened only if the changes are read, and closed when they have been read
+            with open(self.filepath, 'r') as f:
+                f.readline()
+                previous = None
+                for n, line in enumerate(f):
+                    if previous is not None:
+                        raise RestoreException("corrupted line %d of the action log %s" % (n, self.filepath))
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        previous = line  # only the last line can be truncated
+                        continue
+                    yield record['op'], record['args']
+        return header, changes()
+
+    def replay(self, db):
+        """
+        apply the changes of the log to a datastore, the changes are not logged again
+
+        :param db: the datastore
+        :return: the number of changes applied
+        """
+        _, changes = self.records()
+        n = 0
+        self._replaying = True
+        try:
+            for op, args in changes:
+                getattr(db, op)(**args)
+                n += 1
+        finally:
+            self._replaying = False
+        return n
+
+    def recover(self, db, filepath=None, **restore_params):
+        """
+        restore a datastore from a snapshot and replay the changes logged after it. The changes are not
+        replayed if the log refers to a different snapshot, e.g. if the process died after a new
+        snapshot had been written by compact() but before the log had been replaced
+
+        :param db: the datastore
+        :param filepath: the path of the snapshot, if None or if the file does not exist the changes are
+            applied to the datastore as it is
+        :param restore_params: parameters of db.restore, e.g. mmap=True
+        :return: the number of changes applied
+        """
+        fingerprint = None
+        if filepath is not None and os.path.exists(filepath):
+            db.restore(filepath, **restore_params)
+            fingerprint = snapshot.fingerprint(filepath)
+        header, _ = self.records()
+        if header.get('snapshot') != fingerprint:
+            self.logger.warning("[ActionLog] the log %s refers to a different snapshot, not replayed", self.filepath)
+            return 0
+        n = self.replay(db)
+        self.logger.info("[ActionLog] %d changes replayed from %s", n, self.filepath)
+        return n
+
+    def compact(self, db, filepath, file_format='snapshot'):
+        """
+        write a new snapshot of the datastore and start a new, empty, log which refers to it.
+        The datastore is locked for writing until both are written
+
+        :param db: the datastore
+        :param filepath: the path of the snapshot
+        :param file_format: the format of the snapshot, see db.serialize
+        """
+        with db.lock.writer():
+            db.serialize(filepath, file_format=file_format)
+            fingerprint = snapshot.fingerprint(filepath)
+            with self._lock:
+                self._sync()
+                self._file.close()
+                self._write_new(fingerprint)
+                self._file = open(self.filepath, 'a')
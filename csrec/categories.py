@@ -0,0 +1,75 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import numpy as np
+
+
+class ItemsCategories(object):
+    """
+    Index from items to the values of a category (e.g. the authors of each book).
+
+    The index is a 2D array of integer indices: row i holds the indices of the values of
+    the item with index i, padded with -1. Scores on the values of the category can be
+    gathered for many items with a single fancy indexing operation.
+    """
+    dtype = np.int32
+
+    def __init__(self, items, values):
+        """
+        :param items: IdMap of the items
+        :param values: IdMap of the values of the category
+        """
+        self.items = items
+        self.values = values
+        self.index = np.full((0, 1), -1, dtype=self.dtype)
+
+    def _reserve(self, n_items, width):
+        rows, columns = self.index.shape
+        if n_items <= rows and width <= columns:
+            if not self.index.flags.writeable:
+                # e.g. the index mapped from the file of a model, copied on the first change
+                self.index = self.index.copy()
+            return
+        # rows grow geometrically to keep the insertions amortized O(1)
+        new_rows = max(n_items, 2 * rows) if n_items > rows else rows
+        index = np.full((new_rows, max(width, columns)), -1, dtype=self.dtype)
+        index[:rows, :columns] = self.index
+        self.index = index
+
+    def set_item(self, item_id, item_values):
+        """
+        set the values of the category of an item
+
+        :param item_id: item id
+        :param item_values: list of values of the category, e.g. ["Author A", "Author B"]
+        """
+        item = self.items.intern(item_id)
+        values = self.values.intern_many(item_values or ())
+        self._reserve(item + 1, len(values))
+        self.index[item, :] = -1
+        self.index[item, :len(values)] = values
+
+    def remove_item(self, item_id):
+        item = self.items.index(item_id)
+        if item is not None and item < self.index.shape[0]:
+            self._reserve(item + 1, 1)
+            self.index[item, :] = -1
+
+    def clear(self):
+        self.index = np.full((0, 1), -1, dtype=self.dtype)
+
+    def scores(self, items, values_scores):
+        """
+        sum, for each item, the scores of its values
+
+        :param items: numpy array with the indices of the items
+        :param values_scores: numpy array with a score for each value of the category
+        :return: numpy array with a score for each item
+        """
+        items = np.asarray(items, dtype=np.int64)
+        known = items < self.index.shape[0]
+        values = np.full((len(items), self.index.shape[1]), -1, dtype=self.dtype)
+        values[known] = self.index[items[known]]
+        # -1 (no value) and values unknown to values_scores point to the trailing 0
+        values[values >= len(values_scores)] = -1
+        return np.append(values_scores, 0.)[values].sum(axis=1)
@@ -0,0 +1,453 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+from math import exp, log
+from time import time
+
+import numpy as np
+from scipy import sparse
+
+from csrec.tools.idmap import IdMap
+from csrec.tools.sparse import binarize, csr_from_arrays, csr_vector, resize_csr
+
+
+class Cooccurrence(object):
+    """
+    Symmetric co-occurrence counts of keys (items or values of a category) updated incrementally:
+    the element (a, b) is the number of users who have both a and b in their profile.
+
+    Keys are mapped to integer indices by an IdMap (usually the one of the datastore), the non-zero
+    counts are kept as one dictionary per row {index: count} and can be exported as a scipy CSR matrix.
+    For each user index the set of keys' indices is kept, so that any change of the profile is
+    applied as the difference between the old and the new set, touching only the rows and the columns of
+    the keys which have been added or removed.
+
+    A precomputed matrix (e.g. memory mapped from a file) can be used with map(): the counts are read
+    from it, and the dictionaries are built only when the first user is updated.
+    """
+    dtype = np.float64
+
+    def __init__(self, keys=None):
+        self.keys = keys if keys is not None else IdMap()  # key -> index
+        self.rows = {}  # index -> {index: number of users}
+        self.users_keys = {}  # user index -> set of indices
+        self._csr = None  # CSR export, reset on each change
+        self._users_matrix = None  # users x keys matrix of a mapped co-occurrence matrix
+        self.mapped = False  # counts are read from _csr until the first update
+
+    def clear(self):
+        self.rows.clear()
+        self.users_keys.clear()
+        self._csr = None
+        self._users_matrix = None
+        self.mapped = False
+
+    def map(self, cooccurrence, users_matrix):
+        """
+        use a precomputed co-occurrence matrix, without building the dictionaries of the counts.
+        The arrays of the matrices are not copied, so they can be memory mapped from a file
+
+        :param cooccurrence: scipy.sparse.csr_matrix keys x keys with sorted indices, e.g. from tocsr()
+        :param users_matrix: scipy.sparse.csr_matrix users x keys with the keys of each user, e.g.
+            from users_matrix(), it is used to build users_keys on the first update
+        """
+        self.clear()
+        self._csr = cooccurrence
+        self._users_matrix = users_matrix
+        self.mapped = True
+
+    def _materialize(self):
+        cooccurrence, users_matrix = self._csr, self._users_matrix
+        self.clear()
+        self._set(cooccurrence, users_matrix)
+
+    def _set(self, cooccurrence, binary):
+        indptr, indices, data = cooccurrence.indptr, cooccurrence.indices, cooccurrence.data
+        for a in np.flatnonzero(np.diff(indptr)):
+            start, end = indptr[a], indptr[a + 1]
+            self.rows[int(a)] = dict(zip(indices[start:end].tolist(), data[start:end].tolist()))
+        indptr, indices = binary.indptr, binary.indices
+        for u in np.flatnonzero(np.diff(indptr)):
+            self.users_keys[int(u)] = set(indices[indptr[u]:indptr[u + 1]].tolist())
+
+    def _add(self, a, b, n):
+        row = self.rows.setdefault(a, {})
+        count = row.get(b, 0) + n
+        if count:
+            row[b] = count
+        else:
+            del row[b]
+            if not row:
+                del self.rows[a]
+
+    def _add_block(self, indices_a, indices_b, n):
+        for a in indices_a:
+            for b in indices_b:
+                self._add(a, b, n)
+
+    def update_user(self, user, indices, timestamps=None):
+        """
+        set the keys of a user and update the co-occurrence counts accordingly
+
+        :param user: user index
+        :param indices: indices of the keys (e.g. the rated items) of the user, empty to remove the user
+        :param timestamps: not used, see DecayedCooccurrence
+        :return: the sets of the indices added to and removed from the keys of the user
+        """
+        if self.mapped:
+            self._materialize()
+        new_indices = set(int(i) for i in indices)
+        old_indices = self.users_keys.get(user, set())
+        added = new_indices - old_indices
+        removed = old_indices - new_indices
+        if not added and not removed:
+            return added, removed
+        kept = old_indices & new_indices
+
+        # (kept + added)^2 - (kept + removed)^2
+        self._add_block(kept, added, 1)
+        self._add_block(added, kept, 1)
+        self._add_block(added, added, 1)
+        self._add_block(kept, removed, -1)
+        self._add_block(removed, kept, -1)
+        self._add_block(removed, removed, -1)
+        self._csr = None
+
+        if new_indices:
+            self.users_keys[user] = new_indices
+        else:
+            self.users_keys.pop(user, None)
+        return added, removed
+
+    def load(self, matrix):
+        """
+        replace the co-occurrence counts with the ones of a users x keys matrix,
+        computed as a sparse product
+
+        :param matrix: scipy sparse matrix users x keys, rows are users indices and
+            columns are indices of self.keys
+        """
+        self.clear()
+        binary = binarize(matrix)
+        self._set(binary.T.dot(binary).tocsr(), binary)
+
+    def scale(self, now=None):
+        """
+        :return: the factor of the counts as of now, always 1 as the counts do not decay, see DecayedCooccurrence
+        """
+        return 1.0
+
+    def diagonal(self):
+        """
+        :return: numpy array with the number of users of each key
+        """
+        counts = np.zeros(len(self.keys), dtype=self.dtype)
+        if self.mapped:
+            diagonal = self._csr.diagonal()
+            counts[:len(diagonal)] = diagonal
+            return counts
+        for a, row in self.rows.items():
+            counts[a] = row.get(a, 0)
+        return counts
+
+    def dot(self, vector):
+        """
+        product of the co-occurrence matrix with a vector, only the rows of the non-zero elements
+        of the vector are read
+
+        :param vector: a scipy sparse matrix 1 x keys, columns are indices of self.keys
+        :return: a scipy.sparse.csr_matrix 1 x keys with the score of each co-occurring key
+        """
+        vector = sparse.csr_matrix(vector)
+        # the scores of each key are summed in the order of the rows, like the sparse product does,
+        # so that the results do not depend on the order of the dictionaries
+        vector.sort_indices()
+        if self.mapped:
+            scores = vector[:, :self._csr.shape[0]].dot(self._csr).tocsr()
+            scores.sort_indices()
+            return resize_csr(scores, (1, len(self.keys)))
+        indices = []
+        scores = []
+        for a, value in zip(vector.indices.tolist(), vector.data.tolist()):
+            row = self.rows.get(a)
+            if row and value:
+                indices.append(np.fromiter(row.keys(), dtype=self.keys.dtype, count=len(row)))
+                scores.append(value * np.fromiter(row.values(), dtype=self.dtype, count=len(row)))
+        if not indices:
+            return csr_vector((), (), len(self.keys), self.dtype)
+        keys, position = np.unique(np.concatenate(indices), return_inverse=True)
+        return csr_vector(keys, np.bincount(position, weights=np.concatenate(scores), minlength=len(keys)),
+                          len(self.keys), self.dtype)
+
+    def tocsr(self):
+        """
+        :return: the co-occurrence counts as a scipy.sparse.csr_matrix keys x keys
+        """
+        n = len(self.keys)
+        if self._csr is not None and self._csr.shape[0] == n:
+            return self._csr
+        if self.mapped:  # keys added after the matrix was built
+            return resize_csr(self._csr, (n, n))
+        lengths = np.zeros(n, dtype=np.int64)
+        for a, row in self.rows.items():
+            lengths[a] = len(row)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=self.keys.dtype)
+        data = np.empty(indptr[-1], dtype=self.dtype)
+        for a, row in self.rows.items():
+            start, end = indptr[a], indptr[a + 1]
+            indices[start:end] = np.fromiter(row.keys(), dtype=self.keys.dtype, count=len(row))
+            data[start:end] = np.fromiter(row.values(), dtype=self.dtype, count=len(row))
+        self._csr = sparse.csr_matrix((data, indices, indptr), shape=(n, n))
+        self._csr.sort_indices()
+        return self._csr
+
+    def users_matrix(self, n_users):
+        """
+        :param n_users: the number of users
+        :return: a scipy.sparse.csr_matrix users x keys with 1 for the keys of each user
+        """
+        if self.mapped:
+            return resize_csr(self._users_matrix, (n_users, len(self.keys)))
+        users = sorted(self.users_keys)
+        rows = [np.full(len(self.users_keys[u]), u, dtype=self.keys.dtype) for u in users]
+        columns = [np.fromiter(self.users_keys[u], dtype=self.keys.dtype, count=len(self.users_keys[u]))
+                   for u in users]
+        data = [np.ones(len(c), dtype=self.dtype) for c in columns]
+        matrix = csr_from_arrays(rows, columns, data, (n_users, len(self.keys)), self.dtype)
+        matrix.sort_indices()
+        return matrix
+
+    def __len__(self):
+        if self.mapped:
+            return int(np.count_nonzero(np.diff(self._csr.indptr)))
+        return len(self.rows)
+
+
+class DecayedCooccurrence(Cooccurrence):
+    """
+    Co-occurrence counts where each action of a user decays exponentially with its age: an action of
+    one half_life ago counts 1/2, so the recent actions (e.g. trending items) weigh more than the old ones.
+
+    The decay is lazy: the action at time t of a user is stored with weight w = exp(rate * (t - t0) / 2),
+    with rate = ln(2) / half_life and a fixed base time t0, and the element (a, b) is the sum of
+    w_a * w_b over the users, so the counts never change with the time and each update costs the same
+    as in Cooccurrence. The decayed counts are the stored ones times the global factor
+    scale() = exp(-rate * (now - t0)): the diagonal is the number of users of each key, each one
+    decayed with the age of its action, and a pair decays with the mean age of its two actions.
+    When the weights of new actions grow too much the base time is moved forward (see rebase),
+    multiplying all the counts by the same factor.
+
+    The actions older than the age at which their weight decays below threshold are not counted,
+    and prune() removes them with the counts which decayed below the threshold, so the size of the
+    matrix is bounded by the actions of the last half_life * log2(1 / threshold) seconds.
+    """
+    tolerance = 1e-9  # relative error of the sums below which a count is considered 0
+    max_exponent = 20.0  # the base time is moved when the weights grow above exp(max_exponent)
+
+    def __init__(self, keys=None, half_life=86400.0, threshold=0.01):
+        """
+        :param keys: IdMap of the keys
+        :param half_life: seconds after which the weight of an action is halved
+        :param threshold: decayed weight below which actions and counts are removed, 0 to keep everything
+        """
+        Cooccurrence.__init__(self, keys)
+        self.half_life = float(half_life)
+        self.rate = log(2.0) / self.half_life
+        self.threshold = threshold
+        self.t0 = time()
+
+    def _weights(self, timestamps):
+        return np.exp(0.5 * self.rate * (np.asarray(timestamps, dtype=self.dtype) - self.t0))
+
+    def cutoff(self, now=None):
+        """
+        :return: the time of the oldest action counted
+        """
+        if self.threshold <= 0:
+            return -np.inf
+        return (time() if now is None else now) + log(self.threshold) / self.rate
+
+    def scale(self, now=None):
+        """
+        :return: the factor of the stored counts which gives the decayed counts as of now
+        """
+        return exp(-self.rate * ((time() if now is None else now) - self.t0))
+
+    def map(self, cooccurrence, users_matrix, t0=None):
+        """
+        see Cooccurrence.map, users_matrix holds the weights of the actions
+
+        :param t0: the base time of the weights
+        """
+        Cooccurrence.map(self, cooccurrence, users_matrix)
+        if t0 is not None:
+            self.t0 = t0
+
+    def _set(self, cooccurrence, weights):
+        indptr, indices, data = cooccurrence.indptr, cooccurrence.indices, cooccurrence.data
+        for a in np.flatnonzero(np.diff(indptr)):
+            start, end = indptr[a], indptr[a + 1]
+            self.rows[int(a)] = dict(zip(indices[start:end].tolist(), data[start:end].tolist()))
+        indptr, indices, data = weights.indptr, weights.indices, weights.data
+        for u in np.flatnonzero(np.diff(indptr)):
+            start, end = indptr[u], indptr[u + 1]
+            self.users_keys[int(u)] = dict(zip(indices[start:end].tolist(), data[start:end].tolist()))
+
+    def _add(self, a, b, n):
+        row = self.rows.setdefault(a, {})
+        count = row.get(b, 0.0) + n
+        # the sums of weights do not cancel exactly, e.g. when a user is removed
+        if count > self.tolerance * abs(n):
+            row[b] = count
+        else:
+            row.pop(b, None)
+            if not row:
+                del self.rows[a]
+
+    def _set_user(self, user, new):
+        """
+        replace the weights of the keys of a user, only the rows and the columns of the changed keys
+        are updated: the counts change by new_a * new_b - old_a * old_b
+
+        :param user: user index
+        :param new: dictionary {index: weight} of the keys of the user
+        :return: the sets of the indices whose weight increased (e.g. added keys) and decreased (e.g. removed)
+        """
+        old = self.users_keys.get(user, {})
+        increased = set(a for a, w in new.items() if w > old.get(a, 0.0))
+        decreased = set(a for a, w in old.items() if w > new.get(a, 0.0))
+        changed = increased | decreased
+        if not changed:
+            return increased, decreased
+        for a in changed:
+            new_a, old_a = new.get(a, 0.0), old.get(a, 0.0)
+            for b in set(old) | set(new):
+                n = new_a * new.get(b, 0.0) - old_a * old.get(b, 0.0)
+                if n:
+                    self._add(a, b, n)
+                    if b not in changed:  # the elements of two changed keys are updated by both rows
+                        self._add(b, a, n)
+        self._csr = None
+        if new:
+            self.users_keys[user] = new
+        else:
+            self.users_keys.pop(user, None)
+        return increased, decreased
+
+    def update_user(self, user, indices, timestamps=None):
+        """
+        set the keys of a user, with the time of each action, and update the co-occurrence counts accordingly
+
+        :param user: user index
+        :param indices: indices of the keys (e.g. the rated items) of the user, empty to remove the user
+        :param timestamps: the times of the actions on the keys, if None the current time
+        :return: the sets of the indices whose weight increased (e.g. added keys) and decreased (e.g. removed)
+        """
+        if self.mapped:
+            self._materialize()
+        indices = np.asarray(indices, dtype=self.keys.dtype)
+        if timestamps is None:
+            timestamps = np.full(len(indices), time())
+        timestamps = np.asarray(timestamps, dtype=self.dtype)
+        if len(timestamps) and 0.5 * self.rate * (timestamps.max() - self.t0) > self.max_exponent:
+            self.rebase(timestamps.max())
+        alive = timestamps >= self.cutoff()
+        return self._set_user(user, dict(zip(indices[alive].tolist(), self._weights(timestamps[alive]).tolist())))
+
+    def rebase(self, t0):
+        """
+        move the base time of the weights, all the weights and the counts are rescaled
+
+        :param t0: the new base time
+        """
+        if self.mapped:
+            self._materialize()
+        factor = exp(-0.5 * self.rate * (t0 - self.t0))
+        for keys in self.users_keys.values():
+            for a in keys:
+                keys[a] *= factor
+        for row in self.rows.values():
+            for b in row:
+                row[b] *= factor * factor
+        self.t0 = t0
+        self._csr = None
+
+    def prune(self, now=None):
+        """
+        remove the actions older than cutoff() and the counts whose decayed value is below the threshold
+
+        :param now: the current time, if None time()
+        :return: the set of the indices whose weight decreased
+        """
+        decreased = set()
+        if self.threshold <= 0:
+            return decreased
+        if self.mapped:
+            self._materialize()
+        min_weight = float(self._weights(self.cutoff(now)))
+        for user, keys in list(self.users_keys.items()):
+            if any(w < min_weight for w in keys.values()):
+                decreased |= self._set_user(user, dict((a, w) for a, w in keys.items() if w >= min_weight))[1]
+        # e.g. the pairs of a recent action with an old one
+        min_count = self.threshold / self.scale(now)
+        for a, row in list(self.rows.items()):
+            for b in [b for b, count in row.items() if count < min_count]:
+                del row[b]
+            if not row:
+                del self.rows[a]
+        self._csr = None
+        return decreased
+
+    def load(self, matrix):
+        """
+        replace the co-occurrence counts with the ones of a users x keys matrix of the times of the actions,
+        computed as a sparse product
+
+        :param matrix: scipy sparse matrix users x keys with the timestamps of the actions, rows are users
+            indices and columns are indices of self.keys
+        """
+        self.clear()
+        weights = sparse.csr_matrix(matrix, dtype=self.dtype, copy=True)
+        now = time()
+        self.t0 = max(now, weights.data.max()) if weights.nnz else now
+        alive = weights.data >= self.cutoff(now)
+        weights.data = np.where(alive, self._weights(weights.data), 0.0)
+        weights.eliminate_zeros()
+        weights.sort_indices()
+        self._set(weights.T.dot(weights).tocsr(), weights)
+
+    def diagonal_value(self, index):
+        """
+        :return: the stored count of the key with the index and itself, the decayed number of users of the key
+            divided by scale()
+        """
+        if self.mapped:
+            return float(self.diagonal()[index]) if index < len(self.keys) else 0.0
+        return self.rows.get(index, {}).get(index, 0.0)
+
+    def dot(self, vector):
+        """
+        see Cooccurrence.dot, the scores are computed with the decayed counts
+        """
+        scores = Cooccurrence.dot(self, vector)
+        scores.data *= self.scale()
+        return scores
+
+    def users_matrix(self, n_users):
+        """
+        :param n_users: the number of users
+        :return: a scipy.sparse.csr_matrix users x keys with the weights of the keys of each user
+        """
+        if self.mapped:
+            return resize_csr(self._users_matrix, (n_users, len(self.keys)))
+        users = sorted(self.users_keys)
+        rows = [np.full(len(self.users_keys[u]), u, dtype=self.keys.dtype) for u in users]
+        columns = [np.fromiter(self.users_keys[u].keys(), dtype=self.keys.dtype, count=len(self.users_keys[u]))
+                   for u in users]
+        data = [np.fromiter(self.users_keys[u].values(), dtype=self.dtype, count=len(self.users_keys[u]))
+                for u in users]
+        matrix = csr_from_arrays(rows, columns, data, (n_users, len(self.keys)), self.dtype)
+        matrix.sort_indices()
+        return matrix
@@ -2,9 +2,11 @@ __author__ = "elegans.io Ltd"
 __email__ = "info@elegans.io"
 
 import abc
+from time import time
 
 from csrec.tools.observable import Observable
 from csrec.tools.observable import observable
+from csrec.tools.rwlock import RWLock
 from csrec.exceptions import *
 
 class DALBase(Observable):  # interface of the data abstraction layer
@@ -12,6 +14,9 @@ class DALBase(Observable):  # interface of the data abstraction layer
 
     def __init__(self):
         Observable.__init__(self)
+        # readers/writer lock on the datastore: the updates (and their observers) hold it for writing,
+        # the readers who need a consistent view across many calls hold it for reading
+        self.lock = RWLock()
 
     @abc.abstractmethod
     def init(self, **params):
@@ -159,21 +164,87 @@ class DALBase(Observable):  # interface of the data abstraction layer
 
     @abc.abstractmethod
     @observable
-    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False):
+    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False,
+                           timestamp=None):
         """
         insert a new item code on datastore, for each user a list of ratings will be mantained:
             user0: { 'item_0':3.0, ..., 'item_N':5.0}
             ...
             userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        along with the time of each action
 
         exception: raise an InsertException if any error occur
 
         :param user_id: user id
         :param item_id: item id
         :param code: the code, default value is 3.0
+        :param timestamp: the time of the action in seconds since the epoch, if None the current time
+        :return: the timestamp of the action
         """
         raise NotImplementedError
 
+    @observable
+    def insert_items_bulk(self, items):
+        """
+        insert many items at once, same as calling insert_item for each item but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param items: a dictionary {item_id: attributes}, an iterable of (item_id, attributes) pairs
+            or a pandas DataFrame indexed by item id with one column for each attribute
+        :return: the list of the inserted item ids
+        """
+        raise NotImplementedError
+
+    @observable
+    def insert_item_actions_bulk(self, actions, code=3.0, item_meaningful_info=None, only_info=False,
+                                 timestamp=None):
+        """
+        insert many item actions at once, same as calling insert_item_action for each action but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param actions: an iterable of (user_id, item_id), (user_id, item_id, code) or
+            (user_id, item_id, code, timestamp) tuples, a dictionary of arrays
+            {"user_id": [...], "item_id": [...], "code": [...], "timestamp": [...]} or a pandas DataFrame with
+            the same columns, "code" and "timestamp" are optional
+        :param code: the code of the actions without one, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the items, be considered
+        :param timestamp: the time of the actions without one, in seconds since the epoch,
+            if None the current time
+        :return: a tuple (users, timestamps) with the list of the users whose actions have been inserted
+            and the list of the timestamps of the actions, in their order, e.g. to log them
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _actions_columns(actions, code, timestamp=None):
+        """
+        :param timestamp: the timestamp of the actions without one, if None the current time
+        :return: a tuple (users, items, codes, timestamps) with the columns of the actions
+        """
+        if timestamp is None:
+            timestamp = time()
+        if hasattr(actions, 'columns') or hasattr(actions, 'keys'):  # DataFrame or dictionary of arrays
+            users = list(actions['user_id'])
+            items = list(actions['item_id'])
+            codes = list(actions['code']) if 'code' in actions else [code] * len(users)
+            timestamps = list(actions['timestamp']) if 'timestamp' in actions else [timestamp] * len(users)
+            return users, items, codes, timestamps
+        users = []
+        items = []
+        codes = []
+        timestamps = []
+        for action in actions:
+            users.append(action[0])
+            items.append(action[1])
+            codes.append(action[2] if len(action) > 2 else code)
+            timestamps.append(action[3] if len(action) > 3 else timestamp)
+        return users, items, codes, timestamps
+
     @abc.abstractmethod
     @observable
     def remove_item_action(self, user_id, item_id):
@@ -261,6 +332,83 @@ class DALBase(Observable):  # interface of the data abstraction layer
         """
         raise NotImplementedError
 
+    def get_user_index(self, user_id):
+        """
+        get the integer index of a user, indices are dense and stable: they are assigned
+        once to each user and are not reused
+
+        :param user_id: user id
+        :return: the index of the user, None if the user has never rated an item
+        """
+        raise NotImplementedError
+
+    def get_item_index(self, item_id):
+        """
+        get the integer index of an item, indices are dense and stable: they are assigned
+        once to each item and are not reused
+
+        :param item_id: item id
+        :return: the index of the item, None if the item does not exists
+        """
+        raise NotImplementedError
+
+    def get_users_map(self):
+        """
+        :return: the IdMap between user ids and integer indices
+        """
+        raise NotImplementedError
+
+    def get_items_map(self):
+        """
+        :return: the IdMap between item ids and integer indices
+        """
+        raise NotImplementedError
+
+    def get_category_values_map(self, info):
+        """
+        :param info: the category e.g. "author"
+        :return: the IdMap between the values of the category and integer indices
+        """
+        raise NotImplementedError
+
+    def synchronize(self):
+        """
+        read the changes made by the other processes sharing the datastore, e.g. the ids they added,
+        for the datastores which can be shared
+
+        :return: True if other processes changed the data since the last call, the data of this process
+            is then to be read again e.g. to rebuild the co-occurrence matrices
+        """
+        return False
+
+    def get_item_actions_arrays(self, user_id=None, timestamps=False):
+        """
+        get the users' actions as coordinates of a sparse matrix users x items
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :param timestamps: return the timestamps of the actions too
+        :return: a tuple (users, items, codes) of numpy arrays, users and items are indices
+            of get_users_map() and get_items_map(), (users, items, codes, timestamps) with timestamps
+        """
+        raise NotImplementedError
+
+    def get_categories_user_ratings_arrays(self, info, user_id=None):
+        """
+        get the ratings of users on the values of a category as coordinates of a sparse matrix
+        users x values
+
+        exception: raise a GetException if any error occur
+
+        :param info: the category e.g. "author"
+        :param user_id: user id, if None returns the ratings of all users
+        :return: a tuple (users, values, tot, n) of numpy arrays, users and values are indices
+            of get_users_map() and get_category_values_map(info), tot is the sum of ratings
+            and n the number of ratings
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     @observable
     def reconcile_user(self, old_user_id, new_user_id):
@@ -325,20 +473,39 @@ class DALBase(Observable):  # interface of the data abstraction layer
 
     @abc.abstractmethod
     @observable
-    def serialize(self, filepath):
+    def serialize(self, filepath, file_format='pickle'):
         """
         dump the datastore on file
 
         exception: raise a SerializeException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: the format of the file, "pickle" or "snapshot"
+        """
+        raise NotImplementedError
+
+    def serialize_background(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file without blocking the other requests: the file is written by a background
+        thread from a copy of the datastore taken when the method is called, the observers of serialize
+        are notified when the file has been written
+
+        :param filepath: the path of the file
+        :param file_format: the format of the file, "pickle" or "snapshot"
+        :return: the thread which writes the file, join() waits for the end
         """
         raise NotImplementedError
 
     @abc.abstractmethod
     @observable
-    def restore(self, filepath):
+    def restore(self, filepath, file_format=None, mmap=False):
         """
         restore the datastore from file
 
         exception: raise a RestoreException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: the format of the file, "pickle" or "snapshot", if None it is detected
+        :param mmap: memory map the arrays of snapshots instead of reading them
         """
         raise NotImplementedError
@@ -12,7 +12,10 @@ class Dal:
         """
 
         implemented_dal = {
-            'mem'
+            'mem',
+            'sqlite',
+            'redis',
+            'sharded'
         }
         return implemented_dal
 
@@ -28,6 +31,15 @@ class Dal:
         if name == 'mem':  # in memory implementation of dal
             import csrec.mem_dal as mem_dal
             return mem_dal.Database.get_init_parameters_description()
+        elif name == 'sqlite':  # SQLite implementation of dal
+            import csrec.sqlite_dal as sqlite_dal
+            return sqlite_dal.Database.get_init_parameters_description()
+        elif name == 'redis':  # Redis implementation of dal
+            import csrec.redis_dal as redis_dal
+            return redis_dal.Database.get_init_parameters_description()
+        elif name == 'sharded':  # mem implementation of dal partitioned by user
+            import csrec.sharded_dal as sharded_dal
+            return sharded_dal.Database.get_init_parameters_description()
         else:
             raise NotImplementedError
 
@@ -50,6 +62,24 @@ class Dal:
                 dal_instance = mem_dal.Database()
             except InitializationException as exc:
                 raise InitializationException("unable to initialize: " % name)
+        elif name == 'sqlite':  # SQLite implementation of dal
+            import csrec.sqlite_dal as sqlite_dal
+            try:
+                dal_instance = sqlite_dal.Database()
+            except InitializationException as exc:
+                raise InitializationException("unable to initialize: " % name)
+        elif name == 'redis':  # Redis implementation of dal
+            import csrec.redis_dal as redis_dal
+            try:
+                dal_instance = redis_dal.Database()
+            except InitializationException as exc:
+                raise InitializationException("unable to initialize: " % name)
+        elif name == 'sharded':  # mem implementation of dal partitioned by user
+            import csrec.sharded_dal as sharded_dal
+            try:
+                dal_instance = sharded_dal.Database()
+            except InitializationException as exc:
+                raise InitializationException("unable to initialize: " % name)
         else:
             raise NotImplementedError
 
@@ -0,0 +1,193 @@
+"""
+Streaming loaders of item actions and items from CSV or JSON lines files, optionally gzipped.
+The files are read through a pipeline of generators and inserted in the datastore in chunks,
+so the memory used does not depend on the size of the files.
+"""
+
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import csv
+import gzip
+import io
+import json
+import logging
+from itertools import islice
+from time import time
+
+from csrec.exceptions import *
+
+logger = logging.getLogger("csrc")
+
+
+def open_text(path, encoding='utf-8'):
+    """
+    open a text file for reading, files ending with .gz are decompressed on the fly
+
+    :param path: the path of the file
+    :param encoding: the encoding of the file
+    :return: a file object
+    """
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path, 'rb')), encoding=encoding)
+    return io.open(path, 'r', encoding=encoding)
+
+
+def _file_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith('.jsonl') or name.endswith('.json'):
+        return 'jsonl'
+    raise BadParametersException("unknown format of file %s, expected .csv or .jsonl" % path)
+
+
+def read_records(path, file_format=None, delimiter=','):
+    """
+    generator of the records of a CSV (with header) or JSON lines file
+
+    :param path: the path of the file, optionally gzipped (.gz)
+    :param file_format: "csv" or "jsonl", if None it is guessed from the extension of the file
+    :param delimiter: the delimiter of the fields of CSV files
+    :return: a generator of dictionaries {column: value}
+    """
+    if file_format is None:
+        file_format = _file_format(path)
+    with open_text(path) as f:
+        if file_format == 'csv':
+            for record in csv.DictReader(f, delimiter=delimiter):
+                yield record
+        elif file_format == 'jsonl':
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            raise BadParametersException("unknown file format %s, expected csv or jsonl" % file_format)
+
+
+def chunks(iterable, size):
+    """
+    :param iterable: an iterable
+    :param size: the number of elements of each chunk
+    :return: a generator of lists with at most size elements
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _attribute(value):
+    # lists in CSV files are written as JSON, e.g. ["nice", "good"]
+    if hasattr(value, 'startswith') and value.startswith('['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+class _Progress(object):
+    def __init__(self, name, every):
+        self.name = name
+        self.every = every
+        self.start = self.last = time()
+        self.rows = 0
+
+    def update(self, rows):
+        self.rows += rows
+        now = time()
+        if now - self.last >= self.every:
+            self.last = now
+            self.log()
+
+    def log(self):
+        elapsed = time() - self.start
+        logger.info("[%s] %d rows in %.1fs (%.1f rows/s)", self.name, self.rows, elapsed,
+                    self.rows / elapsed if elapsed > 0 else float('inf'))
+
+
+def load_item_actions(db, path, chunk_size=10000, code=3.0, item_meaningful_info=None, only_info=False,
+                      file_format=None, columns=None, log_every=10.0):
+    """
+    load the actions of users on items from a file with a record for each action, e.g.
+        user_id,item_id,code,timestamp
+        user1,item1,4,1467331200
+    the actions are inserted in the datastore in chunks with insert_item_actions_bulk, with the time
+    of the timestamp column, in seconds since the epoch, or the time of the insertion if there is none.
+
+    exception: raise an InsertException if a record has no user or item
+
+    :param db: the datastore, e.g. Recommender().db
+    :param path: the path of a CSV or JSON lines file, optionally gzipped (.gz)
+    :param chunk_size: number of actions inserted at once
+    :param code: the code of the actions without one, default value is 3.0
+    :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+    :param only_info: should only the info, and not the items, be considered
+    :param file_format: "csv" or "jsonl", if None it is guessed from the extension of the file
+    :param columns: dictionary with the names of the columns, if different from the defaults:
+        {"user_id": "user_id", "item_id": "item_id", "code": "code", "timestamp": "timestamp"}
+    :param log_every: seconds between two progress messages
+    :return: the number of actions loaded
+    """
+    names = {"user_id": "user_id", "item_id": "item_id", "code": "code", "timestamp": "timestamp"}
+    names.update(columns or {})
+    user_column, item_column, code_column = names["user_id"], names["item_id"], names["code"]
+    timestamp_column = names["timestamp"]
+
+    def actions():
+        for n, record in enumerate(read_records(path, file_format=file_format)):
+            user_id = record.get(user_column)
+            item_id = record.get(item_column)
+            if user_id is None or item_id is None:
+                raise InsertException("record %d of %s has no %s or %s" % (n, path, user_column, item_column))
+            value = record.get(code_column)
+            value = float(value) if value not in (None, '') else code
+            timestamp = record.get(timestamp_column)
+            if timestamp in (None, ''):
+                yield user_id, item_id, value  # the time of the insertion
+            else:
+                yield user_id, item_id, value, float(timestamp)
+
+    progress = _Progress("load_item_actions", log_every)
+    for chunk in chunks(actions(), chunk_size):
+        db.insert_item_actions_bulk(chunk, item_meaningful_info=item_meaningful_info, only_info=only_info)
+        progress.update(len(chunk))
+    progress.log()
+    return progress.rows
+
+
+def load_items(db, path, chunk_size=10000, file_format=None, id_column='item_id', log_every=10.0):
+    """
+    load the items from a catalogue file with a record for each item, e.g.
+        item_id,author,tags
+        item1,Author A,"[""nice"", ""good""]"
+    all the columns but the id are attributes of the items, lists in CSV files are written as JSON.
+    The items are inserted in the datastore in chunks with insert_items_bulk.
+
+    exception: raise an InsertException if a record has no id
+
+    :param db: the datastore, e.g. Recommender().db
+    :param path: the path of a CSV or JSON lines file, optionally gzipped (.gz)
+    :param chunk_size: number of items inserted at once
+    :param file_format: "csv" or "jsonl", if None it is guessed from the extension of the file
+    :param id_column: the name of the column with the item id
+    :param log_every: seconds between two progress messages
+    :return: the number of items loaded
+    """
+    def items():
+        for n, record in enumerate(read_records(path, file_format=file_format)):
+            item_id = record.pop(id_column, None)
+            if item_id is None:
+                raise InsertException("record %d of %s has no %s" % (n, path, id_column))
+            yield item_id, dict((k, _attribute(v)) for k, v in record.items() if v not in (None, ''))
+
+    progress = _Progress("load_items", log_every)
+    for chunk in chunks(items(), chunk_size):
+        db.insert_items_bulk(chunk)
+        progress.update(len(chunk))
+    progress.log()
+    return progress.rows
@@ -4,12 +4,23 @@ __email__ = "info@elegans.io"
 
 __base_error_code__ = 110
 
+import copy
+import logging
+import threading
+from time import time
 from collections import defaultdict
+from itertools import chain
 
 import pickle  # serialization library
+import numpy as np
 from csrec.dal import DALBase
 from csrec.tools.singleton import Singleton
 from csrec.tools.observable import observable
+from csrec.tools.rwlock import RWLock, read_locked, write_locked
+from csrec.tools.idmap import IdMap
+from csrec.tools.lazytable import LazyTable, EncodedRows, EncodedJson
+from csrec.tools import snapshot
+from csrec.action_log import ActionLog
 import json
 
 from csrec.exceptions import *
@@ -25,6 +36,7 @@ class Database(DALBase, Singleton):
 
         self.users_ratings_tbl = {}  # table with users rating
         self.items_ratings_tbl = {}  # table with items rating
+        self.users_times_tbl = {}  # time of the actions of each user, same keys of users_ratings_tbl
 
         self.users_social_tbl = {}  # table with action user-user
         self.info_used = set()
@@ -34,20 +46,54 @@ class Database(DALBase, Singleton):
         self.n_categories_user_ratings = {}  # number of ratings
         self.n_categories_item_ratings = {}
 
+        # integer indices of users, items and categories' values
+        self.users_map = IdMap()
+        self.items_map = IdMap()
+        self.categories_maps = {}  # category -> IdMap of the values
+        self.__users_keys = {}  # user id -> normalized user id, for the interned users
+        self.action_log = None  # optional ActionLog of the changes
+
     def init(self, **params):
         if not params:
             params = {}
         try:
             self.__params_dictionary.update(params)
+            log_path = params.get('log_path')
+            if log_path is not None:
+                self.action_log = ActionLog(log_path, sync_every=params.get('log_sync_every', 100),
+                                            sync_interval=params.get('log_sync_interval', 1.0))
+                self.action_log.attach(self)
         except Exception as e:
             e_message = "error during initialization"
-            raise InitializationException(e_message + " : " + e.message)
+            raise InitializationException(e_message + " : " + str(e))
 
     @staticmethod
     def get_init_parameters_description():
-        param_description = {}
+        param_description = {
+            "log_path": "the path of an append-only log of the changes, see csrec.action_log.ActionLog",
+            "log_sync_every": "number of changes after which the log is synced to disk, default 100",
+            "log_sync_interval": "seconds after which the changes are synced to disk, default 1.0",
+        }
         return param_description
 
+    def _user_key(self, user_id, intern=False):
+        """
+        user ids are stored as strings without dots, the normalization is done once for
+        each interned user
+
+        :param user_id: the user id
+        :param intern: assign an integer index to the user if it does not have one
+        :return: the normalized user id
+        """
+        key = self.__users_keys.get(user_id)
+        if key is None:
+            key = str(user_id).replace('.', '')
+            if intern:
+                self.users_map.intern(key)
+                self.__users_keys[user_id] = key
+        return key
+
+    @write_locked
     @observable
     def insert_item(self, item_id, attributes=None):
         """
@@ -63,6 +109,7 @@ class Database(DALBase, Singleton):
                 ...
             }
         """
+        self.items_map.intern(item_id)
         if attributes is not None:
             for k, v in attributes.items():
                 if not isinstance(v, list):
@@ -75,6 +122,36 @@ class Database(DALBase, Singleton):
             self.items_tbl[item_id] = {}
         return True
 
+    @write_locked
+    @observable
+    def insert_items_bulk(self, items):
+        """
+        insert many items at once, same as calling insert_item for each item but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param items: a dictionary {item_id: attributes}, an iterable of (item_id, attributes) pairs
+            or a pandas DataFrame indexed by item id with one column for each attribute
+        :return: the list of the inserted item ids
+        """
+        if hasattr(items, 'columns'):  # DataFrame
+            items = items.to_dict('index')
+        if hasattr(items, 'items'):
+            items = items.items()
+
+        item_ids = []
+        for item_id, attributes in items:
+            self.items_map.intern(item_id)
+            item = self.items_tbl.setdefault(item_id, {})
+            for k, v in (attributes or {}).items():
+                if v is None or v != v:  # missing values of DataFrames are NaN
+                    continue
+                item[k] = v if isinstance(v, list) else [v]
+            item_ids.append(item_id)
+        return item_ids
+
+    @write_locked
     @observable
     def remove_item(self, item_id=None):
         """
@@ -92,6 +169,7 @@ class Database(DALBase, Singleton):
         else:
             self.items_tbl.clear()
 
+    @read_locked
     def get_items(self, item_id=None):
         """
         get a dictionary of items
@@ -128,6 +206,7 @@ class Database(DALBase, Singleton):
         """
         return self.items_tbl.items()
 
+    @write_locked
     @observable
     def insert_social_action(self, user_id, user_id_to, code=3.0):
         """
@@ -144,6 +223,7 @@ class Database(DALBase, Singleton):
         """
         self.users_social_tbl.setdefault(user_id, {})[user_id_to] = code
 
+    @write_locked
     @observable
     def remove_social_action(self, user_id, user_id_to):
         """
@@ -159,6 +239,7 @@ class Database(DALBase, Singleton):
         except KeyError:
             pass
 
+    @read_locked
     def get_social_actions(self, user_id=None):
         """
         get the social actions
@@ -180,8 +261,10 @@ class Database(DALBase, Singleton):
         else:
             return self.users_social_tbl
 
+    @write_locked
     @observable
-    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False):
+    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False,
+                           timestamp=None):
         """
         insert a new item code on datastore, for each user a list of ratings will be maintained:
             user0: { 'item_0':3.0, ..., 'item_N':5.0}
@@ -195,9 +278,13 @@ class Database(DALBase, Singleton):
         :param code: the code, default value is 3.0
         :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
         :param only_info: should only the info, and not the item, be considered
+        :param timestamp: the time of the action in seconds since the epoch, if None the current time
+        :return: the timestamp of the action
         """
         if item_meaningful_info is None:
             item_meaningful_info = []
+        if timestamp is None:
+            timestamp = time()
 
         # If only_info==True, only the self.item_meaningful_info's are put in the co-occurrence, not item_id.
         # This is necessary when we have for instance a "segmentation page" where we propose
@@ -205,7 +292,7 @@ class Database(DALBase, Singleton):
         # to retrieve the info that s/he likes JK Rowling, narrative, magic etc
 
         # Now fill the dicts or the db collections if available
-        user_id = str(user_id).replace('.', '')
+        user_id = self._user_key(user_id, intern=True)
 
         item = self.get_items(item_id=item_id)[item_id]
         if item is not None:
@@ -213,6 +300,7 @@ class Database(DALBase, Singleton):
                 values = item.get(info)
                 if values is not None:
                     self.set_info_used(info)
+                    self.categories_maps.setdefault(info, IdMap()).intern_many(values)
 
                     # we cannot set the rating, because we want to keep the info
                     # that a user has read N books of, say, the same author,
@@ -242,7 +330,84 @@ class Database(DALBase, Singleton):
         if not only_info:
                 self.users_ratings_tbl.setdefault(user_id, {})[item_id] = code
                 self.items_ratings_tbl.setdefault(item_id, {})[user_id] = code
+                self.users_times_tbl.setdefault(user_id, {})[item_id] = timestamp
+        return timestamp
+
+    @write_locked
+    @observable
+    def insert_item_actions_bulk(self, actions, code=3.0, item_meaningful_info=None, only_info=False,
+                                 timestamp=None):
+        """
+        insert many item actions at once, same as calling insert_item_action for each action but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param actions: an iterable of (user_id, item_id), (user_id, item_id, code) or
+            (user_id, item_id, code, timestamp) tuples, a dictionary of arrays
+            {"user_id": [...], "item_id": [...], "code": [...], "timestamp": [...]} or a pandas DataFrame with
+            the same columns, "code" and "timestamp" are optional
+        :param code: the code of the actions without one, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the items, be considered
+        :param timestamp: the time of the actions without one, in seconds since the epoch,
+            if None the current time
+        :return: a tuple (users, timestamps) with the list of the users whose actions have been inserted
+            and the list of the timestamps of the actions, in their order, e.g. to log them
+        """
+        if item_meaningful_info is None:
+            item_meaningful_info = []
+        users, items, codes, timestamps = self._actions_columns(actions, code, timestamp)
+
+        # the tables of each category are looked up once
+        categories = []
+        for info in item_meaningful_info:
+            categories.append((info,
+                               self.tot_categories_user_ratings.setdefault(info, {}),
+                               self.n_categories_user_ratings.setdefault(info, {}),
+                               self.tot_categories_item_ratings.setdefault(info, {}),
+                               self.n_categories_item_ratings.setdefault(info, {})))
+
+        users_keys = {}  # user id -> normalized user id
+        inserted_users = []
+        inserted_users_set = set()
+        for user_id, item_id, code, timestamp in zip(users, items, codes, timestamps):
+            user_key = users_keys.get(user_id)
+            if user_key is None:
+                user_key = users_keys[user_id] = self._user_key(user_id, intern=True)
+                if user_key not in inserted_users_set:
+                    inserted_users_set.add(user_key)
+                    inserted_users.append(user_key)
+            user_id = user_key
+
+            item = self.items_tbl.get(item_id)
+            if item is not None:
+                for info, tot_user, n_user, tot_item, n_item in categories:
+                    values = item.get(info)
+                    if values is None:
+                        continue
+                    self.info_used.add(info)
+                    self.categories_maps.setdefault(info, IdMap()).intern_many(values)
+                    # same averages of insert_item_action
+                    tot_user_values = tot_user.setdefault(user_id, {})
+                    n_user_values = n_user.setdefault(user_id, {})
+                    for value in values:
+                        tot_user_values[value] = tot_user_values.get(value, 0) + int(code)
+                        n_user_values[value] = n_user_values.get(value, 0) + 1
+                        tot_item_users = tot_item.setdefault(value, {})
+                        tot_item_users[user_id] = tot_item_users.get(user_id, 0) + int(code)
+                        n_item_users = n_item.setdefault(value, {})
+                        n_item_users[user_id] = n_item_users.get(user_id, 0) + 1
+            else:
+                self.items_map.intern(item_id)
+                self.items_tbl[item_id] = {}
+            if not only_info:
+                self.users_ratings_tbl.setdefault(user_id, {})[item_id] = code
+                self.items_ratings_tbl.setdefault(item_id, {})[user_id] = code
+                self.users_times_tbl.setdefault(user_id, {})[item_id] = timestamp
+        return inserted_users, timestamps
 
+    @write_locked
     @observable
     def remove_item_action(self, user_id, item_id):
         """
@@ -254,6 +419,7 @@ class Database(DALBase, Singleton):
         :param item_id: item id
         :return: True if the operation was successfully executed or it does not exists, otherwise return False
         """
+        user_id = self._user_key(user_id)
         try:
             del self.users_ratings_tbl[user_id][item_id]
         except KeyError:
@@ -264,6 +430,12 @@ class Database(DALBase, Singleton):
         except KeyError:
             pass
 
+        try:
+            del self.users_times_tbl[user_id][item_id]
+        except KeyError:
+            pass
+
+    @read_locked
     def get_item_actions(self, user_id=None):
         """
         get a dictionary with user's actions
@@ -277,6 +449,7 @@ class Database(DALBase, Singleton):
             userN: { 'item_0':3.0, ..., 'item_N':5.0}
         """
         if user_id is not None:
+            user_id = self._user_key(user_id)
             item_actions = self.users_ratings_tbl.get(user_id)
             if item_actions is None:
                 return {}
@@ -298,6 +471,7 @@ class Database(DALBase, Singleton):
         """
         return self.users_ratings_tbl.items()
 
+    @read_locked
     def get_item_ratings(self, item_id=None):
         """
         get ratings on items made by users
@@ -319,6 +493,7 @@ class Database(DALBase, Singleton):
         else:
             return self.items_ratings_tbl
 
+    @read_locked
     def get_info_used(self):
         """
         get the categories used
@@ -329,6 +504,7 @@ class Database(DALBase, Singleton):
         """
         return self.info_used
 
+    @write_locked
     def set_info_used(self, info_used):
         """
         insert a new category
@@ -339,6 +515,7 @@ class Database(DALBase, Singleton):
         """
         self.info_used.add(info_used)
 
+    @write_locked
     def remove_info_used(self, info_used=None):
         """
         remove a category from the datastore
@@ -355,6 +532,7 @@ class Database(DALBase, Singleton):
         else:
             self.info_used.clear()
 
+    @write_locked
     @observable
     def remove_user(self, user_id):
         """
@@ -364,21 +542,21 @@ class Database(DALBase, Singleton):
 
         :param user_id: user id, raise an error if does not exists
         """
+        user_id = self._user_key(user_id)
         #  verifying that both users exists
         if user_id not in self.users_ratings_tbl:
             e_message = "unable to remove user, id does not exists: %s" % str(user_id)
             raise MergeEntitiesException(e_message)
 
-        # updating ratings
-        del self.users_ratings_tbl[user_id]
-
-        for key in self.items_ratings_tbl:
-            try:
-                self.items_ratings_tbl[key][user_id]
-            except KeyError:
-                pass
-            if self.items_ratings_tbl[key] == {}:
+        # updating ratings, only the items rated by the user are changed
+        for key in self.users_ratings_tbl.pop(user_id):
+            item_ratings = self.items_ratings_tbl.get(key)
+            if item_ratings is None:
+                continue
+            item_ratings.pop(user_id, None)
+            if not item_ratings:
                 del self.items_ratings_tbl[key]
+        self.users_times_tbl.pop(user_id, None)
 
         # updating the social stuff
         try:
@@ -387,17 +565,15 @@ class Database(DALBase, Singleton):
             pass
 
         for category in self.info_used:
-            if user_id in self.tot_categories_user_ratings[category]:
-                del self.tot_categories_user_ratings[category][user_id]
+            user_values = self.tot_categories_user_ratings.get(category, {}).pop(user_id, {})
+            self.n_categories_user_ratings.get(category, {}).pop(user_id, None)
 
-            if user_id in self.n_categories_user_ratings[category]:
-                del self.n_categories_user_ratings[category][user_id]
-
-            for v in self.tot_categories_item_ratings[category]:
-                if user_id in self.tot_categories_item_ratings[category][v]:
-                    del self.tot_categories_item_ratings[category][v][user_id]
-                    del self.n_categories_item_ratings[category][v][user_id]
+            # only the values rated by the user are changed
+            for v in user_values:
+                self.tot_categories_item_ratings.get(category, {}).get(v, {}).pop(user_id, None)
+                self.n_categories_item_ratings.get(category, {}).get(v, {}).pop(user_id, None)
 
+    @write_locked
     @observable
     def reconcile_user(self, old_user_id, new_user_id):
         """
@@ -409,6 +585,8 @@ class Database(DALBase, Singleton):
         :param old_user_id: old user id, raise an error if does not exists
         :param new_user_id: new user id, raise an error if does not exists
         """
+        old_user_id = self._user_key(old_user_id)
+        new_user_id = self._user_key(new_user_id)
         #  verifying that both users exists
         if old_user_id not in self.users_ratings_tbl:
             e_message = "unable to reconcile old user id does not exists: %s" % str(old_user_id)
@@ -434,6 +612,7 @@ class Database(DALBase, Singleton):
             except KeyError:
                 pass
             self.items_ratings_tbl.setdefault(i, {})[new_user_id] = r
+        self.users_times_tbl.setdefault(new_user_id, {}).update(self.users_times_tbl.pop(old_user_id, {}))
 
         # updating the social stuff
         old_social_dict = {}
@@ -453,6 +632,8 @@ class Database(DALBase, Singleton):
         self.users_social_tbl[new_user_id] = old_social_dict
 
         for category in self.info_used:
+            # only the values rated by the old user are changed
+            old_user_values = list(self.tot_categories_user_ratings.get(category, {}).get(old_user_id, ()))
             if old_user_id in self.tot_categories_user_ratings[category]:
                 tot_curr_cat_values = self.tot_categories_user_ratings[category][old_user_id]
                 del self.tot_categories_user_ratings[category][old_user_id]
@@ -472,19 +653,20 @@ class Database(DALBase, Singleton):
                         self.n_categories_user_ratings[category][new_user_id].setdefault(value, 0)
                         self.n_categories_user_ratings[category][new_user_id][value] += n_code
 
-            for v in self.tot_categories_item_ratings[category]:
-                if old_user_id in self.tot_categories_item_ratings[category][v]:
+            for v in old_user_values:
+                if old_user_id in self.tot_categories_item_ratings[category].get(v, ()):
                     tot_curr_cat_item_values = self.tot_categories_item_ratings[category][v][old_user_id]
                     del self.tot_categories_item_ratings[category][v][old_user_id]
                     self.tot_categories_item_ratings[category][v].setdefault(new_user_id, 0)
                     self.tot_categories_item_ratings[category][v][new_user_id] += tot_curr_cat_item_values
 
-                    tot_curr_cat_item_values = self.n_categories_item_ratings[category][v][old_user_id]
+                    n_curr_cat_item_values = self.n_categories_item_ratings[category][v][old_user_id]
                     del self.n_categories_item_ratings[category][v][old_user_id]
                     self.n_categories_item_ratings[category][v].setdefault(new_user_id, 0)
-                    self.n_categories_item_ratings[category][v][new_user_id] += 1
+                    self.n_categories_item_ratings[category][v][new_user_id] += n_curr_cat_item_values
 
 
+    @read_locked
     def get_user_count(self):
         """
         get the number of users who rated items
@@ -495,6 +677,7 @@ class Database(DALBase, Singleton):
         """
         return len(self.users_ratings_tbl)
 
+    @read_locked
     def get_items_count(self):
         """
         get the number of items
@@ -505,6 +688,7 @@ class Database(DALBase, Singleton):
         """
         return len(self.items_tbl)
 
+    @read_locked
     def get_social_count(self):
         """
         Get the number of social actions
@@ -522,6 +706,7 @@ class Database(DALBase, Singleton):
         for user in self.users_social_tbl:
             yield {user: self.users_social_tbl[user]}
 
+    @write_locked
     @observable
     def reset(self):
         """
@@ -532,58 +717,192 @@ class Database(DALBase, Singleton):
         self.items_tbl.clear()
         self.users_ratings_tbl.clear()
         self.items_ratings_tbl.clear()
+        self.users_times_tbl.clear()
         self.users_social_tbl.clear()
         self.tot_categories_user_ratings.clear()
         self.tot_categories_item_ratings.clear()
         self.n_categories_user_ratings.clear()
+        self.n_categories_item_ratings.clear()
         self.info_used.clear()
+        self.users_map.clear()
+        self.items_map.clear()
+        self.categories_maps.clear()
+        self.__users_keys.clear()
 
+    @read_locked
     @observable
-    def serialize(self, filepath):
+    def serialize(self, filepath, file_format='pickle'):
         """
         dump the datastore on file
 
         exception: raise a SerializeException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", a versioned binary format with the ids and
+            flat arrays of the tables and checksums, restored without decoding the tables (see LazyTable)
         """
+        self._serialize(filepath, file_format)
+
+    def _serialize(self, filepath, file_format):
         # Write chunks of text data
         try:
+            if file_format == 'snapshot':
+                write_tables_snapshot(filepath, self._tables())
+                return
             with open(filepath, 'wb') as f:
-                data_to_serialize = {'items': self.items_tbl,
-                                     'users_ratings': self.users_ratings_tbl,
-                                     'items_ratings': self.items_ratings_tbl,
-                                     'user_social': self.users_social_tbl,
-                                     'tot_categories_user_ratings': self.tot_categories_user_ratings,
-                                     'tot_categories_item_ratings': self.tot_categories_item_ratings,
-                                     'n_categories_user_ratings': self.n_categories_user_ratings,
-                                     'info_used': self.info_used
-                                     }
-                pickle.dump(data_to_serialize, f)
+                pickle.dump(self._tables(), f)
         except Exception as e:
             e_message = "unable to serialize data to file: %d" % (__base_error_code__ + 1)
-            raise SerializeException(e_message + " : " + e.message)
+            raise SerializeException(e_message + " : " + str(e))
 
+    def _tables(self):
+        """
+        :return: the dictionary of the tables written by serialize, the tables are not copied
+        """
+        return {'items': self.items_tbl,
+                'users_ratings': self.users_ratings_tbl,
+                'items_ratings': self.items_ratings_tbl,
+                'users_times': self.users_times_tbl,
+                'user_social': self.users_social_tbl,
+                'tot_categories_user_ratings': self.tot_categories_user_ratings,
+                'tot_categories_item_ratings': self.tot_categories_item_ratings,
+                'n_categories_user_ratings': self.n_categories_user_ratings,
+                'n_categories_item_ratings': self.n_categories_item_ratings,
+                'info_used': self.info_used,
+                'users_map': self.users_map.keys(),
+                'items_map': self.items_map.keys(),
+                'categories_maps': dict((c, m.keys()) for c, m in self.categories_maps.items()),
+                'generation': self.lock.generation
+                }
+
+    def serialize_background(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file without blocking the other requests: the tables are copied holding
+        the lock for reading, then the copy is written by a background thread while the datastore
+        keeps changing. When the file has been written the observers of serialize are notified by the
+        background thread, with the generation of the data written (see RWLock) in the generation
+        parameter, if any error occur it is logged and the observers get return_value False
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", see serialize
+        :return: the thread which writes the file, join() waits for the end
+        """
+        with self.lock.reader():
+            frozen = self._freeze()
+
+        def write():
+            try:
+                frozen._serialize(filepath, file_format)
+            except SerializeException as e:
+                logging.getLogger("csrc").error("[serialize_background] %s", e)
+                return_value = False
+            else:
+                return_value = True
+            self.notify('serialize', filepath=filepath, file_format=file_format,
+                        generation=frozen.lock.generation, return_value=return_value)
+
+        worker = threading.Thread(target=write, name="csrec-serialize")
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _freeze(self):
+        """
+        :return: a copy of the datastore which does not change with it, with its own lock and the same
+            observers. The dictionaries are copied, the ids and the values are shared
+        """
+        def copy_table(table, depth):
+            if isinstance(table, LazyTable):
+                # the rows not decoded yet are shared
+                return table.copy(lambda row: copy_table(row, depth - 1))
+            if depth == 1:
+                return dict(table)
+            return dict((k, copy_table(v, depth - 1)) for k, v in table.items())
+
+        frozen = copy.copy(self)
+        frozen.lock = RWLock()
+        frozen.lock.generation = self.lock.generation
+        frozen.action_log = None
+        frozen.items_tbl = copy_table(self.items_tbl, 2)
+        frozen.users_ratings_tbl = copy_table(self.users_ratings_tbl, 2)
+        frozen.items_ratings_tbl = copy_table(self.items_ratings_tbl, 2)
+        frozen.users_times_tbl = copy_table(self.users_times_tbl, 2)
+        frozen.users_social_tbl = copy_table(self.users_social_tbl, 2)
+        frozen.info_used = set(self.info_used)
+        for table_name in self._categories_tables:
+            setattr(frozen, table_name, copy_table(getattr(self, table_name), 3))
+        frozen.users_map = self.users_map.copy()
+        frozen.items_map = self.items_map.copy()
+        frozen.categories_maps = dict((c, m.copy()) for c, m in self.categories_maps.items())
+        return frozen
+
+    @write_locked
     @observable
-    def restore(self, filepath):
+    def restore(self, filepath, file_format=None, mmap=False):
         """
         restore the datastore from file
 
         exception: raise a RestoreException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", if None it is detected from the content of the file.
+            Only snapshots should be loaded from untrusted sources
+        :param mmap: memory map the arrays of snapshots instead of reading them, the checksums
+            of the arrays are not verified
         """
         # Write chunks of text data
         try:
+            if file_format is None:
+                file_format = 'snapshot' if snapshot.is_snapshot(filepath) else 'pickle'
+            if file_format == 'snapshot':
+                # the snapshot holds the indices of all the ids in its tables, and the timestamps
+                self._restore_tables(read_tables_snapshot(filepath, mmap=mmap), complete=True)
+                return
             with open(filepath, 'rb') as f:
-                data_from_file = pickle.load(f)
-                self.items_tbl = data_from_file['items']
-                self.users_ratings_tbl = data_from_file['users_ratings']
-                self.items_ratings_tbl = data_from_file['items_ratings']
-                self.users_social_tbl = data_from_file['user_social']
-                self.tot_categories_user_ratings = data_from_file['tot_categories_user_ratings']
-                self.tot_categories_item_ratings = data_from_file['tot_categories_item_ratings']
-                self.n_categories_user_ratings = data_from_file['n_categories_user_ratings']
-                self.info_used = data_from_file['info_used']
+                self._restore_tables(pickle.load(f))
         except Exception as e:
             e_message = "unable to load data from file: %d" % (__base_error_code__ + 2)
-            raise RestoreException(e_message + " : " + e.message)
+            raise RestoreException(e_message + " : " + str(e))
+
+    _categories_tables = ('tot_categories_user_ratings', 'n_categories_user_ratings',
+                          'tot_categories_item_ratings', 'n_categories_item_ratings')
+
+    def _restore_tables(self, data, complete=False):
+        """
+        replace the tables with the dictionary written by serialize
+
+        :param complete: the ids of the tables are known to be all in the maps of the ids, see _restore_maps,
+            and every action has a timestamp
+        """
+        self.items_tbl = data['items']
+        self.users_ratings_tbl = data['users_ratings']
+        self.items_ratings_tbl = data['items_ratings']
+        self.users_times_tbl = data.get('users_times', {})
+        self.users_social_tbl = data['user_social']
+        self.tot_categories_user_ratings = data['tot_categories_user_ratings']
+        self.tot_categories_item_ratings = data['tot_categories_item_ratings']
+        self.n_categories_user_ratings = data['n_categories_user_ratings']
+        self.n_categories_item_ratings = data.get('n_categories_item_ratings', {})
+        self.info_used = data['info_used']
+        self._restore_maps(data.get('users_map', ()), data.get('items_map', ()), data.get('categories_maps', {}),
+                           complete=complete)
+        if not complete:
+            self._fill_times()
+        self.lock.generation = data.get('generation', 0)
+
+    def _fill_times(self, timestamp=None):
+        """
+        the actions restored without a timestamp, e.g. from files written by older versions, get the same one
+
+        :param timestamp: the timestamp, if None the current time
+        """
+        if timestamp is None:
+            timestamp = time()
+        for user_id, actions in self.users_ratings_tbl.items():
+            user_times = self.users_times_tbl.setdefault(user_id, {})
+            if len(user_times) < len(actions):
+                for item_id in actions:
+                    user_times.setdefault(item_id, timestamp)
 
     def get_tot_categories_user_ratings(self):
         return self.tot_categories_user_ratings
@@ -596,3 +915,369 @@ class Database(DALBase, Singleton):
 
     def get_n_categories_user_ratings(self):
         return self.n_categories_user_ratings
+
+    def _restore_maps(self, users_keys, items_keys, categories_keys, complete=False):
+        """
+        rebuild the integer indices of users, items and categories' values, the indices
+        found in the serialized data are kept and missing ids are appended
+
+        :param complete: the ids of the tables are known to be all in the serialized indices
+        """
+        self.users_map = IdMap(users_keys)
+        self.items_map = IdMap(items_keys)
+        self.categories_maps = dict((c, IdMap(k)) for c, k in categories_keys.items())
+        if complete:
+            self.__users_keys = dict(zip(self.users_map, self.users_map))
+            return
+        self.__users_keys = {}
+        for user_id in self.users_ratings_tbl:
+            self.users_map.intern(user_id)
+        for user_id in self.users_map:
+            self.__users_keys[user_id] = user_id
+        for item_id in self.items_tbl:
+            self.items_map.intern(item_id)
+        for item_id in self.items_ratings_tbl:
+            self.items_map.intern(item_id)
+        for category, users_values in self.n_categories_user_ratings.items():
+            values_map = self.categories_maps.setdefault(category, IdMap())
+            for values in users_values.values():
+                values_map.intern_many(values)
+
+    @read_locked
+    def get_user_index(self, user_id):
+        """
+        get the integer index of a user
+
+        :param user_id: user id
+        :return: the index of the user, None if the user has never rated an item
+        """
+        return self.users_map.index(self._user_key(user_id))
+
+    @read_locked
+    def get_item_index(self, item_id):
+        """
+        get the integer index of an item
+
+        :param item_id: item id
+        :return: the index of the item, None if the item does not exists
+        """
+        return self.items_map.index(item_id)
+
+    def get_users_map(self):
+        """
+        :return: the IdMap between user ids and integer indices
+        """
+        return self.users_map
+
+    def get_items_map(self):
+        """
+        :return: the IdMap between item ids and integer indices
+        """
+        return self.items_map
+
+    def get_category_values_map(self, info):
+        """
+        :param info: the category e.g. "author"
+        :return: the IdMap between the values of the category and integer indices
+        """
+        return self.categories_maps.setdefault(info, IdMap())
+
+    @read_locked
+    def get_item_actions_arrays(self, user_id=None, timestamps=False):
+        """
+        get the users' actions as coordinates of a sparse matrix users x items
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :param timestamps: return the timestamps of the actions too
+        :return: a tuple (users, items, codes) of numpy arrays, users and items are indices
+            of get_users_map() and get_items_map(), (users, items, codes, timestamps) with timestamps
+        """
+        if user_id is not None:
+            user_id = self._user_key(user_id)
+            table = {user_id: self.users_ratings_tbl.get(user_id, {})}
+        else:
+            table = self.users_ratings_tbl
+        return self._table_arrays(table, self.users_map, self.items_map,
+                                  values_table=self.users_times_tbl if timestamps else None)
+
+    @read_locked
+    def get_categories_user_ratings_arrays(self, info, user_id=None):
+        """
+        get the ratings of users on the values of a category as coordinates of a sparse matrix
+        users x values
+
+        exception: raise a GetException if any error occur
+
+        :param info: the category e.g. "author"
+        :param user_id: user id, if None returns the ratings of all users
+        :return: a tuple (users, values, tot, n) of numpy arrays, users and values are indices
+            of get_users_map() and get_category_values_map(info), tot is the sum of ratings
+            and n the number of ratings
+        """
+        tot_table = self.tot_categories_user_ratings.get(info, {})
+        n_table = self.n_categories_user_ratings.get(info, {})
+        if user_id is not None:
+            user_id = self._user_key(user_id)
+            tot_table = {user_id: tot_table.get(user_id, {})}
+            n_table = {user_id: n_table.get(user_id, {})}
+        return self._table_arrays(tot_table, self.users_map, self.get_category_values_map(info), values_table=n_table)
+
+    @staticmethod
+    def _table_arrays(table, rows_map, columns_map, values_table=None):
+        """
+        :param values_table: table with the same keys of table, e.g. the timestamps of the ratings
+        :return: a tuple (rows, columns, data) of numpy arrays with the indices of the keys of the row and of the
+            column and the value of each element of table, with the values of values_table of the same elements
+            if not None
+        """
+        arrays = []
+        rows = table.items()
+        if isinstance(table, LazyTable) and table.coordinates is not None:
+            # the rows not decoded yet, i.e. not changed since the restore, are read from the arrays of the snapshot
+            rows_indices, columns, data = table.coordinates
+            encoded = set(table.encoded_keys())
+            if values_table is not None:
+                if isinstance(values_table, LazyTable) and values_table.coordinates is not None and \
+                        values_table.coordinates[1] is columns:
+                    encoded.intersection_update(values_table.encoded_keys())
+                else:
+                    encoded = set()
+            if encoded:
+                mask = np.zeros(len(rows_map), dtype=bool)
+                mask[rows_map.indices(encoded, count=len(encoded))] = True
+                selected = mask[rows_indices]
+                arrays.append([rows_indices[selected].astype(IdMap.dtype), columns[selected].astype(IdMap.dtype),
+                               data[selected].astype(np.float64)])
+                if values_table is not None:
+                    arrays[-1].append(values_table.coordinates[2][selected].astype(np.float64))
+                rows = ((row_key, table[row_key]) for row_key in table if row_key not in encoded)
+        for row_key, row in rows:
+            if not row:
+                continue
+            arrays.append([np.full(len(row), rows_map.index(row_key), dtype=IdMap.dtype),
+                           np.fromiter((columns_map.index(k) for k in row), dtype=IdMap.dtype, count=len(row)),
+                           np.fromiter(row.values(), dtype=np.float64, count=len(row))])
+            if values_table is not None:
+                # the values are read in the same order of the elements
+                values_row = values_table[row_key]
+                arrays[-1].append(np.fromiter((values_row[k] for k in row), dtype=np.float64, count=len(row)))
+        if not arrays:
+            empty = (np.empty(0, dtype=IdMap.dtype), np.empty(0, dtype=IdMap.dtype), np.empty(0, dtype=np.float64))
+            return empty if values_table is None else empty + (np.empty(0, dtype=np.float64),)
+        return tuple(np.concatenate(a) for a in zip(*arrays))
+
+# Snapshot of the tables written by serialize, see csrec.tools.snapshot: the ids of users, items, values of the
+# categories and users of the social actions are encoded once. The tables of the users are encoded as flat arrays
+# of indices and values, each one in the narrowest type which holds it exactly, e.g. one byte for codes 1-5; the
+# timestamps and the number of ratings of the categories are stored in the order of the ratings and of their sum,
+# without their indices. The tables of the items are the transposed tables of the users, only the ids of their
+# rows are stored. The attributes of each item are a JSON string. The tables are restored as LazyTable, each row
+# is decoded on its first access.
+
+_SNAPSHOT_LAYOUT = 2
+
+
+def _snapshot_tables(categories):
+    """
+    :return: the tables of the users in the snapshot: name, key of the table in the serialized data, category
+        of the table or None, ids of the rows, ids of the columns, type of the values, name of the table in the
+        same order or None, name of the transposed table or None
+    """
+    tables = [('users_ratings', 'users_ratings', None, 'users', 'items', np.float64, None, 'items_ratings'),
+              ('users_times', 'users_times', None, 'users', 'items', np.float64, 'users_ratings', None),
+              ('users_social', 'user_social', None, 'social', 'social', np.float64, None, None)]
+    for n, info in enumerate(categories):
+        tot, count = 'tot_categories_user_ratings.%d' % n, 'n_categories_user_ratings.%d' % n
+        tables += [(tot, 'tot_categories_user_ratings', info, 'users', 'values.%d' % n, np.int64, None,
+                    'tot_categories_item_ratings.%d' % n),
+                   (count, 'n_categories_user_ratings', info, 'users', 'values.%d' % n, np.int64, tot,
+                    'n_categories_item_ratings.%d' % n)]
+    return tables
+
+
+def _transposed_tables(categories):
+    """
+    :return: the tables of the items in the snapshot: name, key of the table in the serialized data, category
+        of the table or None, ids of the rows
+    """
+    tables = [('items_ratings', 'items_ratings', None, 'items')]
+    for n, info in enumerate(categories):
+        tables += [('tot_categories_item_ratings.%d' % n, 'tot_categories_item_ratings', info, 'values.%d' % n),
+                   ('n_categories_item_ratings.%d' % n, 'n_categories_item_ratings', info, 'values.%d' % n)]
+    return tables
+
+
+def _index_dtype(ids_map):
+    """
+    :return: the narrowest type of the indices of a map
+    """
+    return np.min_scalar_type(max(len(ids_map) - 1, 0))
+
+
+def _narrow(values):
+    """
+    :param values: numpy array
+    :return: the values in the narrowest type which holds them exactly
+    """
+    if not len(values):
+        return values.astype(np.uint8)
+    if values.dtype.kind == 'f':
+        if not np.all(np.abs(values) < 2 ** 53):  # also with nan
+            return values
+        integers = values.astype(np.int64)
+        if not np.array_equal(integers, values):
+            single = values.astype(np.float32)
+            return single if np.array_equal(single, values) else values
+        values = integers
+    return values.astype(np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max())))
+
+
+def _encode_table(table, rows_map, columns_map, dtype):
+    """
+    encode a dictionary of dictionaries as flat arrays: the indices of the rows, the number
+    of elements of each row, the indices of the columns and the values
+    """
+    lengths = np.fromiter(map(len, table.values()), dtype=np.int64, count=len(table))
+    n = int(lengths.sum())
+    rows = rows_map.indices(table, count=len(table)).astype(_index_dtype(rows_map))
+    columns = columns_map.indices(chain.from_iterable(table.values()), count=n).astype(_index_dtype(columns_map))
+    data = np.fromiter(chain.from_iterable(row.values() for row in table.values()), dtype=dtype, count=n)
+    return rows, _narrow(lengths), columns, _narrow(data)
+
+
+def _encode_values(table, like, dtype, default):
+    """
+    encode the values of a dictionary of dictionaries in the order of the elements of another one with the
+    same keys, the values missing are default
+    """
+    def values():
+        for row_key, row in like.items():
+            table_row = table.get(row_key, {})
+            for column_key in row:
+                yield table_row.get(column_key, default)
+
+    return _narrow(np.fromiter(values(), dtype=dtype, count=sum(map(len, like.values()))))
+
+
+def write_tables_snapshot(filepath, data):
+    """
+    write the tables of a datastore in a snapshot, which can be restored by any datastore. The actions without
+    a timestamp get the current time, the timestamps and the number of ratings of the categories which do not
+    belong to a rating are not written
+
+    :param filepath: the path of the file
+    :param data: the dictionary of the tables written by Database.serialize, the maps of the ids
+        must hold all the users, items and values of the categories of the tables
+    """
+    categories = sorted(set(chain.from_iterable(data[t] for t in Database._categories_tables)) |
+                        set(data.get('categories_maps', {})))
+    social = IdMap()
+    for user_id, actions in data['user_social'].items():
+        social.intern(user_id)
+        social.intern_many(actions)
+    maps = {'users': IdMap(data.get('users_map', ())), 'items': IdMap(data.get('items_map', ())), 'social': social}
+    for n, info in enumerate(categories):
+        maps['values.%d' % n] = IdMap(data.get('categories_maps', {}).get(info, ()))
+
+    def table(key, info):
+        return data.get(key, {}) if info is None else data.get(key, {}).get(info, {})
+
+    arrays = {}
+    ids_kinds = {}
+    for name, ids_map in maps.items():
+        ids_kinds[name], arrays[name + '.data'], arrays[name + '.offsets'] = snapshot.encode_strings(ids_map.keys())
+        arrays[name + '.offsets'] = _narrow(arrays[name + '.offsets'])
+    tables = dict((t[0], t) for t in _snapshot_tables(categories))
+    now = time()
+    for name, key, info, rows_map, columns_map, dtype, like, _ in tables.values():
+        if like is not None:
+            arrays[name + '.data'] = _encode_values(table(key, info), table(*tables[like][1:3]), dtype,
+                                                    now if name == 'users_times' else 0)
+            continue
+        arrays[name + '.rows'], arrays[name + '.lengths'], arrays[name + '.columns'], arrays[name + '.data'] = \
+            _encode_table(table(key, info), maps[rows_map], maps[columns_map], dtype)
+    for name, key, info, rows_map in _transposed_tables(categories):
+        rows = table(key, info)
+        arrays[name + '.rows'] = maps[rows_map].indices(rows, count=len(rows)).astype(_index_dtype(maps[rows_map]))
+    items = data['items']
+    arrays['items_tbl.rows'] = maps['items'].indices(items, count=len(items)).astype(_index_dtype(maps['items']))
+    _, arrays['items_tbl.data'], arrays['items_tbl.offsets'] = \
+        snapshot.encode_strings([json.dumps(items[i]) for i in items])
+    arrays['items_tbl.offsets'] = _narrow(arrays['items_tbl.offsets'])
+
+    metadata = {'dal': 'mem', 'layout': _SNAPSHOT_LAYOUT, 'categories': categories,
+                'info_used': sorted(data['info_used']), 'ids': ids_kinds, 'generation': data.get('generation', 0),
+                'categories_tables': dict((t, [info for info in categories if info in data[t]])
+                                          for t in Database._categories_tables)}
+    snapshot.write_snapshot(filepath, arrays, metadata)
+
+
+def read_tables_snapshot(filepath, mmap=False):
+    """
+    read a snapshot written by write_tables_snapshot, the tables are LazyTable: the restore decodes only the ids,
+    the rows are decoded on their first access
+
+    exception: raise a RestoreException if the file is not a snapshot of the tables
+
+    :param filepath: the path of the file
+    :param mmap: memory map the arrays instead of reading them, the checksums are not verified
+    :return: the dictionary of the tables written by Database.serialize, the maps of the ids hold
+        all the ids of the tables and every action has a timestamp
+    """
+    metadata, arrays = snapshot.read_snapshot(filepath, mmap=mmap, verify=not mmap)
+    if metadata.get('dal') != 'mem':
+        raise RestoreException("the snapshot does not hold the tables of a datastore")
+    if metadata.get('layout') != _SNAPSHOT_LAYOUT:
+        raise RestoreException("the layout of the tables of the snapshot is not supported")
+    categories = metadata['categories']
+    ids = dict((name, snapshot.decode_strings(kind, arrays[name + '.data'], arrays[name + '.offsets']))
+               for name, kind in metadata['ids'].items())
+
+    tables = {}
+    elements = {}  # name -> keys of the rows, offsets, indices of the rows and of the columns of each element
+    transposes = {}  # name -> order of the elements by column, offsets of the columns
+    for name, _, _, rows_ids, columns_ids, dtype, like, transposed in _snapshot_tables(categories):
+        if like is None:
+            rows, lengths = arrays[name + '.rows'], arrays[name + '.lengths']
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            elements[name] = ([ids[rows_ids][r] for r in rows.tolist()], offsets, np.repeat(rows, lengths),
+                              arrays[name + '.columns'])
+        else:
+            elements[name] = elements[like]
+        keys, offsets, rows, columns = elements[name]
+        values = arrays[name + '.data']
+        tables[name] = LazyTable(keys, range(len(keys)), EncodedRows(offsets, columns, values, ids[columns_ids], dtype),
+                                 coordinates=(rows, columns, values))
+        if transposed is None:
+            continue
+        if like is None:
+            columns_offsets = np.zeros(len(ids[columns_ids]) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(columns, minlength=len(ids[columns_ids])), out=columns_offsets[1:])
+            transposes[name] = (np.argsort(columns, kind='mergesort'), columns_offsets)
+        else:
+            transposes[name] = transposes[like]
+        order, columns_offsets = transposes[name]
+        transposed_rows = arrays[transposed + '.rows'].tolist()
+        tables[transposed] = LazyTable([ids[columns_ids][c] for c in transposed_rows], transposed_rows,
+                                       EncodedRows(columns_offsets, rows[order], values[order], ids[rows_ids], dtype))
+    items = ids['items']
+    items_rows = arrays['items_tbl.rows'].tolist()
+    data = {'items': LazyTable([items[i] for i in items_rows], range(len(items_rows)),
+                               EncodedJson(arrays['items_tbl.data'], arrays['items_tbl.offsets'])),
+            'users_ratings': tables['users_ratings'],
+            'items_ratings': tables['items_ratings'],
+            'users_times': tables['users_times'],
+            'user_social': tables['users_social'],
+            'info_used': set(metadata['info_used']),
+            'users_map': ids['users'],
+            'items_map': items,
+            'categories_maps': dict((info, ids['values.%d' % n]) for n, info in enumerate(categories)),
+            'generation': metadata.get('generation', 0)}
+    for table_name in Database._categories_tables:
+        present = set(metadata['categories_tables'][table_name])
+        data[table_name] = dict((info, tables['%s.%d' % (table_name, n)])
+                                for n, info in enumerate(categories) if info in present)
+    return data
@@ -0,0 +1,62 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+from time import time
+
+import numpy as np
+from scipy import sparse
+
+
+# version of the files written by Recommender.save_model
+MODEL_VERSION = 1
+
+
+class Model(object):
+    """
+    Read-only snapshot of the data computed by the recommender from the datastore:
+    the co-occurrence matrices as CSR, the neighbours of the items if pruned, and the items sorted by popularity.
+    A snapshot is never modified after its creation: a new one is built and swapped in
+    with a single assignment, so readers always see a consistent model.
+    """
+    def __init__(self, items_cooccurrence=None, categories_cooccurrence=None,
+                 items_by_popularity=None, popular_items=None, items=None, neighbours=None):
+        """
+        :param items_cooccurrence: scipy.sparse.csr_matrix items x items
+        :param categories_cooccurrence: dictionary {info: scipy.sparse.csr_matrix values x values}
+        :param items_by_popularity: list of item ids sorted by popularity, if None it is built
+            from popular_items and items on first use
+        :param popular_items: numpy array with the indices of items_by_popularity
+        :param items: IdMap of the items
+        :param neighbours: Neighbours of the items, the same scores of items_cooccurrence as fixed-width arrays,
+            None if the neighbourhood is not pruned
+        """
+        if items_cooccurrence is None:
+            items_cooccurrence = sparse.csr_matrix((0, 0))
+        self.items_cooccurrence = items_cooccurrence
+        self.categories_cooccurrence = categories_cooccurrence if categories_cooccurrence is not None else {}
+        if popular_items is None:
+            popular_items = np.empty(0, dtype=np.int64)
+        self.popular_items = popular_items
+        self._items_by_popularity = items_by_popularity
+        self._items = items
+        self.neighbours = neighbours
+        self.created = time()
+
+    @property
+    def items_by_popularity(self):
+        """
+        list of item ids sorted by popularity
+        """
+        if self._items_by_popularity is None:
+            if self._items is None:
+                self._items_by_popularity = []
+            else:
+                self._items_by_popularity = [self._items.key(i) for i in self.popular_items.tolist()]
+        return self._items_by_popularity
+
+    def with_popularity(self, popular_items, items):
+        """
+        :return: a new snapshot with the same matrices and a new popularity
+        """
+        return Model(self.items_cooccurrence, self.categories_cooccurrence, popular_items=popular_items, items=items,
+                     neighbours=self.neighbours)
@@ -0,0 +1,110 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import numpy as np
+from scipy import sparse
+
+from csrec.tools.sparse import top_k_rows
+
+
+class Neighbours(object):
+    """
+    The k most similar items (neighbours) of each item, as fixed-width arrays.
+
+    Row i of indices holds the indices of the neighbours of the item with index i by decreasing score,
+    padded with -1, and the same row of scores their similarity, padded with 0. The memory is
+    n_items * k whatever the number of co-occurring pairs, and the scores of a user are gathered
+    from the rows of the rated items only, with a single fancy indexing operation.
+    """
+    dtype = np.int32
+
+    def __init__(self, indices=None, scores=None):
+        """
+        :param indices: numpy array n_items x k with the indices of the neighbours, -1 for no neighbour
+        :param scores: numpy array n_items x k with the scores of the neighbours
+        """
+        self.indices = indices if indices is not None else np.full((0, 0), -1, dtype=self.dtype)
+        self.scores = scores if scores is not None else np.zeros((0, 0), dtype=np.float64)
+
+    @classmethod
+    def from_matrix(cls, similarity, k, support=None, min_support=1):
+        """
+        keep the k strongest neighbours of each item
+
+        :param similarity: scipy.sparse.csr_matrix items x items with the similarity of the items,
+            e.g. the co-occurrence counts, the diagonal is ignored
+        :param k: number of neighbours kept for each item
+        :param support: scipy sparse matrix items x items with the number of users who rated both items,
+            the similarity if None
+        :param min_support: minimum number of users who rated both items for a pair to be kept
+        :return: a Neighbours instance
+        """
+        similarity = sparse.csr_matrix(similarity)
+        n = similarity.shape[0]
+        if support is None:
+            support = similarity
+        else:
+            support = sparse.csr_matrix(support)[:n, :n]
+        # the support of the non-zero similarities is read with the same sparsity
+        mask = support.multiply(similarity != 0).tocsr()
+        mask.data = (mask.data >= min_support).astype(np.float64)
+        candidates = similarity.multiply(mask).tocoo()
+        keep = (candidates.row != candidates.col) & (candidates.data != 0)
+        candidates = sparse.csr_matrix((candidates.data[keep], (candidates.row[keep], candidates.col[keep])),
+                                       shape=(n, n))
+        kept = top_k_rows(candidates, k)
+        lengths = np.diff(kept.indptr)
+        rows = np.repeat(np.arange(n), lengths)
+        # neighbours of each row by decreasing score, ties by index
+        order = np.lexsort((kept.indices, -kept.data, rows))
+        columns = np.arange(kept.nnz) - kept.indptr[rows]
+        width = max(int(k), 0)
+        indices = np.full((n, width), -1, dtype=cls.dtype)
+        scores = np.zeros((n, width), dtype=np.float64)
+        indices[rows, columns] = kept.indices[order]
+        scores[rows, columns] = kept.data[order]
+        return cls(indices, scores)
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    @property
+    def nnz(self):
+        """
+        number of the neighbours of all the items
+        """
+        return int(np.count_nonzero(self.indices >= 0))
+
+    def score(self, items, weights):
+        """
+        sum the scores of the neighbours of the items weighted by the weights, e.g. the ratings of a user
+
+        :param items: numpy array with the indices of the items, e.g. rated by a user. The items without
+            a row, e.g. inserted after the neighbours were computed, are ignored
+        :param weights: numpy array with the weight of each item
+        :return: a tuple (neighbours, scores) of numpy arrays, neighbours are sorted indices of items
+        """
+        items = np.asarray(items)
+        weights = np.asarray(weights, dtype=np.float64)
+        known = items < len(self)
+        # the scores are summed in the order of the items, like a sparse product does
+        order = np.argsort(items[known], kind='mergesort')
+        items, weights = items[known][order], weights[known][order]
+        neighbours = self.indices[items]
+        valid = neighbours >= 0
+        keys, position = np.unique(neighbours[valid], return_inverse=True)
+        scores = (self.scores[items] * weights[:, None])[valid]
+        return keys, np.bincount(position, weights=scores, minlength=len(keys))
+
+    def tocsr(self):
+        """
+        :return: the neighbours as a scipy.sparse.csr_matrix items x items, e.g. to score many users
+            with a sparse product
+        """
+        n = len(self)
+        valid = self.indices >= 0
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=indptr[1:])
+        matrix = sparse.csr_matrix((self.scores[valid], self.indices[valid], indptr), shape=(n, n))
+        matrix.sort_indices()
+        return matrix
@@ -0,0 +1,250 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+from math import exp
+from time import time
+
+import numpy as np
+
+from csrec.tools.sortedlist import SortedList
+
+
+class Popularity(object):
+    """
+    Items sorted by popularity, the sum of the codes of their actions (e.g. a purchase rated 5 counts more
+    than a view rated 1), kept sorted while the actions change.
+
+    The codes of each user are kept, so that any change of the actions of a user updates the sums of the
+    items whose code changed only. The listed items are kept in a SortedList by their key: (0, -sum, index)
+    for the rated items and (1, 0, index) for the unrated items of the catalogue, so the rated items come first
+    by decreasing sum and ties are ordered by item index. The order depends only on the actions and on the
+    catalogue, not on the order of the changes: an index updated on each action is the same of an index built
+    from scratch. A change costs O(log n) and the top-N items are the first N keys.
+
+    Items neither rated nor in the catalogue (e.g. removed) are not listed by popular_items.
+
+    An order saved with the model can be used with map() until the first change: the index must be built
+    again with build() before it is updated.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sums = {}  # item index -> sum of the codes, only the rated items
+        self.counts = {}  # item index -> number of users who rated it, only the rated items
+        self.users = {}  # user index -> {item index: code}
+        self.catalogue = set()  # indices of the items in the catalogue
+        self.keys = {}  # item index -> key in the index, only the listed items
+        self.index = SortedList()
+        self.mapped = None  # order of the items saved with the model, see map()
+
+    def _values(self, codes, timestamps):
+        """
+        :param codes: numpy array with the codes of the actions
+        :param timestamps: not used, see DecayedPopularity
+        :return: a tuple (counted, values) of numpy arrays: the mask of the actions which are counted and
+            the value of each action in the sums
+        """
+        return np.ones(len(codes), dtype=bool), codes
+
+    def _key(self, item):
+        if self.counts.get(item):
+            return 0, -self.sums[item], item
+        return (1, 0, item) if item in self.catalogue else None
+
+    def _move(self, item):
+        """
+        move an item to the position of its current key
+        """
+        old, new = self.keys.get(item), self._key(item)
+        if old == new:
+            return
+        if old is not None:
+            self.index.remove(old)
+        if new is None:
+            del self.keys[item]
+        else:
+            self.index.add(new)
+            self.keys[item] = new
+
+    def _change(self, item, old, new):
+        """
+        replace the value of the action of a user on an item
+
+        :param item: item index
+        :param old: the old value, None if the user had not rated the item
+        :param new: the new value, None if the user does not rate the item any more
+        """
+        count, total = self.counts.get(item, 0), self.sums.get(item, 0.0)
+        if old is not None:
+            count, total = count - 1, total - old
+        if new is not None:
+            count, total = count + 1, total + new
+        if count:
+            self.counts[item] = count
+            self.sums[item] = total
+        else:  # the sums of real values do not cancel exactly
+            self.counts.pop(item, None)
+            self.sums.pop(item, None)
+        self._move(item)
+
+    def build(self, users, items, codes, catalogue, timestamps=None):
+        """
+        build the index from scratch
+
+        :param users: numpy array with the user index of each action
+        :param items: numpy array with the item index of each action
+        :param codes: numpy array with the code of each action
+        :param catalogue: iterable with the indices of the items in the catalogue
+        :param timestamps: numpy array with the time of each action, see DecayedPopularity
+        """
+        self.clear()
+        counted, values = self._values(np.asarray(codes, dtype=np.float64), timestamps)
+        users, items, values = np.asarray(users)[counted], np.asarray(items)[counted], values[counted]
+        order = np.argsort(users, kind='mergesort')
+        users, items, values = users[order], items[order].astype(np.int64), values[order]
+        if len(users):
+            # the actions of each user are contiguous
+            starts = np.r_[0, np.flatnonzero(np.diff(users)) + 1]
+            ends = np.r_[starts[1:], len(users)]
+            items_list, values_list = items.tolist(), values.tolist()
+            for user, start, end in zip(users[starts].tolist(), starts.tolist(), ends.tolist()):
+                self.users[user] = dict(zip(items_list[start:end], values_list[start:end]))
+        counts = np.bincount(items)
+        sums = np.bincount(items, weights=values)
+        rated = np.flatnonzero(counts)
+        self.counts = dict(zip(rated.tolist(), counts[rated].tolist()))
+        self.sums = dict(zip(rated.tolist(), sums[rated].tolist()))
+        self.catalogue = set(int(item) for item in catalogue)
+        self.keys = dict((item, self._key(item)) for item in set(self.counts) | self.catalogue)
+        self.index = SortedList(sorted(self.keys.values()))
+
+    def map(self, popular_items):
+        """
+        use the order of the items saved with the model, see popular_items, until the index is built again
+
+        :param popular_items: numpy array with the indices of the items sorted by popularity
+        """
+        self.clear()
+        self.mapped = popular_items
+
+    def update_user(self, user, items, codes, timestamps=None):
+        """
+        set the actions of a user and update the sums of the items whose code changed
+
+        :param user: user index
+        :param items: indices of the items rated by the user, empty to remove the user
+        :param codes: the codes of the actions on the items
+        :param timestamps: the times of the actions on the items, see DecayedPopularity
+        """
+        items = np.asarray(items, dtype=np.int64)
+        counted, values = self._values(np.asarray(codes, dtype=np.float64), timestamps)
+        new = dict(zip(items[counted].tolist(), values[counted].tolist()))
+        old = self.users.get(user, {})
+        for item in set(old) | set(new):
+            if old.get(item) != new.get(item):
+                self._change(item, old.get(item), new.get(item))
+        if new:
+            self.users[user] = new
+        else:
+            self.users.pop(user, None)
+
+    def insert_item(self, item):
+        """
+        :param item: index of an item inserted in the catalogue
+        """
+        self.catalogue.add(item)
+        self._move(item)
+
+    def remove_item(self, item):
+        """
+        :param item: index of an item removed from the catalogue, it is still listed if rated
+        """
+        self.catalogue.discard(item)
+        self._move(item)
+
+    def popular_items(self, n=None):
+        """
+        :param n: number of items, all the items if None
+        :return: numpy array with the indices of the n most popular items, rated items by decreasing sum
+            of the codes then the unrated items of the catalogue, ties by item index
+        """
+        if self.mapped is not None:
+            return self.mapped[:n]
+        keys = self.index.head(n)
+        return np.fromiter((key[2] for key in keys), dtype=np.int64, count=len(keys))
+
+
+class DecayedPopularity(Popularity):
+    """
+    Items sorted by decayed popularity, the sum of the codes of their actions each one decayed with its age
+    as in the DecayedCooccurrence of the items. Same interface and order of Popularity.
+
+    The decay is lazy: the action with code c at time t is summed as c * exp(rate * (t - t0)), with the
+    rate and the base time t0 of the co-occurrence, so the decayed sums are the stored ones times scale(),
+    the same factor for all the items: the order does not change with the time and an item is moved,
+    in O(log n), only when its own actions change. When the base time moves all the sums are rescaled by
+    the same factor and the order is kept. The actions pruned from the co-occurrence are not counted.
+    """
+
+    def __init__(self, cooccurrence):
+        """
+        :param cooccurrence: the DecayedCooccurrence of the items
+        """
+        self.cooccurrence = cooccurrence
+        Popularity.__init__(self)
+
+    def clear(self):
+        Popularity.clear(self)
+        self.t0 = self.cooccurrence.t0
+
+    def _values(self, codes, timestamps):
+        """
+        :param codes: numpy array with the codes of the actions
+        :param timestamps: numpy array with the times of the actions, if None the current time
+        :return: a tuple (counted, values), the actions older than the cutoff of the co-occurrence are
+            not counted
+        """
+        if timestamps is None:
+            timestamps = np.full(len(codes), time())
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = codes * np.exp(self.cooccurrence.rate * (timestamps - self.t0))
+        return timestamps >= self.cooccurrence.cutoff(), values
+
+    def _rebase(self):
+        """
+        rescale the sums after the base time of the co-occurrence moved
+        """
+        if self.t0 == self.cooccurrence.t0:
+            return
+        factor = exp(-self.cooccurrence.rate * (self.cooccurrence.t0 - self.t0))
+        for values in self.users.values():
+            for item in values:
+                values[item] *= factor
+        for item in self.sums:
+            self.sums[item] *= factor
+        # the order is the same, the keys are sorted again in case the rounding made some of them equal
+        self.keys = dict((item, self._key(item)) for item in self.keys)
+        self.index = SortedList(sorted(self.keys.values()))
+        self.t0 = self.cooccurrence.t0
+
+    def update_user(self, user, items, codes, timestamps=None):
+        """
+        see Popularity.update_user, the co-occurrence must have been updated first
+        """
+        self._rebase()
+        Popularity.update_user(self, user, items, codes, timestamps)
+
+    def prune(self):
+        """
+        remove the actions pruned from the co-occurrence, see DecayedCooccurrence.prune
+        """
+        self._rebase()
+        users_keys = self.cooccurrence.users_keys
+        for user, values in list(self.users.items()):
+            kept = users_keys.get(user, {})
+            for item in [item for item in values if item not in kept]:
+                self._change(item, values.pop(item), None)
+            if not values:
+                del self.users[user]
@@ -1,15 +1,64 @@
-import pandas as pd
 import numpy as np
 from time import time
 import logging
+import os
+import threading
 from csrec.tools.singleton import Singleton
+from csrec.tools.sparse import csr_from_arrays, csr_vector, csr_to_arrays, csr_from_buffers
+from csrec.tools import snapshot
+from csrec.tools.functions import llr_similarity
+from csrec.tools.minhash import minhash_similarity
+from csrec.exceptions import *
+from csrec.cooccurrence import Cooccurrence, DecayedCooccurrence
+from csrec.categories import ItemsCategories
+from csrec.popularity import Popularity, DecayedPopularity
+from csrec.model import Model, MODEL_VERSION
+from csrec.neighbours import Neighbours
+from csrec.refresher import ModelRefresher
 from csrec import factory_dal
 
 class Recommender(Singleton):
     """
     Cold Start Recommender
     """
-    def __init__(self, dal_name='mem', dal_params={}, max_rating=5, log_level=logging.INFO):
+    def __init__(self, dal_name='mem', dal_params={}, max_rating=5, log_level=logging.INFO,
+                 refresh_interval=None, refresh_actions=None, half_life=None, prune_threshold=0.01,
+                 similarity='cooccurrence', max_neighbours=50, min_llr=0.0, neighbours=None, min_support=1,
+                 minhash_size=128, lsh_bands=32):
+        """
+        :param dal_name: the name of the DAL implementation, see factory_dal
+        :param dal_params: the parameters of the DAL implementation
+        :param max_rating: the maximum rating
+        :param log_level: the logging level
+        :param refresh_interval: if not None, the model is rebuilt by a background thread every
+            refresh_interval seconds, see start_refresher
+        :param refresh_actions: if not None, the model is rebuilt by a background thread after
+            refresh_actions new actions, see start_refresher
+        :param half_life: if not None, the actions on items decay with their age: an action of half_life
+            seconds ago counts half in the co-occurrence of the items and in the popularity, see DecayedCooccurrence.
+            The co-occurrence of the categories does not decay
+        :param prune_threshold: with half_life, the actions and the co-occurrences whose decayed weight is
+            below prune_threshold are removed from the model when it is refreshed, 0 to keep them
+        :param similarity: 'cooccurrence' to score the items with the co-occurrence counts, 'llr' with the
+            log likelihood ratio of the counts, which is computed when the model is refreshed: only the
+            max_neighbours most significant neighbours of each item are kept, so the scoring reads short rows.
+            'minhash' with the jaccard similarity of the users of the items, estimated by MinHash only for the
+            pairs found by LSH, when the model is refreshed: the cost is nearly linear in the number of actions,
+            see minhash_similarity. The co-occurrence counts are not used to build the model
+        :param max_neighbours: with similarity 'llr' or 'minhash', the number of neighbours kept for each item,
+            all if None. With 'minhash' it is also the number of candidates of an item in each LSH bucket
+            (neighbours if not None), see minhash_similarity
+        :param min_llr: with similarity 'llr', the minimum log likelihood ratio of the neighbours,
+            e.g. 3.84 for a significance of 0.05
+        :param neighbours: if not None, the model keeps only the neighbours strongest neighbours of each item,
+            by co-occurrence or log likelihood ratio, as fixed-width arrays computed when the model is refreshed,
+            and a user is scored from the neighbours of the rated items only, see Neighbours
+        :param min_support: with neighbours, the minimum number of users who rated both items
+            for an item to be a neighbour of the other, estimated from the similarity with 'minhash'
+        :param minhash_size: with similarity 'minhash', the number of hash functions of the signatures
+        :param lsh_bands: with similarity 'minhash', the number of LSH bands, it must divide minhash_size.
+            More bands find more pairs with a low similarity, and cost more
+        """
         # Logger initialization
         self.logger = logging.getLogger("csrc")
         self.logger.setLevel(log_level)
@@ -24,74 +73,649 @@ class Recommender(Singleton):
         # registering callback functions for datastore events
         self.db.register(self.db.serialize, self.on_serialize)
         self.db.register(self.db.restore, self.on_restore)
+        self.db.register(self.db.reset, self.on_reset)
+        self.db.register(self.db.insert_item, self.on_insert_item)
+        self.db.register(self.db.remove_item, self.on_remove_item)
+        self.db.register(self.db.insert_items_bulk, self.on_insert_items_bulk)
+
+        # the co-occurrence matrices are updated on each change of the users' ratings
+        self.db.register(self.db.insert_item_action, self.on_insert_item_action)
+        self.db.register(self.db.insert_item_actions_bulk, self.on_insert_item_actions_bulk)
+        self.db.register(self.db.remove_item_action, self.on_remove_item_action)
+        self.db.register(self.db.remove_user, self.on_remove_user)
+        self.db.register(self.db.reconcile_user, self.on_reconcile_user)
 
         # Algorithm's specific attributes
-        self._items_cooccurrence = pd.DataFrame  # cooccurrence of items
+        if similarity not in ('cooccurrence', 'llr', 'minhash'):
+            raise BadParametersException("unsupported similarity %s, expected cooccurrence, llr or minhash"
+                                         % similarity)
+        if lsh_bands <= 0 or minhash_size % lsh_bands:
+            raise BadParametersException("lsh_bands %s must divide minhash_size %s" % (lsh_bands, minhash_size))
+        self.similarity = similarity
+        self.max_neighbours = max_neighbours
+        self.min_llr = min_llr
+        self.neighbours = neighbours
+        self.min_support = min_support
+        self.minhash_size = minhash_size
+        self.lsh_bands = lsh_bands
+        self.half_life = half_life
+        self.prune_threshold = prune_threshold
+        self._lock = threading.RLock()  # guards the lazy creation of the categories' structures by readers
+        self._items_cooccurrence = self._new_items_cooccurrence()  # cooccurrence of items
+        self._items_popularity = self._new_items_popularity()  # items sorted by popularity
         self.cooccurrence_updated = 0.0
         # Info in item_meaningful_info with whom some user has actually interacted
-        self._categories_cooccurrence = {}  # cooccurrence of categories
+        self._categories_cooccurrence = {}  # cooccurrence of categories: {info: Cooccurrence}
+        self._items_categories = {}  # values of the categories of each item: {info: ItemsCategories}
 
-        # categories --same as above, but separated as they are not always available
-        self.items_by_popularity = []  # can be recomputed on_restore
+        # read-only snapshot of co-occurrence matrices and popularity, replaced on each refresh
+        self._model = Model()
+        self._refresher = None
         self.last_serialization_time = 0.0  # Time of data backup
         # configurations:
         self.max_rating = max_rating
 
-    def on_serialize(self, filepath, return_value):
+        # datastores on disk, e.g. sqlite, can already hold the data
+        if self.db.get_user_count():
+            self._create_cooccurrence()
+            self.refresh_model()
+        elif self.db.get_items_count():
+            self._build_popularity()
+
+        if refresh_interval is not None or refresh_actions is not None:
+            self.start_refresher(interval=refresh_interval, n_actions=refresh_actions)
+
+    @property
+    def items_by_popularity(self):
+        """
+        list of item ids sorted by popularity, from the current model
+        """
+        return self._model.items_by_popularity
+
+    def start_refresher(self, interval=1800.0, n_actions=None):
+        """
+        Start a background thread which rebuilds the model every interval seconds or after n_actions
+        new actions. While the thread is running the requests never rebuild the model, they use
+        the last one built.
+        :param interval: seconds between two refreshes, None to refresh only after n_actions
+        :param n_actions: number of new actions which trigger a refresh, None to refresh only on interval
+        :return: None
+        """
+        self.stop_refresher()
+        self.refresh_model()
+        self._refresher = ModelRefresher(self, interval=interval, n_actions=n_actions)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """
+        Stop the background refresher, if any. Afterwards the model is rebuilt on requests.
+        :return: None
+        """
+        if self._refresher is not None:
+            self._refresher.stop()
+            self._refresher = None
+
+    @staticmethod
+    def model_path(filepath):
+        """
+        :param filepath: the path of a file with the data of the datastore
+        :return: the path of the file with the model saved along with the data
+        """
+        return filepath + '.model'
+
+    def on_serialize(self, filepath, return_value, generation=None, **kwargs):
         if return_value is None or return_value:
             self.last_serialization_time = time()
+            # the data written by serialize_background is older than the model if it changed in the meantime
+            if generation is not None and generation != self.db.lock.generation:
+                self.logger.info("[on_serialize] the data changed while written on file %s, model not saved",
+                                 filepath)
+                return
+            self.save_model(self.model_path(filepath), data_filepath=filepath)
         else:
             self.logger.error("[on_serialize] data backup failed on file %s, last successful backup at: %f" %
                               (filepath,
                                self.last_serialization_time))
 
-    def on_restore(self, filepath, return_value):
+    def on_restore(self, filepath, return_value, mmap=False, **kwargs):
         if return_value is not None and not return_value:
-            self.logger.error("[on_restore] restore from serialized data fail: ", filepath)
+            self.logger.error("[on_restore] restore from serialized data fail: %s", filepath)
         else:
+            # the model saved with the data is used if the data has not been changed since
+            path = self.model_path(filepath)
+            if os.path.exists(path):
+                try:
+                    self.load_model(path, data_filepath=filepath, mmap=mmap)
+                    return
+                except (snapshot.SnapshotError, RestoreException) as e:
+                    self.logger.warning("[on_restore] model not loaded from %s: %s", path, e)
             self._create_cooccurrence()
+            self.refresh_model()
+
+    def on_reset(self, return_value):
+        with self.db.lock.writer():
+            self._items_cooccurrence.clear()
+            self._items_popularity.clear()
+            self._categories_cooccurrence = {}
+            self._items_categories = {}
+            self._model = Model()
+            self.cooccurrence_updated = time()
+
+    def on_insert_item(self, item_id, return_value, **kwargs):
+        item = self.db.get_items(item_id=item_id).get(item_id) or {}
+        with self.db.lock.writer():
+            self._popularity_index().insert_item(self.db.get_items_map().intern(item_id))
+            for info, items_categories in self._items_categories.items():
+                items_categories.set_item(item_id, item.get(info))
+
+    def on_insert_items_bulk(self, items, return_value):
+        with self.db.lock.writer():
+            popularity = self._popularity_index()
+            for item in self.db.get_items_map().intern_many(return_value):
+                popularity.insert_item(item)
+            for info, items_categories in self._items_categories.items():
+                for item_id in return_value:
+                    item = self.db.get_items(item_id=item_id).get(item_id) or {}
+                    items_categories.set_item(item_id, item.get(info))
+
+    def on_remove_item(self, item_id, return_value):
+        with self.db.lock.writer():
+            if item_id is None:
+                self._items_categories = {}
+                self._build_popularity()
+            else:
+                item = self.db.get_items_map().index(item_id)
+                if item is not None:
+                    self._popularity_index().remove_item(item)
+                for items_categories in self._items_categories.values():
+                    items_categories.remove_item(item_id)
+
+    def on_insert_item_action(self, user_id, return_value, **kwargs):
+        self._update_user_cooccurrence(user_id)
+
+    def on_insert_item_actions_bulk(self, actions, return_value, **kwargs):
+        users, timestamps = return_value
+        # when most of the users have new actions a full rebuild is cheaper than the updates of each user
+        if len(users) > len(self.db.get_users_map()) / 2:
+            self._create_cooccurrence()
+        else:
+            for user_id in users:
+                self._update_user_cooccurrence(user_id, n_actions=0)
+        # the refresher counts the actions inserted, one timestamp each
+        if self._refresher is not None:
+            self._refresher.notify_action(len(timestamps))
+
+    def on_remove_item_action(self, user_id, return_value, **kwargs):
+        self._update_user_cooccurrence(user_id)
+
+    def on_remove_user(self, user_id, return_value):
+        self._update_user_cooccurrence(user_id)
+
+    def on_reconcile_user(self, old_user_id, new_user_id, return_value):
+        self._update_user_cooccurrence(old_user_id)
+        self._update_user_cooccurrence(new_user_id)
+
+    def _new_items_cooccurrence(self):
+        """
+        :return: an empty co-occurrence of the items, decayed if half_life is set
+        """
+        if self.half_life is None:
+            return Cooccurrence(self.db.get_items_map())
+        return DecayedCooccurrence(self.db.get_items_map(), half_life=self.half_life, threshold=self.prune_threshold)
+
+    def _new_items_popularity(self):
+        """
+        :return: an empty popularity index of the items, decayed as the co-occurrence if half_life is set
+        """
+        if self.half_life is None:
+            return Popularity()
+        return DecayedPopularity(self._items_cooccurrence)
+
+    def _update_user_cooccurrence(self, user_id, n_actions=1):
+        """
+        Update the co-occurrence matrices with the current ratings of a user, only the rows and
+        the columns of the items (and categories' values) added or removed are changed
+        :param user_id: the user id
+        :param n_actions: number of actions notified to the background refresher, e.g. 0 if the caller does
+        :return:
+        """
+        user = self.db.get_user_index(user_id)
+        if user is None:
+            return
+        with self.db.lock.writer():
+            if self.half_life is None:
+                _, items, codes = self.db.get_item_actions_arrays(user_id=user_id)
+                timestamps = None
+            else:
+                _, items, codes, timestamps = self.db.get_item_actions_arrays(user_id=user_id, timestamps=True)
+            self._items_cooccurrence.update_user(user, items, timestamps)
+            self._popularity_index().update_user(user, items, codes, timestamps)
+
+            for i in self.db.get_info_used():
+                _, values, _, _ = self.db.get_categories_user_ratings_arrays(i, user_id=user_id)
+                self._get_categories_cooccurrence(i).update_user(user, values)
+            self.cooccurrence_updated = time()
+        if self._refresher is not None and n_actions:
+            self._refresher.notify_action(n_actions)
+
+    def _get_categories_cooccurrence(self, info):
+        try:
+            return self._categories_cooccurrence[info]
+        except KeyError:
+            with self._lock:
+                cooccurrence = Cooccurrence(self.db.get_category_values_map(info))
+                return self._categories_cooccurrence.setdefault(info, cooccurrence)
+
+    def _get_items_categories(self, info):
+        """
+        get the index item -> values of a category, created from the items on first use and
+        then kept updated by the datastore events
+        :param info: the category e.g. "author"
+        :return: an ItemsCategories instance
+        """
+        try:
+            return self._items_categories[info]
+        except KeyError:
+            with self._lock:
+                items_categories = ItemsCategories(self.db.get_items_map(), self.db.get_category_values_map(info))
+                for item_id, item in self.db.get_items_iterator():
+                    items_categories.set_item(item_id, (item or {}).get(info))
+                return self._items_categories.setdefault(info, items_categories)
 
     def _create_cooccurrence(self):
         """
-        Create or update the co-occurrence matrix
+        Create the co-occurrence matrices from scratch, e.g. after the datastore has been restored.
+        Afterwards the matrices are kept updated by the datastore events.
         :return:
         """
-        all_ratings = self.db.get_item_actions()
-        df = pd.DataFrame(all_ratings).fillna(0).astype(int)  # convert dictionary to pandas dataframe
+        with self.db.lock.writer():
+            n_users = len(self.db.get_users_map())
+            items = self.db.get_items_map()
+            actions = self.db.get_item_actions_arrays(timestamps=self.half_life is not None)
+            users, rated_items, values = actions[:3]
+            if self.half_life is not None:  # the decayed co-occurrence is computed from the times of the actions
+                values = actions[3]
+            self._items_cooccurrence = self._new_items_cooccurrence()
+            self._items_cooccurrence.load(csr_from_arrays([users], [rated_items], [values], (n_users, len(items))))
 
-        # calculate co-occurrence matrix
-        # sometime will print the warning: "RuntimeWarning: invalid value encountered in true_divide"
-        # use np.seterr(divide='ignore', invalid='ignore') to suppress this warning
-        df_items = (df / df).replace(np.inf, 0).replace(np.nan, 0)  # calculate co-occurrence matrix and normalize to 1
-        co_occurrence = df_items.fillna(0).dot(df_items.T)
-        self._items_cooccurrence = co_occurrence
+            self._categories_cooccurrence = {}
+            self._items_categories = {}
+            for i in self.db.get_info_used():
+                users, values, _, n = self.db.get_categories_user_ratings_arrays(i)
+                cooccurrence = self._get_categories_cooccurrence(i)
+                cooccurrence.load(csr_from_arrays([users], [values], [n], (n_users, len(cooccurrence.keys))))
 
-        # update co-occurrence matrix for items categories
-        df_n_cat_item = {}
+            self._build_popularity(actions)
+            self.cooccurrence_updated = time()
 
-        info_used = self.db.get_info_used()
-        if len(info_used) > 0:
-            n_categories_item_ratings = self.db.get_n_categories_item_ratings()
-            for i in info_used:
-                df_n_cat_item[i] = pd.DataFrame(n_categories_item_ratings.get(i)).fillna(0).astype(int)
+    def _build_popularity(self, actions=None):
+        """
+        Build the popularity index from scratch, from the codes of the actions and the items of the catalogue.
+        Afterwards it is kept updated by the datastore events.
+        :param actions: the arrays of get_item_actions_arrays, with the timestamps if half_life is set,
+            read from the datastore if None
+        :return:
+        """
+        with self.db.lock.writer():
+            if actions is None:
+                actions = self.db.get_item_actions_arrays(timestamps=self.half_life is not None)
+            users, rated_items, codes = actions[:3]
+            items = self.db.get_items_map()
+            # the ids of the items only, the attributes restored from a snapshot are decoded when read
+            catalogue = items.intern_many(self.db.get_items())
+            self._items_popularity = self._new_items_popularity()
+            self._items_popularity.build(users, rated_items, codes, catalogue,
+                                         timestamps=actions[3] if self.half_life is not None else None)
 
-            for i in info_used:
-                if type(df_n_cat_item.get(i)) == pd.DataFrame:
-                    df_n_cat_item[i] = (df_n_cat_item[i] / df_n_cat_item[i]).replace(np.nan, 0)
-                    self._categories_cooccurrence[i] = df_n_cat_item[i].T.dot(df_n_cat_item[i])
+    def _popularity_index(self):
+        """
+        :return: the popularity index to be updated, built from the datastore if it holds the order saved with
+            the model (see load_model), as the codes of the users are needed to update it
+        """
+        if self._items_popularity.mapped is not None:
+            self._build_popularity()
+        return self._items_popularity
 
-        self.cooccurrence_updated = time()
+    def save_model(self, filepath, data_filepath=None):
+        """
+        Save the model (co-occurrence matrices, keys of each user, values of the categories of each item and
+        items by popularity) in a snapshot file, it is saved automatically by serialize in the file
+        model_path(filepath)
+        :param filepath: the path of the file
+        :param data_filepath: the path of the file with the data the model has been computed from,
+            its fingerprint is saved with the model
+        :return:
+        """
+        with self.db.lock.reader():
+            n_users = len(self.db.get_users_map())
+            categories = sorted(self._categories_cooccurrence)
+            cooccurrences = [('items', self._items_cooccurrence)]
+            cooccurrences += [('categories.%d' % n, self._categories_cooccurrence[info])
+                              for n, info in enumerate(categories)]
+            arrays = {}
+            for name, cooccurrence in cooccurrences:
+                for matrix_name, matrix in (('cooccurrence', cooccurrence.tocsr()),
+                                            ('users', cooccurrence.users_matrix(n_users))):
+                    for array_name, array in csr_to_arrays(matrix).items():
+                        arrays['%s.%s.%s' % (name, matrix_name, array_name)] = array
+            # the values of the categories of the items, instead of reading all the items after a restore
+            n_items = len(self.db.get_items_map())
+            for n, info in enumerate(categories):
+                arrays['categories.%d.items' % n] = self._get_items_categories(info).index[:n_items]
+            arrays['popular_items'] = self._popularity()
+            metadata = {'version': MODEL_VERSION, 'n_users': n_users, 'categories': categories,
+                        'generation': self.db.lock.generation, 'decay': self._decay(),
+                        'n_keys': dict((name, len(cooccurrence.keys)) for name, cooccurrence in cooccurrences),
+                        'data': snapshot.fingerprint(data_filepath) if data_filepath is not None else None}
+        snapshot.write_snapshot(filepath, arrays, metadata)
+
+    def _decay(self):
+        """
+        :return: the parameters of the decay of the co-occurrence of the items, saved with the model
+        """
+        if self.half_life is None:
+            return None
+        return {'half_life': self.half_life, 't0': self._items_cooccurrence.t0}
+
+    def load_model(self, filepath, data_filepath=None, mmap=False):
+        """
+        Load a model saved by save_model instead of computing it, it is loaded automatically by restore
+        from the file model_path(filepath). With mmap the processes which map the same file share its pages.
+        The dictionaries of the incremental updates of the co-occurrence matrices are built on the first update.
+        exception: raise a RestoreException if the model does not match the datastore
+        :param filepath: the path of the file
+        :param data_filepath: the path of the file with the data in the datastore, the model is not loaded
+            if it has been computed from different data
+        :param mmap: memory map the arrays of the model instead of reading them
+        :return:
+        """
+        metadata, arrays = snapshot.read_snapshot(filepath, mmap=mmap, verify=not mmap)
+        if metadata.get('version') != MODEL_VERSION:
+            raise RestoreException("unsupported model version %s" % metadata.get('version'))
+        if data_filepath is not None and metadata.get('data') != snapshot.fingerprint(data_filepath):
+            raise RestoreException("the model has been computed from different data")
+        decay = metadata.get('decay')
+        if (decay and decay['half_life']) != self.half_life:
+            raise RestoreException("the model has been computed with half life %s" % (decay and decay['half_life']))
+
+        def matrix(name):
+            prefix = name + '.'
+            return csr_from_buffers(dict((k[len(prefix):], a) for k, a in arrays.items() if k.startswith(prefix)))
+
+        with self.db.lock.writer():
+            categories = metadata['categories']
+            items = self.db.get_items_map()
+            if metadata['n_users'] != len(self.db.get_users_map()) or \
+                    metadata['n_keys']['items'] != len(items) or \
+                    not set(self.db.get_info_used()) <= set(categories):
+                raise RestoreException("the model does not match the datastore")
+            # e.g. the data has been written by serialize_background and the model after other changes
+            if data_filepath is not None and metadata.get('generation') != self.db.lock.generation:
+                raise RestoreException("the model has been computed from different data")
+            for n, info in enumerate(categories):
+                if metadata['n_keys']['categories.%d' % n] != len(self.db.get_category_values_map(info)):
+                    raise RestoreException("the model does not match the datastore")
+
+            self._items_cooccurrence = self._new_items_cooccurrence()
+            if decay:
+                self._items_cooccurrence.map(matrix('items.cooccurrence'), matrix('items.users'), t0=decay['t0'])
+            else:
+                self._items_cooccurrence.map(matrix('items.cooccurrence'), matrix('items.users'))
+            self._categories_cooccurrence = {}
+            self._items_categories = {}
+            for n, info in enumerate(categories):
+                cooccurrence = self._get_categories_cooccurrence(info)
+                cooccurrence.map(matrix('categories.%d.cooccurrence' % n), matrix('categories.%d.users' % n))
+                # models saved by older versions do not hold them, they are read from the items on first use
+                if 'categories.%d.items' % n in arrays:
+                    items_categories = ItemsCategories(items, self.db.get_category_values_map(info))
+                    items_categories.index = arrays['categories.%d.items' % n]
+                    self._items_categories[info] = items_categories
+            # the popularity is built from the datastore on the first change
+            self._items_popularity = self._new_items_popularity()
+            self._items_popularity.map(arrays['popular_items'])
+            self.cooccurrence_updated = time()
+
+            items_cooccurrence, neighbours = self._items_model()
+            self._model = Model(items_cooccurrence,
+                                dict((info, c.tocsr()) for info, c in self._categories_cooccurrence.items()),
+                                popular_items=arrays['popular_items'], items=items, neighbours=neighbours)
+
+    def _items_model(self):
+        """
+        :return: a tuple (matrix, neighbours): the matrix of the model which scores the items as CSR, i.e.
+            the co-occurrence, with the decayed counts as of now if decayed, or the log likelihood ratio
+            of the co-occurrence, or the estimated jaccard similarity of the users, and its Neighbours
+            if the neighbourhood is pruned, None otherwise.
+            The support of the neighbours is the co-occurrence, decayed if half_life is set
+        """
+        # with neighbours the strongest ones are selected after the filter on the support
+        max_neighbours = self.max_neighbours if self.neighbours is None else None
+        if self.similarity == 'minhash':
+            return self._minhash_model(max_neighbours)
+        counts = self._items_cooccurrence.tocsr()
+        scale = self._items_cooccurrence.scale()
+        if scale != 1.0:
+            counts = counts * scale
+        matrix = counts
+        if self.similarity == 'llr':
+            matrix = llr_similarity(counts, self.db.get_user_count(), max_neighbours=max_neighbours,
+                                    min_llr=self.min_llr)
+        if self.neighbours is None:
+            return matrix, None
+        neighbours = Neighbours.from_matrix(matrix, self.neighbours, support=counts, min_support=self.min_support)
+        return neighbours.tocsr(), neighbours
+
+    def _minhash_model(self, max_neighbours):
+        """
+        see _items_model, the similarity is estimated from the users of the items and the support
+        of the neighbours from the similarity
+        """
+        # with half_life the actions pruned from the co-occurrence are not used, the weights are ignored
+        users = self._items_cooccurrence.users_matrix(len(self.db.get_users_map()))
+        # each item gets at most as many candidates from a group of identical items or from an LSH bucket
+        # as the neighbours it keeps, so a large group does not cost its size squared
+        max_candidates = self.max_neighbours if self.neighbours is None else self.neighbours
+        matrix = minhash_similarity(users.T, n_hashes=self.minhash_size, bands=self.lsh_bands,
+                                    max_neighbours=max_neighbours, max_candidates=max_candidates)
+        if self.neighbours is None:
+            return matrix, None
+        # users of both items from the jaccard similarity J: |A & B| = J * (|A| + |B|) / (1 + J)
+        n_users = np.bincount(users.indices, minlength=matrix.shape[0])
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        support = matrix.copy()
+        support.data = matrix.data * (n_users[rows] + n_users[matrix.indices]) / (1.0 + matrix.data)
+        neighbours = Neighbours.from_matrix(matrix, self.neighbours, support=support, min_support=self.min_support)
+        return neighbours.tocsr(), neighbours
+
+    def _popularity(self):
+        """
+        :return: numpy array with the indices of the items sorted by popularity
+        """
+        return self._items_popularity.popular_items()
 
     def compute_items_by_popularity(self):
         """
-        As per name, get self.items_by_popularity
+        As per name, get self.items_by_popularity: the current model gets the popularity of the index
         :return: None
         """
-        df_item = pd.DataFrame(self.db.get_item_actions()).T.fillna(0).astype(int).sum()
-        df_item.sort_values(inplace=True, ascending=False)
-        pop_items = list(df_item.index)
-        all_items = set(self.db.get_items().keys())
-        self.items_by_popularity = (pop_items + list(all_items - set(pop_items)))
+        with self.db.lock.reader():
+            popular_items = self._popularity()
+        self._model = self._model.with_popularity(popular_items, self.db.get_items_map())
+
+    def get_popular_items(self, max_items=None):
+        """
+        The most popular items, read from the popularity index which is updated on each action:
+        rated items by decreasing sum of the codes of their actions, then the items never rated
+        :param max_items: number of items to be returned, all the items if None
+        :return: list of item ids
+        """
+        with self.db.lock.reader():
+            items = self.db.get_items_map()
+            return [items.key(i) for i in self._items_popularity.popular_items(max_items).tolist()]
+
+    def refresh_model(self):
+        """
+        Build a new snapshot of the model (co-occurrence matrices as CSR and items by popularity) and
+        swap it in with a single assignment: requests running in other threads keep using the previous one.
+        If other processes sharing the datastore changed the data, the co-occurrence matrices and the
+        popularity are built again from the datastore first
+        :return: the new model
+        """
+        if self.db.synchronize():
+            self._create_cooccurrence()
+        if self.half_life is not None:
+            # the model is kept bounded to the recent actions
+            with self.db.lock.writer():
+                self._items_cooccurrence.prune()
+                self._popularity_index().prune()
+        with self.db.lock.reader():
+            items_cooccurrence, neighbours = self._items_model()
+            categories_cooccurrence = dict((info, cooccurrence.tocsr())
+                                           for info, cooccurrence in self._categories_cooccurrence.items())
+            popular_items = self._popularity()
+        self._model = Model(items_cooccurrence, categories_cooccurrence, popular_items=popular_items,
+                            items=self.db.get_items_map(), neighbours=neighbours)
+        self.logger.debug("[refresh_model] model refreshed")
+        return self._model
+
+    @staticmethod
+    def _add_popular_items(candidates, scores, rated, max_recs, popular_items, max_rating):
+        """
+        If there are less than max_recs candidates, add the most popular items not already rated or
+        recommended, supposing score goes down according to Zipf distribution starting from the lowest
+        score of the candidates, or from max_rating if there are no candidates
+        :param candidates: array with the indices of the recommended items
+        :param scores: array with the scores of the candidates
+        :param rated: array with the indices of the items rated by the user
+        :param max_recs: number of recommended items to be returned
+        :param popular_items: array with the indices of the items sorted by popularity
+        :param max_rating: the maximum rating
+        :return: the candidates and their scores, with the popular items appended
+        """
+        n_candidates = len(candidates)
+        if n_candidates >= max_recs:
+            return candidates, scores
+        excluded = np.concatenate((rated, candidates))
+        head = popular_items[:max_recs + len(excluded)]
+        fill = head[~np.isin(head, excluded)][:max_recs - n_candidates]
+        if n_candidates:
+            fill_scores = scores.min() * n_candidates / (n_candidates + np.arange(1., len(fill) + 1))
+        else:
+            fill_scores = max_rating / np.arange(1., len(fill) + 1)
+        return np.concatenate((candidates, fill)), np.concatenate((scores, fill_scores))
+
+    @staticmethod
+    def _top_items(scores, k):
+        """
+        partial selection of the k highest scores, only the selected ones are sorted
+        :param scores: numpy array with the scores
+        :param k: number of elements to be selected
+        :return: the positions of the k highest scores in decreasing order of score
+        """
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if len(scores) > k:
+            # k-th highest score, ties on it are taken in order of position
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            above = np.flatnonzero(scores > threshold)
+            top = np.concatenate((above, np.flatnonzero(scores == threshold)[:k - len(above)]))
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind='mergesort')]
+
+    def _users_ratings_matrix(self, user_ids):
+        """
+        :param user_ids: list of user ids
+        :return: CSR matrix users x items with the ratings of the users, one row for each user id
+        """
+        rows, rated_items, codes = [], [], []
+        for n, user_id in enumerate(user_ids):
+            _, user_items, user_codes = self.db.get_item_actions_arrays(user_id=user_id)
+            rows.append(np.full(len(user_items), n, dtype=np.int32))
+            rated_items.append(user_items)
+            codes.append(user_codes)
+        return csr_from_arrays(rows, rated_items, codes, (len(user_ids), len(self.db.get_items_map())))
+
+    def _users_categories_matrix(self, user_ids, info):
+        """
+        :param user_ids: list of user ids
+        :param info: the category e.g. "author"
+        :return: CSR matrix users x values with the average rating of the users on each value of the category
+        """
+        rows, values, average = [], [], []
+        for n, user_id in enumerate(user_ids):
+            _, user_values, tot, n_ratings = self.db.get_categories_user_ratings_arrays(info, user_id=user_id)
+            rows.append(np.full(len(user_values), n, dtype=np.int32))
+            values.append(user_values)
+            average.append(tot / n_ratings)
+        return csr_from_arrays(rows, values, average, (len(user_ids), len(self.db.get_category_values_map(info))))
+
+    def get_recommendations_bulk(self, user_ids, max_recs=50, fast=False, block_size=1000):
+        """
+        Compute the recommendations for many users at once, same algorithm of get_recommendations:
+        the scores of a block of users are computed as the product of their ratings matrix
+        with the co-occurrence matrix, and the same for categories.
+        :param user_ids: list of user ids
+        :param max_recs: number of recommended items to be returned for each user
+        :param fast: Do not rebuild the model (co-occurrence matrices and popularity) if already available.
+            The model is never rebuilt by this call when the background refresher is running.
+        :param block_size: number of users scored with a single matrix product
+        :return: a dictionary with the list of recommended items for each user: {user_id: [item, ...]}
+        """
+        start_time = time()
+        user_ids = list(user_ids)
+        if self._refresher is None and (not fast or len(self._model.popular_items) == 0):
+            self.refresh_model()
+        model = self._model
+        items = self.db.get_items_map()
+        cooccurrence = model.items_cooccurrence
+        n_items = cooccurrence.shape[0]  # items inserted after the model was built are not scored
+
+        info_used = [i for i in self.db.get_info_used() if i in model.categories_cooccurrence]
+        categories_cooccurrence = model.categories_cooccurrence
+
+        recommendations = {}
+        for block_start in range(0, len(user_ids), block_size):
+            block = user_ids[block_start:block_start + block_size]
+            with self.db.lock.reader():
+                ratings = self._users_ratings_matrix(block)
+                scores = ratings[:, :n_items].dot(cooccurrence).tocsr()
+                scores.sort_indices()
+                categories_scores = {}
+                for info in info_used:
+                    users_categories = self._users_categories_matrix(block, info)
+                    cooccurrence_info = categories_cooccurrence[info]
+                    users_categories = users_categories[:, :cooccurrence_info.shape[0]]
+                    categories_scores[info] = users_categories.dot(cooccurrence_info).tocsr()
+
+                for n, user_id in enumerate(block):
+                    rated = ratings.indices[ratings.indptr[n]:ratings.indptr[n + 1]]
+                    row = slice(scores.indptr[n], scores.indptr[n + 1])
+                    candidates = scores.indices[row]
+                    candidates_scores = scores.data[row]
+                    keep = (candidates_scores != 0) & ~np.isin(candidates, rated)
+                    candidates, candidates_scores = candidates[keep], candidates_scores[keep]
+
+                    # If necessary, add popular items
+                    candidates, candidates_scores = self._add_popular_items(candidates, candidates_scores,
+                                                                            rated, max_recs, model.popular_items,
+                                                                            self.max_rating)
+
+                    # Recommended items receive a further score according to categories
+                    for info in info_used:
+                        values_scores = categories_scores[info].getrow(n)
+                        if values_scores.nnz:
+                            candidates_scores = candidates_scores + self._get_items_categories(info).scores(
+                                candidates, values_scores.toarray().ravel())
+
+                    top = self._top_items(candidates_scores, max_recs)
+                    recommendations[user_id] = [items.key(i) for i in candidates[top]]
+
+        elapsed = time() - start_time
+        self.logger.info("[get_recommendations_bulk] %d users in %.3fs (%.1f users/s)",
+                         len(user_ids), elapsed, len(user_ids) / elapsed if elapsed > 0 else float('inf'))
+        return recommendations
 
     def get_recommendations(self, user_id, max_recs=50, fast=False, algorithm='item_based'):
         """
@@ -105,126 +729,74 @@ class Recommender(Singleton):
             - Recommended items above receive a further score according to categories
         :param user_id: the user id as in the collection of 'users'
         :param max_recs: number of recommended items to be returned
-        :param fast: Compute the co-occurrence matrix only if it is one hour old or
-                     if matrix and user vector have different dimension
+        :param fast: Use the popularity of the current model, if already available, instead of the
+                     popularity index updated on each action. The co-occurrence matrices are always
+                     up to date. The model is always used when the background refresher is running.
+                     With similarity 'llr' or neighbours the items are scored by the model, which is rebuilt
+                     if the co-occurrence changed since, unless fast or the background refresher is running.
         :return: list of recommended items
         """
-        user_id = str(user_id).replace('.', '')
-        df_tot_cat_user = {}
-        df_n_cat_user = {}
-        rec = pd.Series()
-        user_has_rated_items = False  # has user rated some items?
-        rated_infos = []  # user has rated the category (e.g. the category "author" etc)
-        df_user = None
-        if self.db.get_item_actions(user_id=user_id):  # compute item-based rec only if user has rated smt
-            user_has_rated_items = True
-            # Just take user_id for the user vector
-            df_user = pd.DataFrame(self.db.get_item_actions()).fillna(0).astype(int)[[user_id]]
-        info_used = self.db.get_info_used()
-        if len(info_used) > 0:
-            tot_categories_user_ratings = self.db.get_tot_categories_user_ratings()
-            n_categories_user_ratings = self.db.get_n_categories_user_ratings()
+        model_scored = self.similarity != 'cooccurrence' or self.neighbours is not None
+        if model_scored and self._refresher is None:
+            stale = self._model.created <= self.cooccurrence_updated
+            if len(self._model.popular_items) == 0 or (stale and not fast):
+                self.refresh_model()
+        # the datastore and the co-occurrence matrices are not updated while the user is scored
+        with self.db.lock.reader():
+            items = self.db.get_items_map()
+            cat_user = {}
+            rated_infos = []  # user has rated the category (e.g. the category "author" etc)
+
+            # only the actions of the user are read from the datastore
+            _, rated_items, codes = self.db.get_item_actions_arrays(user_id=user_id)
+            user_ratings = csr_vector(rated_items, codes, len(items))
+            info_used = self.db.get_info_used()
             for i in info_used:
-                if i in tot_categories_user_ratings and user_id in tot_categories_user_ratings[i]:
+                _, values, tot, n = self.db.get_categories_user_ratings_arrays(i, user_id=user_id)
+                if len(values) > 0:
                     rated_infos.append(i)
-                    df_tot_cat_user[i] =\
-                        pd.DataFrame(tot_categories_user_ratings.get(i)).fillna(0).astype(int)[[user_id]]
-                    df_n_cat_user[i] =\
-                        pd.DataFrame(n_categories_user_ratings.get(i)).fillna(0).astype(int)[[user_id]]
-
-        if user_has_rated_items:
-            if not fast or (time() - self.cooccurrence_updated > 1800):
-                self._create_cooccurrence()
-            try:
-                # this might fail if the cooccurrence was not updated (fast)
-                # and the user rated a new item.
-                # In this case the matrix and the user-vector have different
-                # dimension
-                # print("DEBUG [get_recommendations] Trying cooccurrence dot df_user")
-                # print("DEBUG [get_recommendations] _items_cooccurrence: %s", self._items_cooccurrence)
-                # print("DEBUG [get_recommendations] df_user: %s", df_user)
-                rec = self._items_cooccurrence.T.dot(df_user[user_id])
-                # self.logger.debug("[get_recommendations] Rec worked: %s", rec)
-            except:
-                self.logger.debug("[get_recommendations] 1st rec production failed, calling _create_cooccurrence.")
-                self._create_cooccurrence()
-                rec = self._items_cooccurrence.T.dot(df_user[user_id])
-                self.logger.debug("[get_recommendations] Rec: %s", rec)
-            # Sort by cooccurrence * rating:
-            rec.sort_values(inplace=True, ascending=False)
-
-            # If necessary, add popular items
-            if len(rec) < max_recs:
-                if not fast or len(self.items_by_popularity) == 0:
-                    self.compute_items_by_popularity()
-                for v in self.items_by_popularity:
-                    if len(rec) == max_recs:
-                        break
-                    elif v not in rec.index:
-                        n = len(rec)
-                        # supposing score goes down according to Zipf distribution
-                        rec.set_value(v, rec.values[n - 1]*n/(n+1.))
+                    # average rating on categories
+                    cat_user[i] = csr_vector(values, tot / n, len(self.db.get_category_values_map(i)))
 
-        else:
-            if not fast or len(self.items_by_popularity) == 0:
-                self.compute_items_by_popularity()
-            for i, v in enumerate(self.items_by_popularity):
-                if len(rec) == max_recs:
-                    break
-                rec.set_value(v, self.max_rating / (i+1.))  # As comment above, starting from max_rating
-#        print("DEBUG [get_recommendations] Rec after item_based or not: %s", rec)
-
-        # Now, the worse case we have is the user has not rated, then rec=popular with score starting from max_rating
-        # and going down as 1/i
-
-        # User info on rated categories (in info_used)
-        global_rec = rec.copy()
-        if len(info_used) > 0:
-            cat_rec = {}
-            if not fast or (time() - self.cooccurrence_updated > 1800):
-                self._create_cooccurrence()
-            for cat in rated_infos:
-                # get average rating on categories
-                user_vec = df_tot_cat_user[cat][user_id] / df_n_cat_user[cat][user_id].replace(0, 1)
-                # print("DEBUG [get_recommendations]. user_vec:\n", user_vec)
-                try:
-                    cat_rec[cat] = self._categories_cooccurrence[cat].T.dot(user_vec)
-                    cat_rec[cat].sort_values(inplace=True, ascending=False)
-                    #print("DEBUG [get_recommendations] cat_rec (try):\n %s", cat_rec)
-                except:
-                    self._create_cooccurrence()
-                    cat_rec[cat] = self._categories_cooccurrence[cat].T.dot(user_vec)
-                    cat_rec[cat].sort(ascending=False)
-                    #print("DEBUG [get_recommendations] cat_rec (except):\n %s", cat_rec)
-                for item_id, score in rec.items():
-                    #print("DEBUG [get_recommendations] rec_item_id: %s", k)
-                    try:
-                        item = self.db.get_items(item_id=item_id)
-                        item_info_value = item.get(cat, "")
-
-                        #print("DEBUG get_recommendations. item value for %s: %s", cat, item_info_value)
-                        # In case the info value is not in cat_rec (as it can obviously happen
-                        # because a rec'd item coming from most popular can have the value of
-                        # an info (author etc) which is not in the rec'd info
-                        if item_info_value:
-                            global_rec[item_id] = score + cat_rec.get(cat, {}).get(item_info_value, 0)
-                    except Exception as e:
-                        self.logger.error("item %s, category %s", item_id, cat)
-                        logging.exception(e)
-        global_rec.sort_values(inplace=True, ascending=False)
-#        print("DEBUG [get_recommendations] global_rec:\n %s", global_rec)
-
-        if user_has_rated_items:
-            # If the user has rated all items, return an empty list
-            rated = df_user[user_id] != 0
-            # rated.get is correct (pycharm complains, knows no pandas)
-            items = [i for i in global_rec.index if not rated.get(i, False)]
-            if items:
-                return items[:max_recs]
+            # the popularity index is always up to date, the model is used while the background refresher runs
+            if self._refresher is None and (not fast or len(self._model.popular_items) == 0):
+                # enough items to fill max_recs after removing the rated items and fewer than max_recs candidates
+                popular_items = self._items_popularity.popular_items(2 * max_recs + len(rated_items))
             else:
-                return []
-        else:
-            try:
-                return list(global_rec.index)[:max_recs]
-            except:
-                return None
+                popular_items = self._model.popular_items
+
+            if self._model.neighbours is not None:
+                # only the k neighbours of each item rated by the user are read
+                indices, data = self._model.neighbours.score(rated_items, codes)
+            else:
+                if self.similarity == 'cooccurrence':
+                    # co-occurrence is symmetric: only the rows of the items rated by the user are read
+                    scores = self._items_cooccurrence.dot(user_ratings)
+                else:
+                    # the neighbours of the items rated by the user, items inserted after the model are not scored
+                    similarity = self._model.items_cooccurrence
+                    n_items = similarity.shape[0]
+                    known = rated_items < n_items
+                    scores = csr_vector(rated_items[known], codes[known], n_items).dot(similarity).tocsr()
+                    scores.sort_indices()
+                indices, data = scores.indices, scores.data
+            # rated items are removed before any selection
+            keep = (data != 0) & ~np.isin(indices, rated_items)
+            candidates, candidates_scores = indices[keep], data[keep]
+
+            # If necessary, add popular items. If the user has not rated, then rec=popular with score
+            # starting from max_rating and going down as 1/i
+            candidates, candidates_scores = self._add_popular_items(candidates, candidates_scores,
+                                                                    rated_items, max_recs, popular_items,
+                                                                    self.max_rating)
+
+            # Recommended items receive a further score according to categories: the scores of the values
+            # of the categories (e.g. authors) liked by the user are gathered for all the candidates
+            for cat in rated_infos:
+                values_scores = self._get_categories_cooccurrence(cat).dot(cat_user[cat])
+                candidates_scores = candidates_scores + self._get_items_categories(cat).scores(
+                    candidates, values_scores.toarray().ravel())
+
+            # rated items are already excluded, if the user has rated all items the list is empty
+            top = self._top_items(candidates_scores, max_recs)
+            return [items.key(i) for i in candidates[top]]
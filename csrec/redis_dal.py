@@ -0,0 +1,1146 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+
+__base_error_code__ = 140
+
+import json
+import logging
+import os
+import pickle
+import threading
+from time import time
+
+import numpy as np
+from csrec.dal import DALBase
+from csrec import mem_dal
+from csrec.tools.singleton import Singleton
+from csrec.tools.observable import observable
+from csrec.tools.rwlock import read_locked, write_locked
+from csrec.tools.idmap import IdMap
+from csrec.tools import snapshot
+
+from csrec.exceptions import *
+
+try:
+    import redis
+except ImportError:  # optional, needed only by this datastore
+    redis = None
+
+_replace = getattr(os, 'replace', os.rename)
+
+# Keys, below the prefix (default "csrec"):
+#   users:ids, items:ids, values:<info>:ids      lists of the ids, the position is the integer index
+#   users:index, items:index, values:<info>:index  hashes id -> index
+#   items                    hash item -> attributes
+#   rated                    set of the users who rated items
+#   ur:<user>                hash item -> code, the ratings of a user
+#   ir:<item>                hash user -> code, the ratings of an item
+#   ut:<user>                hash item -> timestamp, the time of the ratings of a user
+#   social_users             set of the users with social actions
+#   social:<user>            hash user_to -> code
+#   info_used                set of the categories used
+#   cusers:<info>            set of the users with ratings on the values of a category
+#   ctot:<info>:<user>, cn:<info>:<user>  hashes value -> sum, number of the ratings
+#   version                  counter incremented by every change, it is never reset
+# Ids, in keys and fields, and codes are JSON encoded so that their type is kept, e.g. 1 and "1" are
+# different ids as in the mem datastore.
+
+# assign the indices of new ids, atomically for all the processes sharing the server
+INTERN_SCRIPT = """
+local indices = {}
+for i, id in ipairs(ARGV) do
+    local index = redis.call('HGET', KEYS[1], id)
+    if not index then
+        index = redis.call('RPUSH', KEYS[2], id) - 1
+        redis.call('HSET', KEYS[1], id, index)
+    end
+    indices[i] = tonumber(index)
+end
+return indices
+"""
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _loads(raw):
+    return json.loads(raw.decode('utf-8') if isinstance(raw, bytes) else raw)
+
+
+def _decode_hash(raw):
+    return dict((_loads(k), _loads(v)) for k, v in raw.items())
+
+
+class SharedIdMap(IdMap):
+    """
+    IdMap of the ids stored on a Redis server: the indices are assigned by the server, so that they are
+    the same in every process. The ids assigned by the other processes are read by update()
+    """
+    def __init__(self, client, key, intern_script):
+        IdMap.__init__(self)
+        self._client = client
+        self._key = key
+        self._intern_script = intern_script
+
+    def intern(self, key):
+        index = self._index.get(key)
+        if index is None:
+            index = int(self.intern_many([key])[0])
+        return index
+
+    def intern_many(self, keys):
+        keys = list(keys)
+        new = []  # in order of first occurrence, as IdMap
+        seen = set()
+        for k in keys:
+            if k not in self._index and k not in seen:
+                seen.add(k)
+                new.append(k)
+        if new:
+            indices = self._intern_script(keys=[self._key + ':index', self._key + ':ids'],
+                                          args=[_dumps(k) for k in new])
+            self.update(max(indices) + 1)
+        return np.fromiter((self._index[k] for k in keys), dtype=self.dtype, count=len(keys))
+
+    def update(self, length=None):
+        """
+        read the ids added by the other processes
+
+        :param length: the number of ids to read, if None all of them
+        """
+        start = len(self._keys)
+        if length is not None and length <= start:
+            return
+        for raw in self._client.lrange(self._key + ':ids', start, -1 if length is None else length - 1):
+            IdMap.intern(self, _loads(raw))
+
+
+class Database(DALBase, Singleton):
+    """
+    Datastore on a Redis server, shared by the processes (e.g. the workers of a web application)
+    connected to the same server. The updates of each method are sent in a single pipeline, executed
+    as a transaction, through a pool of connections.
+    The co-occurrence matrices of each recommender are computed when it starts, or restores the data,
+    and then updated with the changes made by its own process. Each change increments a counter on the
+    server, so synchronize() tells when the other processes changed the data: the recommender then
+    builds the matrices again when it refreshes its model.
+    """
+    def __init__(self):
+        DALBase.__init__(self)
+
+        self.__params_dictionary = {}  # abstraction layer initialization parameters
+        self.client = None
+        self.prefix = None
+        self._intern_script = None
+        self._version = 0  # value of the counter of the changes when this process last saw all of them
+
+        self.users_map = None
+        self.items_map = None
+        self.categories_maps = {}  # category -> SharedIdMap of the values
+
+    def init(self, **params):
+        if not params:
+            params = {}
+        try:
+            if redis is None and params.get('client') is None:
+                raise ImportError("the redis package is needed by the redis datastore")
+            self.__params_dictionary.update(params)
+            self.prefix = params.get('prefix', 'csrec')
+            self.client = params.get('client')
+            if self.client is None:
+                pool_params = {'max_connections': int(params.get('max_connections', 16)),
+                               'socket_timeout': params.get('socket_timeout')}
+                if params.get('url') is not None:
+                    pool = redis.ConnectionPool.from_url(params['url'], **pool_params)
+                else:
+                    pool = redis.ConnectionPool(host=params.get('host', 'localhost'),
+                                                port=int(params.get('port', 6379)), db=int(params.get('db', 0)),
+                                                password=params.get('password'), **pool_params)
+                self.client = redis.StrictRedis(connection_pool=pool)
+            self._intern_script = self.client.register_script(INTERN_SCRIPT)
+            self.users_map = SharedIdMap(self.client, self._key('users'), self._intern_script)
+            self.items_map = SharedIdMap(self.client, self._key('items'), self._intern_script)
+            self.categories_maps = {}
+            self._update_maps()
+            self._version = int(self.client.get(self._key('version')) or 0)
+        except Exception as e:
+            e_message = "error during initialization"
+            raise InitializationException(e_message + " : " + str(e))
+
+    @staticmethod
+    def get_init_parameters_description():
+        param_description = {
+            "url": "the url of the server, e.g. redis://localhost:6379/0, instead of host, port, db and password",
+            "host": "the host of the server, default localhost",
+            "port": "the port of the server, default 6379",
+            "db": "the number of the database, default 0",
+            "password": "the password of the server",
+            "prefix": "the prefix of the keys, default csrec",
+            "max_connections": "the maximum number of connections of the pool, default 16",
+            "socket_timeout": "timeout in seconds of the requests to the server",
+            "client": "a redis client already connected, used instead of the parameters above",
+        }
+        return param_description
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def _user_key(self, user_id):
+        """
+        user ids are stored as strings without dots, as in the mem datastore
+        """
+        return _dumps(str(user_id).replace('.', ''))
+
+    def _values_map(self, info):
+        values_map = self.categories_maps.get(info)
+        if values_map is None:
+            values_map = SharedIdMap(self.client, self._key('values', info), self._intern_script)
+            values_map = self.categories_maps.setdefault(info, values_map)
+        return values_map
+
+    def _update_maps(self):
+        self.users_map.update()
+        self.items_map.update()
+        for info in self.client.smembers(self._key('info_used')):
+            self._values_map(_loads(info))
+        for values_map in self.categories_maps.values():
+            values_map.update()
+
+    def _execute(self, pipe, exception, e_message):
+        pipe.incr(self._key('version'))
+        try:
+            results = pipe.execute()
+        except redis.RedisError as e:
+            raise exception(e_message + " : " + str(e))
+        self._changed(results[-1])
+        return results[:-1]
+
+    def _changed(self, version):
+        """
+        :param version: the counter of the changes after a change of this process
+        """
+        # the changes are serialized by the lock in the process: the other processes changed
+        # the data if the counter moved more than once, and synchronize() finds it
+        if version == self._version + 1:
+            self._version = version
+
+    def synchronize(self):
+        """
+        read the ids added by the other processes, see DALBase.synchronize
+
+        :return: True if other processes changed the data since the last call
+        """
+        with self.lock.reader():
+            version = int(self.client.get(self._key('version')) or 0)
+            self._update_maps()
+            changed = version != self._version
+            self._version = version
+            return changed
+
+    @staticmethod
+    def _attributes(item, attributes):
+        for k, v in attributes.items():
+            item[k] = v if isinstance(v, list) else [v]
+        return item
+
+    @write_locked
+    @observable
+    def insert_item(self, item_id, attributes=None):
+        """
+        insert a new item on datastore, if the item already exists its attributes are updated
+
+        exception: raise an InsertException if any error occur
+
+        :param item_id: item id
+        :param attributes: a dictionary with item attributes e.g.
+            {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+        """
+        self.items_map.intern(item_id)
+        item = {}
+        if attributes is not None:
+            raw = self.client.hget(self._key('items'), _dumps(item_id))
+            item = self._attributes(_loads(raw) if raw is not None else {}, attributes)
+        pipe = self.client.pipeline()
+        pipe.hset(self._key('items'), _dumps(item_id), json.dumps(item))
+        self._execute(pipe, InsertException, "unable to insert item: %d" % (__base_error_code__ + 1))
+        return True
+
+    @write_locked
+    @observable
+    def insert_items_bulk(self, items):
+        """
+        insert many items at once in a single pipeline, same as calling insert_item for each item but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param items: a dictionary {item_id: attributes}, an iterable of (item_id, attributes) pairs
+            or a pandas DataFrame indexed by item id with one column for each attribute
+        :return: the list of the inserted item ids
+        """
+        if hasattr(items, 'columns'):  # DataFrame
+            items = items.to_dict('index')
+        if hasattr(items, 'items'):
+            items = items.items()
+        items = list(items)
+        item_ids = [item_id for item_id, _ in items]
+        self.items_map.intern_many(item_ids)
+
+        fields = list(set(_dumps(i) for i in item_ids))
+        stored = {}
+        if fields:
+            stored = dict((f, _loads(raw)) for f, raw in zip(fields, self.client.hmget(self._key('items'), fields))
+                          if raw is not None)
+        rows = {}
+        for item_id, attributes in items:
+            field = _dumps(item_id)
+            item = rows.get(field)
+            if item is None:
+                item = rows[field] = stored.get(field, {})
+            for k, v in (attributes or {}).items():
+                if v is None or v != v:  # missing values of DataFrames are NaN
+                    continue
+                item[k] = v if isinstance(v, list) else [v]
+        if rows:
+            pipe = self.client.pipeline()
+            pipe.hset(self._key('items'), mapping=dict((f, json.dumps(i)) for f, i in rows.items()))
+            self._execute(pipe, InsertException, "unable to insert items: %d" % (__base_error_code__ + 2))
+        return item_ids
+
+    @write_locked
+    @observable
+    def remove_item(self, item_id=None):
+        """
+        remove an item from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param item_id: the item id to delete, if None remove all items
+        """
+        pipe = self.client.pipeline()
+        if item_id is not None:
+            pipe.hdel(self._key('items'), _dumps(item_id))
+        else:
+            pipe.delete(self._key('items'))
+        self._execute(pipe, DeleteException, "unable to remove item: %d" % (__base_error_code__ + 3))
+
+    @read_locked
+    def get_items(self, item_id=None):
+        """
+        get a dictionary of items
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: the item id to get, if None get all items
+        :return: a dictionary with one or more items:
+            item_id0 : {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+            ...
+
+            None is the value of the item if it was not found
+        """
+        if item_id is not None:
+            raw = self.client.hget(self._key('items'), _dumps(item_id))
+            return {item_id: _loads(raw) if raw is not None else None}
+        return _decode_hash(self.client.hgetall(self._key('items')))
+
+    def get_items_iterator(self):
+        """
+        an iterator on items
+
+        :return: an iterator on (item_id, attributes)
+        """
+        for field, raw in self.client.hscan_iter(self._key('items'), count=1000):
+            yield _loads(field), _loads(raw)
+
+    @write_locked
+    @observable
+    def insert_social_action(self, user_id, user_id_to, code=3.0):
+        """
+        insert a new user id on datastore, for each user a list of actions will be maintained:
+            user0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        :param code: the code, default value is 3.0
+        """
+        pipe = self.client.pipeline()
+        pipe.hset(self._key('social', _dumps(user_id)), _dumps(user_id_to), _dumps(code))
+        pipe.sadd(self._key('social_users'), _dumps(user_id))
+        self._execute(pipe, InsertException, "unable to insert social action: %d" % (__base_error_code__ + 4))
+
+    @write_locked
+    @observable
+    def remove_social_action(self, user_id, user_id_to):
+        """
+        remove a social action from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        """
+        pipe = self.client.pipeline()
+        pipe.hdel(self._key('social', _dumps(user_id)), _dumps(user_id_to))
+        self._execute(pipe, DeleteException, "unable to remove social action: %d" % (__base_error_code__ + 5))
+
+    @read_locked
+    def get_social_actions(self, user_id=None):
+        """
+        get the social actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None, return all social actions
+        :return: a dictionary social actions performed BY users:
+            user0: { 'user_1':3.0, ..., 'user_M':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_M':5.0}
+        """
+        if user_id is not None:
+            users = [_dumps(user_id)]
+        else:
+            users = [u.decode('utf-8') for u in self.client.smembers(self._key('social_users'))]
+        social_actions = {}
+        for user, actions in zip(users, self._hashes(self._key('social', u) for u in users)):
+            if actions:
+                social_actions[_loads(user)] = _decode_hash(actions)
+        return social_actions
+
+    def _categories_updates(self, pipe, info, user, values, code):
+        tot_key = self._key('ctot', info, user)
+        n_key = self._key('cn', info, user)
+        for value in values:
+            pipe.hincrby(tot_key, _dumps(value), int(code))
+            pipe.hincrby(n_key, _dumps(value), 1)
+        pipe.sadd(self._key('cusers', info), user)
+
+    @write_locked
+    @observable
+    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False,
+                           timestamp=None):
+        """
+        insert a new item code on datastore, for each user a list of ratings will be maintained:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :param code: the code, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the item, be considered
+        :param timestamp: the time of the action in seconds since the epoch, if None the current time
+        :return: the timestamp of the action
+        """
+        if item_meaningful_info is None:
+            item_meaningful_info = []
+        if timestamp is None:
+            timestamp = time()
+        user = self._user_key(user_id)
+        self.users_map.intern(_loads(user))
+        raw = self.client.hget(self._key('items'), _dumps(item_id))
+
+        pipe = self.client.pipeline()
+        if raw is not None:
+            item = _loads(raw)
+            for info in item_meaningful_info:
+                values = item.get(info)
+                if values is not None:
+                    self._values_map(info).intern_many(values)
+                    pipe.sadd(self._key('info_used'), _dumps(info))
+                    self._categories_updates(pipe, info, user, values, code)
+        else:
+            self.insert_item(item_id=item_id)
+        if not only_info:
+            pipe.hset(self._key('ur', user), _dumps(item_id), _dumps(code))
+            pipe.hset(self._key('ir', _dumps(item_id)), user, _dumps(code))
+            pipe.hset(self._key('ut', user), _dumps(item_id), _dumps(timestamp))
+            pipe.sadd(self._key('rated'), user)
+        self._execute(pipe, InsertException, "unable to insert item action: %d" % (__base_error_code__ + 6))
+        return timestamp
+
+    @write_locked
+    @observable
+    def insert_item_actions_bulk(self, actions, code=3.0, item_meaningful_info=None, only_info=False,
+                                 timestamp=None):
+        """
+        insert many item actions at once in a single pipeline, same as calling insert_item_action for
+        each action but the observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param actions: an iterable of (user_id, item_id), (user_id, item_id, code) or
+            (user_id, item_id, code, timestamp) tuples, a dictionary of arrays
+            {"user_id": [...], "item_id": [...], "code": [...], "timestamp": [...]} or a pandas DataFrame with
+            the same columns, "code" and "timestamp" are optional
+        :param code: the code of the actions without one, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the items, be considered
+        :param timestamp: the time of the actions without one, in seconds since the epoch,
+            if None the current time
+        :return: a tuple (users, timestamps) with the list of the users whose actions have been inserted
+            and the list of the timestamps of the actions, in their order, e.g. to log them
+        """
+        if item_meaningful_info is None:
+            item_meaningful_info = []
+        users, items, codes, timestamps = self._actions_columns(actions, code, timestamp)
+        users_keys = {}  # user id -> JSON of the normalized user id
+        inserted_users = []
+        for user_id in users:
+            if user_id not in users_keys:
+                users_keys[user_id] = self._user_key(user_id)
+                user_key = _loads(users_keys[user_id])
+                if user_key not in inserted_users:
+                    inserted_users.append(user_key)
+        self.users_map.intern_many(inserted_users)
+
+        # the attributes of the items are read at once, the items which do not exist are inserted
+        items_fields = dict((i, _dumps(i)) for i in set(items))
+        fields = list(items_fields.values())
+        items_attributes = {}
+        if fields:
+            items_attributes = dict(zip(fields, self.client.hmget(self._key('items'), fields)))
+        missing = [i for i, f in items_fields.items() if items_attributes[f] is None]
+        self.items_map.intern_many(missing)
+
+        pipe = self.client.pipeline()
+        if missing:
+            pipe.hset(self._key('items'), mapping=dict((items_fields[i], '{}') for i in missing))
+        categories = {}  # (info, user) -> values, with repetitions
+        for user_id, item_id, code, timestamp in zip(users, items, codes, timestamps):
+            user = users_keys[user_id]
+            raw = items_attributes[items_fields[item_id]]
+            if raw is not None:
+                item = _loads(raw)
+                for info in item_meaningful_info:
+                    values = item.get(info)
+                    if values is not None:
+                        categories.setdefault((info, user), []).append((values, code))
+            if not only_info:
+                pipe.hset(self._key('ur', user), items_fields[item_id], _dumps(code))
+                pipe.hset(self._key('ir', items_fields[item_id]), user, _dumps(code))
+                pipe.hset(self._key('ut', user), items_fields[item_id], _dumps(timestamp))
+        for (info, user), ratings in categories.items():
+            for values, code in ratings:
+                self._values_map(info).intern_many(values)
+                self._categories_updates(pipe, info, user, values, code)
+            pipe.sadd(self._key('info_used'), _dumps(info))
+        if not only_info and users_keys:
+            pipe.sadd(self._key('rated'), *set(users_keys.values()))
+        self._execute(pipe, InsertException, "unable to insert item actions: %d" % (__base_error_code__ + 7))
+        return inserted_users, timestamps
+
+    @write_locked
+    @observable
+    def remove_item_action(self, user_id, item_id):
+        """
+        remove a rating made by a user from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :return: True if the operation was successfully executed or it does not exists, otherwise return False
+        """
+        user = self._user_key(user_id)
+        pipe = self.client.pipeline()
+        pipe.hdel(self._key('ur', user), _dumps(item_id))
+        pipe.hdel(self._key('ir', _dumps(item_id)), user)
+        pipe.hdel(self._key('ut', user), _dumps(item_id))
+        self._execute(pipe, DeleteException, "unable to remove item action: %d" % (__base_error_code__ + 8))
+
+    def _hashes(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return pipe.execute()
+
+    @read_locked
+    def get_item_actions(self, user_id=None):
+        """
+        get a dictionary with user's actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :return: a dictionary with all ratings:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        if user_id is not None:
+            user = self._user_key(user_id)
+            if not self.client.sismember(self._key('rated'), user):
+                return {}
+            users = [user]
+        else:
+            users = [u.decode('utf-8') for u in self.client.smembers(self._key('rated'))]
+        actions = self._hashes(self._key('ur', u) for u in users)
+        return dict((_loads(u), _decode_hash(a)) for u, a in zip(users, actions))
+
+    def get_item_actions_iterator(self):
+        """
+        get an iterator on item actions
+
+        exception: raise a GetException if any error occur
+
+        :return: an iterator on item ratings for each user:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        # the ratings are read in pipelines of 1000 users
+        batch = []
+        for user in self.client.sscan_iter(self._key('rated'), count=1000):
+            batch.append(_loads(user))
+            if len(batch) == 1000:
+                for user_id, actions in zip(batch, self._hashes(self._key('ur', _dumps(u)) for u in batch)):
+                    yield user_id, _decode_hash(actions)
+                batch = []
+        for user_id, actions in zip(batch, self._hashes(self._key('ur', _dumps(u)) for u in batch)):
+            yield user_id, _decode_hash(actions)
+
+    @read_locked
+    def get_item_ratings(self, item_id=None):
+        """
+        get ratings on items made by users
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: an item id, if None returns the ratings for all items
+        :return: a dictionary with ratings for each item
+            item0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            itemN: { 'user_0':3.0, ..., 'user_N':5.0}
+        """
+        if item_id is not None:
+            item_ids = [item_id]
+        else:
+            self.items_map.update()
+            item_ids = list(self.items_map.keys())
+        ratings = self._hashes(self._key('ir', _dumps(i)) for i in item_ids)
+        return dict((i, _decode_hash(r)) for i, r in zip(item_ids, ratings) if r)
+
+    @read_locked
+    def get_info_used(self):
+        """
+        get the categories used
+
+        exception: raise a GetException if any error occur
+
+        :return: a set with the name of categories used
+        """
+        return set(_loads(i) for i in self.client.smembers(self._key('info_used')))
+
+    @write_locked
+    def set_info_used(self, info_used):
+        """
+        insert a new category
+
+        exception: raise an InsertException if any error occur
+
+        :param info_used: the new category to use
+        """
+        pipe = self.client.pipeline()
+        pipe.sadd(self._key('info_used'), _dumps(info_used))
+        self._execute(pipe, InsertException, "unable to insert category: %d" % (__base_error_code__ + 14))
+
+    @write_locked
+    def remove_info_used(self, info_used=None):
+        """
+        remove a category from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param info_used: the category to be deleted, if None, reset all categories
+        """
+        pipe = self.client.pipeline()
+        if info_used:
+            pipe.srem(self._key('info_used'), _dumps(info_used))
+        else:
+            pipe.delete(self._key('info_used'))
+        self._execute(pipe, DeleteException, "unable to remove category: %d" % (__base_error_code__ + 15))
+
+    def _rated_user(self, user_id, e_message):
+        user = self._user_key(user_id)
+        if not self.client.sismember(self._key('rated'), user):
+            raise MergeEntitiesException(e_message + ": %s" % _loads(user))
+        return user
+
+    @write_locked
+    @observable
+    def remove_user(self, user_id):
+        """
+        remove all the actions of a user
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param user_id: user id, raise an error if does not exists
+        """
+        user = self._rated_user(user_id, "unable to remove user, id does not exists")
+        items = self.client.hkeys(self._key('ur', user))
+        info_used = self.client.smembers(self._key('info_used'))
+
+        pipe = self.client.pipeline()
+        # only the ratings of the items rated by the user are changed
+        for item in items:
+            pipe.hdel(self._key('ir', item.decode('utf-8')), user)
+        pipe.delete(self._key('ur', user), self._key('ut', user))
+        pipe.srem(self._key('rated'), user)
+        pipe.delete(self._key('social', user))
+        pipe.srem(self._key('social_users'), user)
+        for info in info_used:
+            info = _loads(info)
+            pipe.delete(self._key('ctot', info, user), self._key('cn', info, user))
+            pipe.srem(self._key('cusers', info), user)
+        self._execute(pipe, MergeEntitiesException, "unable to remove user: %d" % (__base_error_code__ + 9))
+
+    @write_locked
+    @observable
+    def reconcile_user(self, old_user_id, new_user_id):
+        """
+        merge two users under the new user id, old user id will be removed
+        for each item rated by both users, the rating of old_user_id will be kept as in the mem datastore
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param old_user_id: old user id, raise an error if does not exists
+        :param new_user_id: new user id, raise an error if does not exists
+        """
+        old_user = self._rated_user(old_user_id, "unable to reconcile old user id does not exists")
+        new_user = self._rated_user(new_user_id, "unable to reconcile new user id does not exists")
+        if old_user == new_user:
+            e_message = "users to be reconcile are the same: %s" % _loads(new_user)
+            raise MergeEntitiesException(e_message)
+
+        info_used = [_loads(i) for i in self.client.smembers(self._key('info_used'))]
+        keys = [self._key('ur', old_user), self._key('ut', old_user), self._key('social', old_user),
+                self._key('social', new_user)]
+        for info in info_used:
+            keys.extend((self._key('ctot', info, old_user), self._key('cn', info, old_user)))
+        hashes = self._hashes(keys)
+        old_ratings, old_times, old_social, new_social = hashes[:4]
+
+        pipe = self.client.pipeline()
+        if old_ratings:
+            pipe.hset(self._key('ur', new_user), mapping=old_ratings)
+        if old_times:
+            pipe.hset(self._key('ut', new_user), mapping=old_times)
+        for item, code in old_ratings.items():
+            item = item.decode('utf-8')
+            pipe.hdel(self._key('ir', item), old_user)
+            pipe.hset(self._key('ir', item), new_user, code)
+        pipe.delete(self._key('ur', old_user), self._key('ut', old_user))
+        pipe.srem(self._key('rated'), old_user)
+
+        # the social actions of the new user are kept
+        old_social.update(new_social)
+        if old_social:
+            pipe.hset(self._key('social', new_user), mapping=old_social)
+            pipe.sadd(self._key('social_users'), new_user)
+        pipe.delete(self._key('social', old_user))
+        pipe.srem(self._key('social_users'), old_user)
+
+        # the ratings on the values of the categories are summed
+        for n, info in enumerate(info_used):
+            tot, count = hashes[4 + 2 * n], hashes[5 + 2 * n]
+            for value in tot:
+                pipe.hincrby(self._key('ctot', info, new_user), value, int(tot[value]))
+                pipe.hincrby(self._key('cn', info, new_user), value, int(count.get(value, 0)))
+            if tot:
+                pipe.sadd(self._key('cusers', info), new_user)
+            pipe.delete(self._key('ctot', info, old_user), self._key('cn', info, old_user))
+            pipe.srem(self._key('cusers', info), old_user)
+        self._execute(pipe, MergeEntitiesException, "unable to reconcile users: %d" % (__base_error_code__ + 10))
+
+    @read_locked
+    def get_user_count(self):
+        """
+        get the number of users who rated items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of users
+        """
+        return self.client.scard(self._key('rated'))
+
+    @read_locked
+    def get_items_count(self):
+        """
+        get the number of items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of items
+        """
+        return self.client.hlen(self._key('items'))
+
+    @read_locked
+    def get_social_count(self):
+        """
+        Get the number of social actions
+        :return: number of social actions
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for user in self.client.smembers(self._key('social_users')):
+            pipe.hlen(self._key('social', user.decode('utf-8')))
+        return sum(pipe.execute())
+
+    def get_social_iterator(self):
+        for user, actions in self.get_social_actions().items():
+            yield {user: actions}
+
+    @write_locked
+    @observable
+    def reset(self):
+        """
+        reset all data into the datastore
+
+        exception: raise a DeleteException if any error occur
+        """
+        self._clear()
+
+    def _clear(self):
+        try:
+            version = self._key('version')
+            keys = [k for k in self.client.scan_iter(match=self._key('*'), count=1000)
+                    if (k.decode('utf-8') if isinstance(k, bytes) else k) != version]
+            for start in range(0, len(keys), 1000):
+                self.client.delete(*keys[start:start + 1000])
+            self._changed(self.client.incr(version))
+        except redis.RedisError as e:
+            e_message = "unable to reset the datastore: %d" % (__base_error_code__ + 11)
+            raise DeleteException(e_message + " : " + str(e))
+        self.users_map.clear()
+        self.items_map.clear()
+        for values_map in self.categories_maps.values():
+            values_map.clear()
+
+    @read_locked
+    def get_user_index(self, user_id):
+        """
+        get the integer index of a user
+
+        :param user_id: user id
+        :return: the index of the user, None if the user has never rated an item
+        """
+        user_id = _loads(self._user_key(user_id))
+        if user_id not in self.users_map:
+            self.users_map.update()
+        return self.users_map.index(user_id)
+
+    @read_locked
+    def get_item_index(self, item_id):
+        """
+        get the integer index of an item
+
+        :param item_id: item id
+        :return: the index of the item, None if the item does not exists
+        """
+        if item_id not in self.items_map:
+            self.items_map.update()
+        return self.items_map.index(item_id)
+
+    def get_users_map(self):
+        """
+        :return: the IdMap between user ids and integer indices
+        """
+        return self.users_map
+
+    def get_items_map(self):
+        """
+        :return: the IdMap between item ids and integer indices
+        """
+        return self.items_map
+
+    def get_category_values_map(self, info):
+        """
+        :param info: the category e.g. "author"
+        :return: the IdMap between the values of the category and integer indices
+        """
+        return self._values_map(info)
+
+    @read_locked
+    def get_item_actions_arrays(self, user_id=None, timestamps=False):
+        """
+        get the users' actions as coordinates of a sparse matrix users x items
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :param timestamps: return the timestamps of the actions too, the actions inserted by older
+            versions, without one, get the current time
+        :return: a tuple (users, items, codes) of numpy arrays, users and items are indices
+            of get_users_map() and get_items_map(), (users, items, codes, timestamps) with timestamps
+        """
+        if user_id is not None:
+            users = [self._user_key(user_id)]
+        else:
+            users = [u.decode('utf-8') for u in self.client.smembers(self._key('rated'))]
+        actions = self._hashes(self._key('ur', u) for u in users)
+        times = self._hashes(self._key('ut', u) for u in users) if timestamps else [{}] * len(users)
+        self._update_maps()
+        now = time()
+        rows, columns, codes, actions_times = [], [], [], []
+        for user, ratings, user_times in zip(users, actions, times):
+            user = self.users_map.index(_loads(user))
+            for item, code in ratings.items():
+                rows.append(user)
+                columns.append(self.items_map.index(_loads(item)))
+                codes.append(float(_loads(code)))
+                if timestamps:
+                    timestamp = user_times.get(item)
+                    actions_times.append(now if timestamp is None else float(_loads(timestamp)))
+        arrays = (np.array(rows, dtype=IdMap.dtype), np.array(columns, dtype=IdMap.dtype),
+                  np.array(codes, dtype=np.float64))
+        if timestamps:
+            arrays += (np.array(actions_times, dtype=np.float64),)
+        return arrays
+
+    @read_locked
+    def get_categories_user_ratings_arrays(self, info, user_id=None):
+        """
+        get the ratings of users on the values of a category as coordinates of a sparse matrix
+        users x values
+
+        exception: raise a GetException if any error occur
+
+        :param info: the category e.g. "author"
+        :param user_id: user id, if None returns the ratings of all users
+        :return: a tuple (users, values, tot, n) of numpy arrays, users and values are indices
+            of get_users_map() and get_category_values_map(info), tot is the sum of ratings
+            and n the number of ratings
+        """
+        if user_id is not None:
+            users = [self._user_key(user_id)]
+        else:
+            users = [u.decode('utf-8') for u in self.client.smembers(self._key('cusers', info))]
+        keys = []
+        for user in users:
+            keys.extend((self._key('ctot', info, user), self._key('cn', info, user)))
+        hashes = self._hashes(keys)
+        self._update_maps()
+        values_map = self._values_map(info)
+        rows, columns, tot, n = [], [], [], []
+        for k, user in enumerate(users):
+            user = self.users_map.index(_loads(user))
+            user_tot, user_n = hashes[2 * k], hashes[2 * k + 1]
+            for value in user_tot:
+                rows.append(user)
+                columns.append(values_map.index(_loads(value)))
+                tot.append(float(user_tot[value]))
+                n.append(float(user_n.get(value, 0)))
+        return (np.array(rows, dtype=IdMap.dtype), np.array(columns, dtype=IdMap.dtype),
+                np.array(tot, dtype=np.float64), np.array(n, dtype=np.float64))
+
+    def _tables(self):
+        """
+        :return: the data of the datastore in the dictionary serialized by the mem datastore
+        """
+        self._update_maps()
+        info_used = self.get_info_used()
+        users_ratings = self.get_item_actions()
+        items_ratings = {}
+        for user_id, ratings in users_ratings.items():
+            for item_id, code in ratings.items():
+                items_ratings.setdefault(item_id, {})[user_id] = code
+        users = list(users_ratings)
+        users_times = dict((u, dict((_loads(i), _loads(t)) for i, t in times.items()))
+                           for u, times in zip(users, self._hashes(self._key('ut', _dumps(u)) for u in users)))
+        data = {'items': self.get_items(),
+                'users_ratings': users_ratings,
+                'items_ratings': items_ratings,
+                'users_times': users_times,
+                'user_social': self.get_social_actions(),
+                'info_used': info_used,
+                'users_map': list(self.users_map.keys()),
+                'items_map': list(self.items_map.keys()),
+                'categories_maps': dict((c, list(m.keys())) for c, m in self.categories_maps.items())}
+        for name in ('tot_categories_user_ratings', 'tot_categories_item_ratings',
+                     'n_categories_user_ratings', 'n_categories_item_ratings'):
+            data[name] = {}
+        for info in info_used:
+            users = [u.decode('utf-8') for u in self.client.smembers(self._key('cusers', info))]
+            keys = []
+            for user in users:
+                keys.extend((self._key('ctot', info, user), self._key('cn', info, user)))
+            hashes = self._hashes(keys)
+            for k, user in enumerate(users):
+                user_id = _loads(user)
+                tot = dict((_loads(v), int(t)) for v, t in hashes[2 * k].items())
+                n = dict((_loads(v), int(c)) for v, c in hashes[2 * k + 1].items())
+                data['tot_categories_user_ratings'].setdefault(info, {})[user_id] = tot
+                data['n_categories_user_ratings'].setdefault(info, {})[user_id] = n
+                for value in tot:
+                    data['tot_categories_item_ratings'].setdefault(info, {}).setdefault(value, {})[user_id] = tot[value]
+                    data['n_categories_item_ratings'].setdefault(info, {}).setdefault(value, {})[user_id] = n[value]
+        return data
+
+    @staticmethod
+    def _write(data, filepath, file_format):
+        if file_format == 'snapshot':
+            mem_dal.write_tables_snapshot(filepath, data)
+            return
+        if file_format != 'pickle':
+            raise BadParametersException("unsupported file format %s, expected pickle or snapshot" % file_format)
+        # the file is replaced only when complete
+        temporary = filepath + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(data, f)
+        _replace(temporary, filepath)
+
+    @read_locked
+    @observable
+    def serialize(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file
+
+        exception: raise a SerializeException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", the same files of the mem datastore, so that the data
+            can be moved between the two
+        """
+        try:
+            data = self._tables()
+            data['generation'] = self.lock.generation
+            self._write(data, filepath, file_format)
+        except Exception as e:
+            e_message = "unable to serialize data to file: %d" % (__base_error_code__ + 12)
+            raise SerializeException(e_message + " : " + str(e))
+
+    def serialize_background(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file without blocking the other requests while the file is written: the
+        data is read from the server under the read lock, then a background thread writes it. When the
+        file has been written the observers of serialize are notified by the background thread, with the
+        generation of the data written (see RWLock) in the generation parameter, if any error occur it is
+        logged and the observers get return_value False.
+        The other processes connected to the server are not locked, their changes made while the data
+        is read can be partially written
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", see serialize
+        :return: the thread which writes the file, join() waits for the end
+        """
+        with self.lock.reader():
+            generation = self.lock.generation
+            data = self._tables()
+            data['generation'] = generation
+
+        def write():
+            try:
+                self._write(data, filepath, file_format)
+            except Exception as e:
+                logging.getLogger("csrc").error("[serialize_background] unable to serialize data to file %s: %s",
+                                                filepath, e)
+                return_value = False
+            else:
+                return_value = True
+            self.notify('serialize', filepath=filepath, file_format=file_format,
+                        generation=generation, return_value=return_value)
+
+        worker = threading.Thread(target=write, name="csrec-serialize")
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    @write_locked
+    @observable
+    def restore(self, filepath, file_format=None, mmap=False):
+        """
+        restore the datastore from file, the data of the server is replaced
+
+        exception: raise a RestoreException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", if None it is detected from the content of the file.
+            Only snapshots should be loaded from untrusted sources
+        :param mmap: memory map the arrays of snapshots while they are sent to the server
+        """
+        try:
+            if file_format is None:
+                file_format = 'snapshot' if snapshot.is_snapshot(filepath) else 'pickle'
+            if file_format == 'snapshot':
+                data = mem_dal.read_tables_snapshot(filepath, mmap=mmap)
+            elif file_format == 'pickle':
+                with open(filepath, 'rb') as f:
+                    data = pickle.load(f)
+            else:
+                raise BadParametersException("unsupported file format %s, expected pickle or snapshot"
+                                             % file_format)
+            self._restore_tables(data)
+        except Exception as e:
+            e_message = "unable to load data from file: %d" % (__base_error_code__ + 13)
+            raise RestoreException(e_message + " : " + str(e))
+
+    def _restore_tables(self, data):
+        """
+        replace the data with the dictionary serialized by the mem datastore
+        """
+        self._clear()
+        # the indices of the serialized data are kept and the missing ids are appended
+        users_ratings = data['users_ratings']
+        self.users_map.intern_many(data.get('users_map', ()))
+        self.users_map.intern_many(users_ratings)
+        self.items_map.intern_many(data.get('items_map', ()))
+        self.items_map.intern_many(data['items'])
+        for ratings in users_ratings.values():
+            self.items_map.intern_many(ratings)
+        for info, values in data.get('categories_maps', {}).items():
+            self._values_map(info).intern_many(values)
+
+        pipe = self.client.pipeline()
+        if data['items']:
+            pipe.hset(self._key('items'), mapping=dict((_dumps(i), json.dumps(a or {}))
+                                                       for i, a in data['items'].items()))
+        # the actions without a timestamp, e.g. in files written by older versions, get the current time
+        users_times = data.get('users_times', {})
+        timestamp = time()
+        for user_id, ratings in users_ratings.items():
+            user = _dumps(user_id)
+            user_times = users_times.get(user_id, {})
+            pipe.sadd(self._key('rated'), user)
+            for item_id, code in ratings.items():
+                pipe.hset(self._key('ur', user), _dumps(item_id), _dumps(code))
+                pipe.hset(self._key('ir', _dumps(item_id)), user, _dumps(code))
+                pipe.hset(self._key('ut', user), _dumps(item_id), _dumps(user_times.get(item_id, timestamp)))
+        for user_id, actions in data['user_social'].items():
+            if actions:
+                pipe.hset(self._key('social', _dumps(user_id)),
+                          mapping=dict((_dumps(u), _dumps(c)) for u, c in actions.items()))
+                pipe.sadd(self._key('social_users'), _dumps(user_id))
+        for info in data['info_used']:
+            pipe.sadd(self._key('info_used'), _dumps(info))
+        n_user_ratings = data['n_categories_user_ratings']
+        for info, users_values in data['tot_categories_user_ratings'].items():
+            values_map = self._values_map(info)
+            for user_id, values in users_values.items():
+                if not values:
+                    continue
+                values_map.intern_many(values)
+                user = _dumps(user_id)
+                self.users_map.intern(user_id)
+                n_values = n_user_ratings.get(info, {}).get(user_id, {})
+                pipe.hset(self._key('ctot', info, user), mapping=dict((_dumps(v), int(t)) for v, t in values.items()))
+                pipe.hset(self._key('cn', info, user),
+                          mapping=dict((_dumps(v), int(n_values.get(v, 0))) for v in values))
+                pipe.sadd(self._key('cusers', info), user)
+        self._execute(pipe, RestoreException, "unable to restore the data: %d" % (__base_error_code__ + 16))
+        self.lock.generation = data.get('generation', 0)
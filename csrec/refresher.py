@@ -0,0 +1,65 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import threading
+
+
+class ModelRefresher(threading.Thread):
+    """
+    Background thread which rebuilds the model of a recommender every interval seconds,
+    or as soon as n_actions new actions have been inserted, and swaps it in.
+    """
+    def __init__(self, recommender, interval=1800.0, n_actions=None):
+        """
+        :param recommender: the Recommender instance
+        :param interval: seconds between two refreshes, if None only n_actions triggers a refresh
+        :param n_actions: number of new actions which trigger a refresh, if None only the interval is used
+        """
+        threading.Thread.__init__(self, name="csrec-model-refresher")
+        self.daemon = True
+        self.recommender = recommender
+        self.interval = interval
+        self.n_actions = n_actions
+        self.logger = logging.getLogger("csrc")
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._new_actions = 0
+
+    def notify_action(self, n=1):
+        """
+        to be called on each new action, wake up the thread if n_actions have been reached
+
+        :param n: number of new actions
+        """
+        with self._lock:
+            self._new_actions += n
+            if self.n_actions is not None and self._new_actions >= self.n_actions:
+                self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            with self._lock:
+                self._new_actions = 0
+            try:
+                self.recommender.refresh_model()
+            except Exception as e:
+                self.logger.error("[ModelRefresher] model refresh failed")
+                logging.exception(e)
+
+    def stop(self, timeout=None):
+        """
+        stop the thread, a refresh in progress is completed
+
+        :param timeout: seconds to wait for the thread termination, None to wait until it terminates
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
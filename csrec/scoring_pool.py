@@ -0,0 +1,224 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+
+import numpy as np
+from csrec.tools import snapshot
+from csrec.tools.sparse import csr_to_arrays, csr_from_buffers, csr_vector
+from csrec.categories import ItemsCategories
+
+# Functions executed by the workers, in the process of the worker
+
+# the model loaded by the worker:
+# (path of the snapshot file, max rating, items co-occurrence, {info: (co-occurrence, ItemsCategories)}, popular items)
+_worker_model = None
+
+
+def _load(path):
+    """
+    memory map the snapshot published by ScoringPool.publish, the pages are shared by all the workers
+    """
+    global _worker_model
+    if _worker_model is None or _worker_model[0] != path:
+        metadata, arrays = snapshot.read_snapshot(path, mmap=True, verify=False)
+
+        def matrix(name):
+            prefix = name + '.'
+            return csr_from_buffers(dict((k[len(prefix):], a) for k, a in arrays.items() if k.startswith(prefix)))
+
+        categories = {}
+        for n, info in enumerate(metadata['categories']):
+            items_categories = ItemsCategories(None, None)
+            items_categories.index = arrays['categories.%d.items' % n]
+            categories[info] = (matrix('categories.%d.cooccurrence' % n), items_categories)
+        _worker_model = (path, metadata['max_rating'], matrix('items.cooccurrence'), categories,
+                         arrays['popular_items'])
+    return _worker_model
+
+
+def _score(path, requests, max_recs):
+    """
+    same algorithm of Recommender.get_recommendations, on the published model
+
+    :param path: the path of the snapshot file with the model
+    :param requests: list of tuples (rated items, codes, [(info, values, average rating), ...])
+        with the arrays of each user
+    :param max_recs: number of recommended items to be returned for each user
+    :return: list with the numpy array of the indices of the recommended items of each user
+    """
+    from csrec.recommender import Recommender
+    _, max_rating, cooccurrence, categories, popular_items = _load(path)
+    n_items = cooccurrence.shape[0]  # items inserted after the model was published are not scored
+    results = []
+    for rated_items, codes, user_categories in requests:
+        known = rated_items < n_items
+        scores = csr_vector(rated_items[known], codes[known], n_items).dot(cooccurrence).tocsr()
+        scores.sort_indices()
+        keep = (scores.data != 0) & ~np.isin(scores.indices, rated_items)
+        candidates, candidates_scores = scores.indices[keep], scores.data[keep]
+        candidates, candidates_scores = Recommender._add_popular_items(candidates, candidates_scores, rated_items,
+                                                                       max_recs, popular_items, max_rating)
+        for info, values, average in user_categories:
+            if info not in categories:
+                continue
+            cooccurrence_info, items_categories = categories[info]
+            known = values < cooccurrence_info.shape[0]
+            values_scores = csr_vector(values[known], average[known],
+                                       cooccurrence_info.shape[0]).dot(cooccurrence_info)
+            candidates_scores = candidates_scores + items_categories.scores(candidates,
+                                                                            values_scores.toarray().ravel())
+        results.append(candidates[Recommender._top_items(candidates_scores, max_recs)])
+    return results
+
+
+class ScoringPool(object):
+    """
+    Pool of worker processes which compute the recommendations of a Recommender.
+    The model is published once in a snapshot file which every worker memory maps, so the matrices
+    are shared by the processes and not copied. Only the ratings of each user are sent to the workers,
+    and only the indices of the recommended items are sent back.
+    The model is published again when the recommender builds a new one, e.g. by refresh_model
+    or by the background refresher.
+    """
+    def __init__(self, recommender, processes=None, directory=None):
+        """
+        :param recommender: the Recommender instance
+        :param processes: number of worker processes, the number of cores if None
+        :param directory: directory of the files of the published model, a temporary one if None
+        """
+        self.recommender = recommender
+        self.logger = logging.getLogger("csrc")
+        self.processes = processes or multiprocessing.cpu_count()
+        self._temporary = directory is None
+        self.directory = tempfile.mkdtemp(prefix='csrec-pool-') if directory is None else directory
+        self._lock = threading.Lock()
+        self._model = None  # the model of the recommender which has been published
+        self._paths = []  # files of the published models, the previous one can still be used by the workers
+        self._n_published = 0
+        self.publish()
+        self._pool = multiprocessing.Pool(self.processes)
+
+    def publish(self):
+        """
+        Write the current model of the recommender, with the categories' values of the items,
+        in a new snapshot file used by the following requests. It is called automatically when
+        the recommender builds a new model.
+        :return: the path of the file
+        """
+        recommender = self.recommender
+        with self._lock:
+            model = recommender._model
+            if model is self._model and self._paths:
+                return self._paths[-1]
+            if len(model.popular_items) == 0 and recommender.db.get_items_count():
+                model = recommender.refresh_model()
+            with recommender.db.lock.reader():
+                categories = sorted(model.categories_cooccurrence)
+                arrays = {'popular_items': model.popular_items}
+                for name, matrix in [('items', model.items_cooccurrence)] + \
+                        [('categories.%d' % n, model.categories_cooccurrence[info])
+                         for n, info in enumerate(categories)]:
+                    for array_name, array in csr_to_arrays(matrix).items():
+                        arrays['%s.cooccurrence.%s' % (name, array_name)] = array
+                for n, info in enumerate(categories):
+                    arrays['categories.%d.items' % n] = recommender._get_items_categories(info).index.copy()
+            self._n_published += 1
+            path = os.path.join(self.directory, 'model-%d-%d.snap' % (os.getpid(), self._n_published))
+            snapshot.write_snapshot(path, arrays, {'categories': categories, 'max_rating': recommender.max_rating})
+            self._paths.append(path)
+            # tasks sent before this call can still be reading the previous file
+            for old_path in self._paths[:-2]:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+            del self._paths[:-2]
+            self._model = model
+            self.logger.debug("[ScoringPool.publish] model published in %s", path)
+            return path
+
+    def _requests(self, user_ids):
+        """
+        :param user_ids: list of user ids
+        :return: the arguments of _score for each user
+        """
+        db = self.recommender.db
+        requests = []
+        with db.lock.reader():
+            info_used = db.get_info_used()
+            for user_id in user_ids:
+                _, rated_items, codes = db.get_item_actions_arrays(user_id=user_id)
+                user_categories = []
+                for info in info_used:
+                    _, values, tot, n = db.get_categories_user_ratings_arrays(info, user_id=user_id)
+                    if len(values) > 0:
+                        user_categories.append((info, values, tot / n))
+                requests.append((rated_items, codes, user_categories))
+        return requests
+
+    def get_recommendations(self, user_id, max_recs=50):
+        """
+        Compute the recommendations of a user in a worker process, see Recommender.get_recommendations.
+        Can be called by many threads at once, each call is served by a free worker.
+        :param user_id: the user id
+        :param max_recs: number of recommended items to be returned
+        :return: list of recommended items
+        """
+        path = self.publish()
+        indices = self._pool.apply(_score, (path, self._requests([user_id]), max_recs))[0]
+        items = self.recommender.db.get_items_map()
+        return [items.key(i) for i in indices.tolist()]
+
+    def get_recommendations_bulk(self, user_ids, max_recs=50, chunk_size=64):
+        """
+        Compute the recommendations of many users, the users are split in chunks scored
+        by all the workers at once
+        :param user_ids: list of user ids
+        :param max_recs: number of recommended items to be returned for each user
+        :param chunk_size: number of users sent to a worker with a single task
+        :return: a dictionary with the list of recommended items for each user: {user_id: [item, ...]}
+        """
+        start_time = time()
+        user_ids = list(user_ids)
+        path = self.publish()
+        chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+        results = [self._pool.apply_async(_score, (path, self._requests(chunk), max_recs)) for chunk in chunks]
+        items = self.recommender.db.get_items_map()
+        recommendations = {}
+        for chunk, result in zip(chunks, results):
+            for user_id, indices in zip(chunk, result.get()):
+                recommendations[user_id] = [items.key(i) for i in indices.tolist()]
+        elapsed = time() - start_time
+        self.logger.info("[ScoringPool.get_recommendations_bulk] %d users in %.3fs (%.1f users/s)",
+                         len(user_ids), elapsed, len(user_ids) / elapsed if elapsed > 0 else float('inf'))
+        return recommendations
+
+    def close(self):
+        """
+        terminate the workers and remove the files of the published models
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for path in self._paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._paths = []
+        if self._temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,988 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+
+__base_error_code__ = 160
+
+import logging
+import multiprocessing
+import threading
+import zlib
+from time import time
+
+import numpy as np
+from csrec.dal import DALBase
+from csrec import mem_dal
+from csrec.tools.singleton import Singleton
+from csrec.tools.observable import observable
+from csrec.tools.rwlock import read_locked, write_locked
+from csrec.tools.idmap import IdMap
+
+from csrec.exceptions import *
+
+# tables of the mem datastore: name in the serialized data -> attribute of mem_dal.Database
+TABLES = (('items', 'items_tbl'), ('users_ratings', 'users_ratings_tbl'), ('items_ratings', 'items_ratings_tbl'),
+          ('users_times', 'users_times_tbl'), ('user_social', 'users_social_tbl'), ('info_used', 'info_used'),
+          ('tot_categories_user_ratings', 'tot_categories_user_ratings'),
+          ('n_categories_user_ratings', 'n_categories_user_ratings'),
+          ('tot_categories_item_ratings', 'tot_categories_item_ratings'),
+          ('n_categories_item_ratings', 'n_categories_item_ratings'))
+USER_TABLES = ('users_ratings', 'users_times', 'user_social', 'tot_categories_user_ratings',
+               'n_categories_user_ratings')
+
+
+# Functions executed by the shards on their mem datastore, in the process of the shard
+
+
+def _shard_insert_item_action(db, *args):
+    db.insert_item_action(*args)
+    return db.info_used
+
+
+def _shard_insert_item_actions_bulk(db, *args):
+    db.insert_item_actions_bulk(*args)
+    return db.info_used
+
+
+def _shard_is_rated(db, user_id):
+    return user_id in db.users_ratings_tbl
+
+
+def _shard_item_actions_arrays(db, user_id, users_start, items_start, timestamps=False):
+    arrays = db.get_item_actions_arrays(user_id=user_id, timestamps=timestamps)
+    return arrays + (db.users_map.keys()[users_start:], db.items_map.keys()[items_start:])
+
+
+def _shard_categories_arrays(db, info, user_id, users_start, values_start):
+    users, values, tot, n = db.get_categories_user_ratings_arrays(info, user_id=user_id)
+    return (users, values, tot, n, db.users_map.keys()[users_start:],
+            db.get_category_values_map(info).keys()[values_start:])
+
+
+def _shard_tables(db, copy=False):
+    source = db._freeze() if copy else db
+    return dict((name, getattr(source, attribute)) for name, attribute in TABLES)
+
+
+def _shard_load(db, tables, users_keys, items_keys, categories_keys):
+    for name, attribute in TABLES:
+        setattr(db, attribute, tables[name])
+    # each shard changes its own copy of the attributes of the items
+    db.items_tbl = dict((item_id, dict(attributes)) for item_id, attributes in tables['items'].items())
+    db._restore_maps(users_keys, items_keys, categories_keys)
+
+
+def _shard_export_user(db, user_id):
+    """
+    :return: the ratings, their timestamps, the social actions and the ratings on the categories of a user,
+        which is removed
+    """
+    ratings = dict(db.users_ratings_tbl[user_id])
+    times = dict(db.users_times_tbl.get(user_id, {}))
+    social = dict(db.users_social_tbl.get(user_id, {}))
+    categories = {}
+    for info in db.info_used:
+        tot = db.tot_categories_user_ratings.get(info, {}).get(user_id)
+        if tot:
+            categories[info] = (dict(tot), dict(db.n_categories_user_ratings[info][user_id]))
+    db.remove_user(user_id)
+    return ratings, times, social, categories
+
+
+def _shard_import_user(db, user_id, data):
+    """
+    merge the data of another user, exported by _shard_export_user, as mem_dal.Database.reconcile_user
+    """
+    ratings, times, social, categories = data
+    user_id = db._user_key(user_id, intern=True)
+    db.users_ratings_tbl.setdefault(user_id, {}).update(ratings)
+    db.users_times_tbl.setdefault(user_id, {}).update(times)
+    for item_id, code in ratings.items():
+        db.items_ratings_tbl.setdefault(item_id, {})[user_id] = code
+    social.update(db.users_social_tbl.get(user_id, {}))
+    db.users_social_tbl[user_id] = social
+    for info, (tot, n) in categories.items():
+        db.info_used.add(info)
+        db.categories_maps.setdefault(info, IdMap()).intern_many(tot)
+        for user_table, item_table, counts in ((db.tot_categories_user_ratings, db.tot_categories_item_ratings, tot),
+                                               (db.n_categories_user_ratings, db.n_categories_item_ratings, n)):
+            user_values = user_table.setdefault(info, {}).setdefault(user_id, {})
+            for value, count in counts.items():
+                user_values[value] = user_values.get(value, 0) + count
+                value_users = item_table.setdefault(info, {}).setdefault(value, {})
+                value_users[user_id] = value_users.get(user_id, 0) + count
+
+
+def _call(db, function, args, kwargs):
+    try:
+        if callable(function):
+            return True, function(db, *args, **kwargs)
+        return True, getattr(db, function)(*args, **kwargs)
+    except Exception as e:
+        return False, e
+
+
+def _serve(connection):
+    """
+    loop of the process of a shard: execute the requests (function, args, kwargs) on a mem datastore
+    """
+    db = mem_dal.Database()
+    db.init()
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        ok, value = _call(db, *request)
+        try:
+            connection.send((ok, value))
+        except Exception as e:  # e.g. an exception which cannot be pickled
+            connection.send((False, GetException("%s: %s" % (type(value).__name__, e))))
+    connection.close()
+
+
+class _LocalShard(object):
+    """
+    shard on a mem datastore in the process of the caller
+    """
+    def __init__(self):
+        self.db = mem_dal.Database()
+        self.db.init()
+        self.lock = threading.Lock()
+        self._result = None
+
+    def send(self, function, *args, **kwargs):
+        self._result = _call(self.db, function, args, kwargs)
+
+    def receive(self):
+        ok, value = self._result
+        self._result = None
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        pass
+
+
+class _ProcessShard(_LocalShard):
+    """
+    shard on a mem datastore in a child process, the requests are sent through a pipe
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child,), name="csrec-shard")
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def send(self, function, *args, **kwargs):
+        self.connection.send((function, args, kwargs))
+
+    def receive(self):
+        ok, value = self.connection.recv()
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        self.connection.send(None)
+        self.process.join()
+
+
+class Database(DALBase, Singleton):
+    """
+    Datastore partitioned by user id on many mem datastores (shards): the actions of each user, and the
+    operations on a user, are on a single shard, the requests on all the users are sent to all the shards
+    and their results merged (scatter/gather). With processes=True each shard runs in its own process,
+    so that the shards work in parallel, e.g. on the actions of a bulk insert.
+    The items are copied on every shard. The indices of users, items and values of the categories
+    are assigned by this datastore and the indices of the shards are translated.
+    """
+    def __init__(self):
+        DALBase.__init__(self)
+
+        self.__params_dictionary = {}  # abstraction layer initialization parameters
+        self._shards = []
+        self._translations_lock = threading.Lock()
+        self._translations = []  # for each shard: name of the map -> array of indices, shard index -> index
+
+        self.items = set()  # ids of the items in the datastore
+        self.info_used = set()
+        self.users_map = IdMap()
+        self.items_map = IdMap()
+        self.categories_maps = {}  # category -> IdMap of the values
+
+    def init(self, **params):
+        if not params:
+            params = {}
+        try:
+            self.__params_dictionary.update(params)
+            n_shards = int(params.get('shards', 4))
+            if n_shards < 1:
+                raise BadParametersException("the number of shards must be at least 1")
+            shard_class = _ProcessShard if params.get('processes', False) else _LocalShard
+            self.close()
+            self._shards = [shard_class() for _ in range(n_shards)]
+            self._translations = [{} for _ in self._shards]
+        except Exception as e:
+            e_message = "error during initialization"
+            raise InitializationException(e_message + " : " + str(e))
+
+    @staticmethod
+    def get_init_parameters_description():
+        param_description = {
+            "shards": "the number of shards, default 4",
+            "processes": "if True each shard runs in its own process, default False",
+        }
+        return param_description
+
+    def close(self):
+        """
+        stop the processes of the shards
+        """
+        for shard in self._shards:
+            shard.close()
+        self._shards = []
+
+    @staticmethod
+    def _user_key(user_id):
+        """
+        user ids are stored as strings without dots, as in the mem datastore
+        """
+        return str(user_id).replace('.', '')
+
+    def _shard_number(self, user_key):
+        # crc32, unlike hash(), is the same in every process
+        return (zlib.crc32(user_key.encode('utf-8')) & 0xffffffff) % len(self._shards)
+
+    def _shard(self, user_key):
+        return self._shards[self._shard_number(user_key)]
+
+    def _scatter(self, requests):
+        """
+        send the requests to the shards and wait for all the results
+
+        :param requests: a list of (shard, function, args) where function is a method of the mem datastore
+            or a function called with the datastore as first argument
+        :return: the list of the results
+        """
+        shards = sorted(set(shard for shard, _, _ in requests), key=self._shards.index)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            for shard, function, args in requests:
+                shard.send(function, *args)
+            results = []
+            error = None
+            for shard, _, _ in requests:
+                try:
+                    results.append(shard.receive())
+                except Exception as e:
+                    error = error or e
+                    results.append(None)
+        finally:
+            for shard in shards:
+                shard.lock.release()
+        if error is not None:
+            raise error
+        return results
+
+    def _broadcast(self, function, *args):
+        return self._scatter([(shard, function, args) for shard in self._shards])
+
+    def _call(self, shard, function, *args):
+        return self._scatter([(shard, function, args)])[0]
+
+    @write_locked
+    @observable
+    def insert_item(self, item_id, attributes=None):
+        """
+        insert a new item on datastore, if the item already exists replace it
+
+        exception: raise an InsertException if any error occur
+
+        :param item_id: item id
+        :param attributes: a dictionary with item attributes e.g.
+            {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+        """
+        self.items_map.intern(item_id)
+        self._broadcast('insert_item', item_id, attributes)
+        self.items.add(item_id)
+        return True
+
+    @write_locked
+    @observable
+    def insert_items_bulk(self, items):
+        """
+        insert many items at once, same as calling insert_item for each item but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param items: a dictionary {item_id: attributes}, an iterable of (item_id, attributes) pairs
+            or a pandas DataFrame indexed by item id with one column for each attribute
+        :return: the list of the inserted item ids
+        """
+        if hasattr(items, 'columns'):  # DataFrame
+            items = items.to_dict('index')
+        if hasattr(items, 'items'):
+            items = items.items()
+        items = list(items)
+        item_ids = self._broadcast('insert_items_bulk', items)[0]
+        self.items_map.intern_many(item_ids)
+        self.items.update(item_ids)
+        return item_ids
+
+    @write_locked
+    @observable
+    def remove_item(self, item_id=None):
+        """
+        remove an item from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param item_id: the item id to delete, if None remove all items
+        """
+        self._broadcast('remove_item', item_id)
+        if item_id is not None:
+            self.items.discard(item_id)
+        else:
+            self.items.clear()
+
+    @read_locked
+    def get_items(self, item_id=None):
+        """
+        get a dictionary of items
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: the item id to get, if None get all items
+        :return: a dictionary with one or more items:
+            item_id0 : {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+            ...
+
+            None is the value of the item if it was not found
+        """
+        return self._call(self._shards[0], 'get_items', item_id)
+
+    def get_items_iterator(self):
+        """
+        an iterator on items
+
+        :return: an iterator on (item_id, attributes)
+        """
+        return iter(self.get_items().items())
+
+    @write_locked
+    @observable
+    def insert_social_action(self, user_id, user_id_to, code=3.0):
+        """
+        insert a new user id on datastore, for each user a list of actions will be maintained:
+            user0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        :param code: the code, default value is 3.0
+        """
+        self._call(self._shard(self._user_key(user_id)), 'insert_social_action', user_id, user_id_to, code)
+
+    @write_locked
+    @observable
+    def remove_social_action(self, user_id, user_id_to):
+        """
+        remove a social action from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        """
+        self._call(self._shard(self._user_key(user_id)), 'remove_social_action', user_id, user_id_to)
+
+    @read_locked
+    def get_social_actions(self, user_id=None):
+        """
+        get the social actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None, return all social actions
+        :return: a dictionary social actions performed BY users:
+            user0: { 'user_1':3.0, ..., 'user_M':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_M':5.0}
+        """
+        if user_id is not None:
+            return self._call(self._shard(self._user_key(user_id)), 'get_social_actions', user_id)
+        social_actions = {}
+        for shard_social_actions in self._broadcast('get_social_actions'):
+            social_actions.update(shard_social_actions)
+        return social_actions
+
+    @write_locked
+    @observable
+    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False,
+                           timestamp=None):
+        """
+        insert a new item code on datastore, for each user a list of ratings will be maintained:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :param code: the code, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the item, be considered
+        :param timestamp: the time of the action in seconds since the epoch, if None the current time
+        :return: the timestamp of the action
+        """
+        if timestamp is None:
+            timestamp = time()
+        user_key = self._user_key(user_id)
+        self.users_map.intern(user_key)
+        if item_id not in self.items:
+            self.insert_item(item_id=item_id)
+        info_used = self._call(self._shard(user_key), _shard_insert_item_action,
+                               user_id, item_id, code, item_meaningful_info, only_info, timestamp)
+        self.info_used.update(info_used)
+        return timestamp
+
+    @write_locked
+    @observable
+    def insert_item_actions_bulk(self, actions, code=3.0, item_meaningful_info=None, only_info=False,
+                                 timestamp=None):
+        """
+        insert many item actions at once, the actions of each shard are inserted in parallel if the shards
+        run in their own processes. Same as calling insert_item_action for each action but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param actions: an iterable of (user_id, item_id), (user_id, item_id, code) or
+            (user_id, item_id, code, timestamp) tuples, a dictionary of arrays
+            {"user_id": [...], "item_id": [...], "code": [...], "timestamp": [...]} or a pandas DataFrame with
+            the same columns, "code" and "timestamp" are optional
+        :param code: the code of the actions without one, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the items, be considered
+        :param timestamp: the time of the actions without one, in seconds since the epoch,
+            if None the current time
+        :return: a tuple (users, timestamps) with the list of the users whose actions have been inserted
+            and the list of the timestamps of the actions, in their order, e.g. to log them
+        """
+        # the actions of all the shards get the same timestamp
+        users, items, codes, timestamps = self._actions_columns(actions, code, timestamp)
+        # the items which do not exist are inserted, without attributes, on every shard
+        missing = []
+        for item_id in items:
+            if item_id not in self.items:
+                self.items.add(item_id)
+                missing.append(item_id)
+        if missing:
+            self.items_map.intern_many(missing)
+            self._broadcast('insert_items_bulk', [(item_id, {}) for item_id in missing])
+
+        users_keys = {}  # user id -> normalized user id
+        inserted_users = []
+        inserted_users_set = set()
+        shards_actions = {}  # shard -> columns of its actions
+        for user_id, item_id, code, timestamp in zip(users, items, codes, timestamps):
+            user_key = users_keys.get(user_id)
+            if user_key is None:
+                user_key = users_keys[user_id] = self._user_key(user_id)
+                if user_key not in inserted_users_set:
+                    inserted_users_set.add(user_key)
+                    inserted_users.append(user_key)
+            columns = shards_actions.setdefault(self._shard(user_key), ([], [], [], []))
+            columns[0].append(user_id)
+            columns[1].append(item_id)
+            columns[2].append(code)
+            columns[3].append(timestamp)
+        self.users_map.intern_many(inserted_users)
+
+        requests = []
+        for shard, columns in shards_actions.items():
+            requests.append((shard, _shard_insert_item_actions_bulk,
+                             (dict(zip(('user_id', 'item_id', 'code', 'timestamp'), columns)), code,
+                              item_meaningful_info, only_info)))
+        for info_used in self._scatter(requests):
+            self.info_used.update(info_used)
+        return inserted_users, timestamps
+
+    @write_locked
+    @observable
+    def remove_item_action(self, user_id, item_id):
+        """
+        remove a rating made by a user from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :return: True if the operation was successfully executed or it does not exists, otherwise return False
+        """
+        return self._call(self._shard(self._user_key(user_id)), 'remove_item_action', user_id, item_id)
+
+    @read_locked
+    def get_item_actions(self, user_id=None):
+        """
+        get a dictionary with user's actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :return: a dictionary with all ratings:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        if user_id is not None:
+            return self._call(self._shard(self._user_key(user_id)), 'get_item_actions', user_id)
+        item_actions = {}
+        for shard_item_actions in self._broadcast('get_item_actions'):
+            item_actions.update(shard_item_actions)
+        return item_actions
+
+    def get_item_actions_iterator(self):
+        """
+        get an iterator on item actions
+
+        exception: raise a GetException if any error occur
+
+        :return: an iterator on item ratings for each user:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        for shard in self._shards:
+            for user_id, actions in self._call(shard, 'get_item_actions').items():
+                yield user_id, actions
+
+    @read_locked
+    def get_item_ratings(self, item_id=None):
+        """
+        get ratings on items made by users
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: an item id, if None returns the ratings for all items
+        :return: a dictionary with ratings for each item
+            item0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            itemN: { 'user_0':3.0, ..., 'user_N':5.0}
+        """
+        item_ratings = {}
+        for shard_item_ratings in self._broadcast('get_item_ratings', item_id):
+            for item, users_ratings in shard_item_ratings.items():
+                item_ratings.setdefault(item, {}).update(users_ratings)
+        return item_ratings
+
+    @read_locked
+    def get_info_used(self):
+        """
+        get the categories used
+
+        exception: raise a GetException if any error occur
+
+        :return: a set with the name of categories used
+        """
+        return self.info_used
+
+    @write_locked
+    def set_info_used(self, info_used):
+        """
+        insert a new category
+
+        exception: raise an InsertException if any error occur
+
+        :param info_used: the new category to use
+        """
+        self._broadcast('set_info_used', info_used)
+        self.info_used.add(info_used)
+
+    @write_locked
+    def remove_info_used(self, info_used=None):
+        """
+        remove a category from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param info_used: the category to be deleted, if None, reset all categories
+        """
+        self._broadcast('remove_info_used', info_used)
+        if info_used:
+            self.info_used.discard(info_used)
+        else:
+            self.info_used.clear()
+
+    @write_locked
+    @observable
+    def remove_user(self, user_id):
+        """
+        remove all the actions of a user, only the shard of the user is changed
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param user_id: user id, raise an error if does not exists
+        """
+        self._call(self._shard(self._user_key(user_id)), 'remove_user', user_id)
+
+    @write_locked
+    @observable
+    def reconcile_user(self, old_user_id, new_user_id):
+        """
+        merge two users under the new user id, old user id will be removed
+        for each item rated more than once, those rated by new_user_id will be kept.
+        If the users are on different shards the data of the old user is moved to the shard of the new one
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param old_user_id: old user id, raise an error if does not exists
+        :param new_user_id: new user id, raise an error if does not exists
+        """
+        old_user_id = self._user_key(old_user_id)
+        new_user_id = self._user_key(new_user_id)
+        old_shard = self._shard(old_user_id)
+        new_shard = self._shard(new_user_id)
+        if old_shard is new_shard:
+            self._call(old_shard, 'reconcile_user', old_user_id, new_user_id)
+            return
+
+        old_rated, new_rated = self._scatter([(old_shard, _shard_is_rated, (old_user_id,)),
+                                              (new_shard, _shard_is_rated, (new_user_id,))])
+        if not old_rated:
+            e_message = "unable to reconcile old user id does not exists: %s" % str(old_user_id)
+            raise MergeEntitiesException(e_message)
+        if not new_rated:
+            e_message = "unable to reconcile new user id does not exists: %s" % str(new_user_id)
+            raise MergeEntitiesException(e_message)
+        data = self._call(old_shard, _shard_export_user, old_user_id)
+        self._call(new_shard, _shard_import_user, new_user_id, data)
+
+    @read_locked
+    def get_user_count(self):
+        """
+        get the number of users who rated items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of users
+        """
+        return sum(self._broadcast('get_user_count'))
+
+    @read_locked
+    def get_items_count(self):
+        """
+        get the number of items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of items
+        """
+        return len(self.items)
+
+    @read_locked
+    def get_social_count(self):
+        """
+        Get the number of social actions
+        :return: number of social actions
+        """
+        return sum(self._broadcast('get_social_count'))
+
+    def get_social_iterator(self):
+        for user, actions in self.get_social_actions().items():
+            yield {user: actions}
+
+    @write_locked
+    @observable
+    def reset(self):
+        """
+        reset all data into the datastore
+
+        exception: raise a DeleteException if any error occur
+        """
+        self._broadcast('reset')
+        self.items.clear()
+        self.info_used.clear()
+        self.users_map.clear()
+        self.items_map.clear()
+        self.categories_maps.clear()
+        self._translations = [{} for _ in self._shards]
+
+    @read_locked
+    def get_user_index(self, user_id):
+        """
+        get the integer index of a user
+
+        :param user_id: user id
+        :return: the index of the user, None if the user has never rated an item
+        """
+        return self.users_map.index(self._user_key(user_id))
+
+    @read_locked
+    def get_item_index(self, item_id):
+        """
+        get the integer index of an item
+
+        :param item_id: item id
+        :return: the index of the item, None if the item does not exists
+        """
+        return self.items_map.index(item_id)
+
+    def get_users_map(self):
+        """
+        :return: the IdMap between user ids and integer indices
+        """
+        return self.users_map
+
+    def get_items_map(self):
+        """
+        :return: the IdMap between item ids and integer indices
+        """
+        return self.items_map
+
+    def get_category_values_map(self, info):
+        """
+        :param info: the category e.g. "author"
+        :return: the IdMap between the values of the category and integer indices
+        """
+        return self.categories_maps.setdefault(info, IdMap())
+
+    def _shards_of(self, user_id):
+        return self._shards if user_id is None else [self._shard(self._user_key(user_id))]
+
+    def _translate(self, shard, name, ids_map, new_keys, indices):
+        """
+        :return: the indices of a shard translated in the indices of ids_map, the translations of
+            the indices of each shard are kept and extended with the new keys of the shard
+        """
+        translations = self._translations[self._shards.index(shard)]
+        translation = translations.get(name)
+        if translation is None:
+            translation = np.empty(0, dtype=IdMap.dtype)
+        if new_keys:
+            translation = translations[name] = np.concatenate((translation, ids_map.intern_many(new_keys)))
+        return translation[indices]
+
+    def _translated_length(self, shard, name):
+        translation = self._translations[self._shards.index(shard)].get(name)
+        return 0 if translation is None else len(translation)
+
+    @staticmethod
+    def _concatenate(columns, dtypes):
+        return tuple(np.concatenate(c) if c else np.empty(0, dtype=dtype) for c, dtype in zip(columns, dtypes))
+
+    @read_locked
+    def get_item_actions_arrays(self, user_id=None, timestamps=False):
+        """
+        get the users' actions as coordinates of a sparse matrix users x items, gathered from the shards
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :param timestamps: return the timestamps of the actions too
+        :return: a tuple (users, items, codes) of numpy arrays, users and items are indices
+            of get_users_map() and get_items_map(), (users, items, codes, timestamps) with timestamps
+        """
+        with self._translations_lock:
+            shards = self._shards_of(user_id)
+            results = self._scatter([(shard, _shard_item_actions_arrays,
+                                      (user_id, self._translated_length(shard, 'users'),
+                                       self._translated_length(shard, 'items'), timestamps)) for shard in shards])
+            columns = ([], [], [], [])
+            for shard, result in zip(shards, results):
+                users, items, codes = result[:3]
+                new_users, new_items = result[-2:]
+                columns[0].append(self._translate(shard, 'users', self.users_map, new_users, users))
+                columns[1].append(self._translate(shard, 'items', self.items_map, new_items, items))
+                columns[2].append(codes)
+                if timestamps:
+                    columns[3].append(result[3])
+        dtypes = (IdMap.dtype, IdMap.dtype, np.float64) + ((np.float64,) if timestamps else ())
+        return self._concatenate(columns[:len(dtypes)], dtypes)
+
+    @read_locked
+    def get_categories_user_ratings_arrays(self, info, user_id=None):
+        """
+        get the ratings of users on the values of a category as coordinates of a sparse matrix
+        users x values, gathered from the shards
+
+        exception: raise a GetException if any error occur
+
+        :param info: the category e.g. "author"
+        :param user_id: user id, if None returns the ratings of all users
+        :return: a tuple (users, values, tot, n) of numpy arrays, users and values are indices
+            of get_users_map() and get_category_values_map(info), tot is the sum of ratings
+            and n the number of ratings
+        """
+        values_name = 'values.' + info
+        values_map = self.get_category_values_map(info)
+        with self._translations_lock:
+            shards = self._shards_of(user_id)
+            results = self._scatter([(shard, _shard_categories_arrays,
+                                      (info, user_id, self._translated_length(shard, 'users'),
+                                       self._translated_length(shard, values_name))) for shard in shards])
+            columns = ([], [], [], [])
+            for shard, (users, values, tot, n, new_users, new_values) in zip(shards, results):
+                columns[0].append(self._translate(shard, 'users', self.users_map, new_users, users))
+                columns[1].append(self._translate(shard, values_name, values_map, new_values, values))
+                columns[2].append(tot)
+                columns[3].append(n)
+        return self._concatenate(columns, (IdMap.dtype, IdMap.dtype, np.float64, np.float64))
+
+    def _gather_tables(self, copy=False):
+        """
+        :return: the tables of the shards merged in the tables of a single mem datastore
+        :param copy: copy the tables of the shards in this process, which keep changing
+        """
+        parts = self._broadcast(_shard_tables, copy)
+        tables = {'items': parts[0]['items'], 'info_used': set(self.info_used)}
+        for name in ('users_ratings', 'users_times', 'user_social', 'items_ratings', 'tot_categories_user_ratings',
+                     'n_categories_user_ratings', 'tot_categories_item_ratings', 'n_categories_item_ratings'):
+            tables[name] = {}
+        for part in parts:
+            tables['users_ratings'].update(part['users_ratings'])
+            tables['users_times'].update(part['users_times'])
+            tables['user_social'].update(part['user_social'])
+            for item_id, users_ratings in part['items_ratings'].items():
+                tables['items_ratings'].setdefault(item_id, {}).update(users_ratings)
+            for name in ('tot_categories_user_ratings', 'n_categories_user_ratings'):
+                for info, users_values in part[name].items():
+                    tables[name].setdefault(info, {}).update(users_values)
+            for name in ('tot_categories_item_ratings', 'n_categories_item_ratings'):
+                for info, values_users in part[name].items():
+                    for value, users in values_users.items():
+                        tables[name].setdefault(info, {}).setdefault(value, {}).update(users)
+        return tables
+
+    def _frozen(self, tables, generation):
+        """
+        :return: a mem datastore with the tables, and the indices, of this datastore
+        """
+        frozen = mem_dal.Database()
+        frozen.init()
+        for name, attribute in TABLES:
+            setattr(frozen, attribute, tables[name])
+        frozen._restore_maps(self.users_map.keys(), self.items_map.keys(),
+                             dict((c, m.keys()) for c, m in self.categories_maps.items()))
+        frozen.lock.generation = generation
+        return frozen
+
+    @read_locked
+    @observable
+    def serialize(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file, the file is the same of the mem datastore with the same data
+
+        exception: raise a SerializeException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", see mem_dal.Database.serialize
+        """
+        self._frozen(self._gather_tables(), self.lock.generation)._serialize(filepath, file_format)
+
+    def serialize_background(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file without blocking the other requests while the file is written: the
+        tables are copied from the shards under the read lock, then a background thread writes the copy.
+        When the file has been written the observers of serialize are notified by the background thread,
+        with the generation of the data written (see RWLock) in the generation parameter, if any error
+        occur it is logged and the observers get return_value False
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", see serialize
+        :return: the thread which writes the file, join() waits for the end
+        """
+        with self.lock.reader():
+            frozen = self._frozen(self._gather_tables(copy=True), self.lock.generation)
+
+        def write():
+            try:
+                frozen._serialize(filepath, file_format)
+            except SerializeException as e:
+                logging.getLogger("csrc").error("[serialize_background] %s", e)
+                return_value = False
+            else:
+                return_value = True
+            self.notify('serialize', filepath=filepath, file_format=file_format,
+                        generation=frozen.lock.generation, return_value=return_value)
+
+        worker = threading.Thread(target=write, name="csrec-serialize")
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    @write_locked
+    @observable
+    def restore(self, filepath, file_format=None, mmap=False):
+        """
+        restore the datastore from a file of the mem datastore, the data is partitioned on the shards
+
+        exception: raise a RestoreException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", if None it is detected from the content of the file
+        :param mmap: memory map the arrays of snapshots while they are read
+        """
+        source = mem_dal.Database()
+        source.init()
+        source.restore(filepath, file_format=file_format, mmap=mmap)
+        tables = dict((name, getattr(source, attribute)) for name, attribute in TABLES)
+
+        parts = [{'items': tables['items'], 'items_ratings': {}, 'info_used': set(tables['info_used']),
+                  'tot_categories_item_ratings': {}, 'n_categories_item_ratings': {}} for _ in self._shards]
+        for part in parts:
+            for name in USER_TABLES:
+                part[name] = {}
+        shards_users = [[] for _ in self._shards]
+        for user_id in source.users_map.keys():
+            shards_users[self._shard_number(user_id)].append(user_id)
+        for name in ('users_ratings', 'users_times', 'user_social'):
+            for user_id, row in tables[name].items():
+                parts[self._shard_number(self._user_key(user_id))][name][user_id] = row
+        for item_id, users_ratings in tables['items_ratings'].items():
+            for user_id, code in users_ratings.items():
+                part = parts[self._shard_number(user_id)]
+                part['items_ratings'].setdefault(item_id, {})[user_id] = code
+        for name in ('tot_categories_user_ratings', 'n_categories_user_ratings'):
+            for info, users_values in tables[name].items():
+                for user_id, values in users_values.items():
+                    parts[self._shard_number(user_id)][name].setdefault(info, {})[user_id] = values
+        for name in ('tot_categories_item_ratings', 'n_categories_item_ratings'):
+            for info, values_users in tables[name].items():
+                for value, users in values_users.items():
+                    for user_id, count in users.items():
+                        part = parts[self._shard_number(user_id)]
+                        part[name].setdefault(info, {}).setdefault(value, {})[user_id] = count
+
+        items_keys = source.items_map.keys()
+        categories_keys = dict((c, m.keys()) for c, m in source.categories_maps.items())
+        try:
+            self._scatter([(shard, _shard_load, (part, users, items_keys, categories_keys))
+                           for shard, part, users in zip(self._shards, parts, shards_users)])
+        except Exception as e:
+            e_message = "unable to load data from file: %d" % (__base_error_code__ + 1)
+            raise RestoreException(e_message + " : " + str(e))
+        self.items = set(tables['items'])
+        self.info_used = set(tables['info_used'])
+        self.users_map = source.users_map
+        self.items_map = source.items_map
+        self.categories_maps = source.categories_maps
+        self._translations = [{} for _ in self._shards]
+        self.lock.generation = source.lock.generation
@@ -0,0 +1,1162 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+
+__base_error_code__ = 120
+
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from time import time
+from contextlib import contextmanager
+
+import numpy as np
+from csrec.dal import DALBase
+from csrec import mem_dal
+from csrec.tools.singleton import Singleton
+from csrec.tools.observable import observable
+from csrec.tools.rwlock import read_locked, write_locked
+from csrec.tools.idmap import IdMap
+from csrec.tools import snapshot
+
+from csrec.exceptions import *
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+_replace = getattr(os, 'replace', os.rename)
+
+# The ids of users, items and values of the categories are stored once, with their integer index (see IdMap),
+# the other tables hold only the indices. The tables are clustered on their primary key (WITHOUT ROWID) and
+# the indices are covering, so the rows read together, e.g. the actions of a user, are in the same pages.
+# Ids are stored without type affinity: as in the mem datastore, 1 and "1" are different ids.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (idx INTEGER PRIMARY KEY, id UNIQUE NOT NULL, rated INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS items_ids (idx INTEGER PRIMARY KEY, id UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS items (idx INTEGER PRIMARY KEY, attributes TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ratings (user INTEGER NOT NULL, item INTEGER NOT NULL, code REAL NOT NULL, ts REAL,
+                                    PRIMARY KEY (user, item)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ratings_by_item ON ratings (item, user, code);
+CREATE TABLE IF NOT EXISTS social (user_id NOT NULL, user_id_to NOT NULL, code REAL NOT NULL,
+                                   PRIMARY KEY (user_id, user_id_to)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS info_used (info TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS categories_values (info TEXT NOT NULL, idx INTEGER NOT NULL, value NOT NULL,
+                                              PRIMARY KEY (info, idx), UNIQUE (info, value)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS categories_ratings (info TEXT NOT NULL, user INTEGER NOT NULL, value INTEGER NOT NULL,
+                                               tot INTEGER NOT NULL, n INTEGER NOT NULL,
+                                               PRIMARY KEY (info, user, value)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS categories_ratings_by_value ON categories_ratings (info, value, user, tot, n);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+"""
+TABLES = ('users', 'items_ids', 'items', 'ratings', 'social', 'info_used', 'categories_values',
+          'categories_ratings', 'meta')
+
+# the ratings of a user on the values of a category are summed, see mem_dal.Database.insert_item_action
+UPSERT_CATEGORIES_RATINGS = "INSERT INTO categories_ratings (info, user, value, tot, n) VALUES (?, ?, ?, ?, ?) " \
+                            "ON CONFLICT (info, user, value) DO UPDATE SET tot = tot + excluded.tot, n = n + excluded.n"
+
+SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+class Database(DALBase, Singleton):
+    """
+    Datastore on a SQLite database: the data is on disk and only the indices of the ids (see IdMap)
+    are kept in memory, so the datasets can be larger than the memory.
+    """
+    def __init__(self):
+        DALBase.__init__(self)
+
+        self.__params_dictionary = {}  # abstraction layer initialization parameters
+        self.db_path = None
+        self.connection = None
+        self._transaction_depth = 0
+
+        # integer indices of users, items and categories' values, loaded from the database
+        self.users_map = IdMap()
+        self.items_map = IdMap()
+        self.categories_maps = {}  # category -> IdMap of the values
+        self.info_used = set()
+
+    def init(self, **params):
+        if not params:
+            params = {}
+        try:
+            self.__params_dictionary.update(params)
+            synchronous = str(params.get('synchronous', 'NORMAL')).upper()
+            if synchronous not in SYNCHRONOUS:
+                raise BadParametersException("synchronous must be one of %s" % ", ".join(SYNCHRONOUS))
+            self.db_path = params.get('db_path', ':memory:')
+            # transactions are opened explicitly, see _transaction
+            self.connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA page_size = %d" % int(params.get('page_size', 4096)))
+            if self.db_path != ':memory:':
+                # the readers do not block the writer, e.g. serialize_background
+                self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = %s" % synchronous)
+            self.connection.execute("PRAGMA cache_size = %d" % -int(params.get('cache_size', 65536)))
+            self.connection.executescript(SCHEMA)
+            self._add_timestamps()
+            self._load_maps()
+        except Exception as e:
+            e_message = "error during initialization"
+            raise InitializationException(e_message + " : " + str(e))
+
+    def _add_timestamps(self, timestamp=None):
+        """
+        add the time of the actions to the ratings of a database written by an older version,
+        the actions without a timestamp get the same one
+
+        :param timestamp: the timestamp, if None the current time
+        """
+        columns = [r[1] for r in self.connection.execute("PRAGMA table_info(ratings)")]
+        with self._transaction():
+            if 'ts' not in columns:
+                self.connection.execute("ALTER TABLE ratings ADD COLUMN ts REAL")
+            self.connection.execute("UPDATE ratings SET ts = ? WHERE ts IS NULL",
+                                    (time() if timestamp is None else timestamp,))
+
+    @staticmethod
+    def get_init_parameters_description():
+        param_description = {
+            "db_path": "the path of the database file, created if it does not exist, default :memory:",
+            "cache_size": "size of the page cache in KiB, default 65536",
+            "page_size": "size of the pages of a new database file in bytes, default 4096",
+            "synchronous": "OFF, NORMAL (default), FULL or EXTRA, see the synchronous pragma of SQLite",
+        }
+        return param_description
+
+    @contextmanager
+    def _transaction(self):
+        """
+        the changes made by a method, and by the methods it calls, are committed at once.
+        If any error occur they are rolled back, and the indices are read again from the database
+        """
+        if self._transaction_depth == 0:
+            self.connection.execute("BEGIN")
+        self._transaction_depth += 1
+        try:
+            yield self.connection
+        except Exception:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.connection.execute("ROLLBACK")
+                self._load_maps()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.connection.execute("COMMIT")
+
+    def _load_maps(self, connection=None):
+        # the IdMap objects are shared with the recommender: they are changed in place
+        connection = connection or self.connection
+        self.users_map.clear()
+        self.users_map.intern_many(r[0] for r in connection.execute("SELECT id FROM users ORDER BY idx"))
+        self.items_map.clear()
+        self.items_map.intern_many(r[0] for r in connection.execute("SELECT id FROM items_ids ORDER BY idx"))
+        for values_map in self.categories_maps.values():
+            values_map.clear()
+        for info, value in connection.execute("SELECT info, value FROM categories_values ORDER BY info, idx"):
+            self.categories_maps.setdefault(info, IdMap()).intern(value)
+        self.info_used.clear()
+        self.info_used.update(r[0] for r in connection.execute("SELECT info FROM info_used"))
+
+    def _store_maps(self):
+        """
+        write the ids added to the maps by the readers, e.g. the values of the categories of the items
+        interned by the recommender, so that the indices of the files are the ones of the maps
+        """
+        tables = [("SELECT idx FROM users", (), "INSERT OR IGNORE INTO users (idx, id) VALUES (?, ?)",
+                   self.users_map),
+                  ("SELECT idx FROM items_ids", (), "INSERT OR IGNORE INTO items_ids (idx, id) VALUES (?, ?)",
+                   self.items_map)]
+        for info, values_map in self.categories_maps.items():
+            tables.append(("SELECT idx FROM categories_values WHERE info = ?", (info,),
+                           "INSERT OR IGNORE INTO categories_values (info, idx, value) VALUES (?, ?, ?)",
+                           values_map))
+        for select, params, insert, ids_map in tables:
+            if len(ids_map) == 0:
+                continue
+            stored = set(r[0] for r in self.connection.execute(select, params))
+            keys = ids_map.keys()
+            self.connection.executemany(insert, (params + (i, keys[i]) for i in range(len(keys))
+                                                 if i not in stored))
+
+    @staticmethod
+    def _user_key(user_id):
+        """
+        user ids are stored as strings without dots, as in the mem datastore
+        """
+        return str(user_id).replace('.', '')
+
+    def _intern(self, table, ids_map, key):
+        index = ids_map.index(key)
+        if index is None:
+            index = ids_map.intern(key)
+            self.connection.execute("INSERT INTO %s (idx, id) VALUES (?, ?)" % table, (index, key))
+        return index
+
+    def _intern_many(self, table, ids_map, keys):
+        new = [k for k in set(keys) if k not in ids_map]
+        if new:
+            self.connection.executemany("INSERT INTO %s (idx, id) VALUES (?, ?)" % table,
+                                        [(ids_map.intern(k), k) for k in new])
+
+    def _intern_values(self, info, values):
+        values_map = self.categories_maps.setdefault(info, IdMap())
+        new = [v for v in values if v not in values_map]
+        if new:
+            self.connection.executemany("INSERT OR IGNORE INTO categories_values (info, idx, value) VALUES (?, ?, ?)",
+                                        [(info, values_map.intern(v), v) for v in new])
+        return [values_map.index(v) for v in values]
+
+    def _item(self, index):
+        if index is None:
+            return None
+        row = self.connection.execute("SELECT attributes FROM items WHERE idx = ?", (index,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    @write_locked
+    @observable
+    def insert_item(self, item_id, attributes=None):
+        """
+        insert a new item on datastore, if the item already exists its attributes are updated
+
+        exception: raise an InsertException if any error occur
+
+        :param item_id: item id
+        :param attributes: a dictionary with item attributes e.g.
+            {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+        """
+        try:
+            with self._transaction():
+                index = self._intern('items_ids', self.items_map, item_id)
+                item = {}
+                if attributes is not None:
+                    item = self._item(index) or {}
+                    for k, v in attributes.items():
+                        item[k] = v if isinstance(v, list) else [v]
+                self.connection.execute("INSERT OR REPLACE INTO items (idx, attributes) VALUES (?, ?)",
+                                        (index, json.dumps(item)))
+        except sqlite3.Error as e:
+            e_message = "unable to insert item: %d" % (__base_error_code__ + 1)
+            raise InsertException(e_message + " : " + str(e))
+        return True
+
+    @write_locked
+    @observable
+    def insert_items_bulk(self, items):
+        """
+        insert many items at once in a single transaction, same as calling insert_item for each item but the
+        observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param items: a dictionary {item_id: attributes}, an iterable of (item_id, attributes) pairs
+            or a pandas DataFrame indexed by item id with one column for each attribute
+        :return: the list of the inserted item ids
+        """
+        if hasattr(items, 'columns'):  # DataFrame
+            items = items.to_dict('index')
+        if hasattr(items, 'items'):
+            items = items.items()
+
+        item_ids = []
+        rows = {}  # index -> attributes
+        try:
+            with self._transaction():
+                for item_id, attributes in items:
+                    index = self.items_map.index(item_id)
+                    if index is None:
+                        index = self._intern('items_ids', self.items_map, item_id)
+                        item = rows[index] = {}
+                    else:
+                        item = rows.get(index)
+                        if item is None:
+                            item = rows[index] = self._item(index) or {}
+                    for k, v in (attributes or {}).items():
+                        if v is None or v != v:  # missing values of DataFrames are NaN
+                            continue
+                        item[k] = v if isinstance(v, list) else [v]
+                    item_ids.append(item_id)
+                self.connection.executemany("INSERT OR REPLACE INTO items (idx, attributes) VALUES (?, ?)",
+                                            ((index, json.dumps(item)) for index, item in rows.items()))
+        except sqlite3.Error as e:
+            e_message = "unable to insert items: %d" % (__base_error_code__ + 2)
+            raise InsertException(e_message + " : " + str(e))
+        return item_ids
+
+    @write_locked
+    @observable
+    def remove_item(self, item_id=None):
+        """
+        remove an item from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param item_id: the item id to delete, if None remove all items
+        """
+        try:
+            with self._transaction():
+                if item_id is not None:
+                    index = self.items_map.index(item_id)
+                    if index is not None:
+                        self.connection.execute("DELETE FROM items WHERE idx = ?", (index,))
+                else:
+                    self.connection.execute("DELETE FROM items")
+        except sqlite3.Error as e:
+            e_message = "unable to remove item: %d" % (__base_error_code__ + 3)
+            raise DeleteException(e_message + " : " + str(e))
+
+    @read_locked
+    def get_items(self, item_id=None):
+        """
+        get a dictionary of items
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: the item id to get, if None get all items
+        :return: a dictionary with one or more items:
+            item_id0 : {"author": "AA. VV.",
+                "category":"horror",
+                "subcategory":["splatter", "zombies"],
+                ...
+            }
+            ...
+
+            None is the value of the item if it was not found
+        """
+        if item_id is not None:
+            return {item_id: self._item(self.items_map.index(item_id))}
+        return dict(self.get_items_iterator())
+
+    def get_items_iterator(self):
+        """
+        an iterator on items
+
+        :return: an iterator on (item_id, attributes)
+        """
+        keys = self.items_map.keys()
+        for index, attributes in self.connection.execute("SELECT idx, attributes FROM items").fetchall():
+            yield keys[index], json.loads(attributes)
+
+    @write_locked
+    @observable
+    def insert_social_action(self, user_id, user_id_to, code=3.0):
+        """
+        insert a new user id on datastore, for each user a list of actions will be maintained:
+            user0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        :param code: the code, default value is 3.0
+        """
+        try:
+            with self._transaction():
+                self.connection.execute("INSERT OR REPLACE INTO social (user_id, user_id_to, code) VALUES (?, ?, ?)",
+                                        (user_id, user_id_to, code))
+        except sqlite3.Error as e:
+            e_message = "unable to insert social action: %d" % (__base_error_code__ + 4)
+            raise InsertException(e_message + " : " + str(e))
+
+    @write_locked
+    @observable
+    def remove_social_action(self, user_id, user_id_to):
+        """
+        remove a social action from datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id who make the action
+        :param user_id_to: the user id destination of the action
+        """
+        try:
+            with self._transaction():
+                self.connection.execute("DELETE FROM social WHERE user_id = ? AND user_id_to = ?",
+                                        (user_id, user_id_to))
+        except sqlite3.Error as e:
+            e_message = "unable to remove social action: %d" % (__base_error_code__ + 5)
+            raise DeleteException(e_message + " : " + str(e))
+
+    @read_locked
+    def get_social_actions(self, user_id=None):
+        """
+        get the social actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None, return all social actions
+        :return: a dictionary social actions performed BY users:
+            user0: { 'user_1':3.0, ..., 'user_M':5.0}
+            ...
+            userN: { 'user_0':3.0, ..., 'user_M':5.0}
+        """
+        if user_id is not None:
+            rows = self.connection.execute("SELECT user_id, user_id_to, code FROM social WHERE user_id = ?",
+                                           (user_id,))
+        else:
+            rows = self.connection.execute("SELECT user_id, user_id_to, code FROM social")
+        social_actions = {}
+        for user, user_to, code in rows.fetchall():
+            social_actions.setdefault(user, {})[user_to] = code
+        return social_actions
+
+    @write_locked
+    @observable
+    def insert_item_action(self, user_id, item_id, code=3.0, item_meaningful_info=None, only_info=False,
+                           timestamp=None):
+        """
+        insert a new item code on datastore, for each user a list of ratings will be maintained:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+
+        exception: raise an InsertException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :param code: the code, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the item, be considered
+        :param timestamp: the time of the action in seconds since the epoch, if None the current time
+        :return: the timestamp of the action
+        """
+        if item_meaningful_info is None:
+            item_meaningful_info = []
+        if timestamp is None:
+            timestamp = time()
+        user_id = self._user_key(user_id)
+        try:
+            with self._transaction():
+                user = self._intern('users', self.users_map, user_id)
+                item = self._item(self.items_map.index(item_id))
+                if item is not None:
+                    # the averages of the ratings on the values of the categories, see mem_dal
+                    rows = []
+                    for info in item_meaningful_info:
+                        values = item.get(info)
+                        if values is not None:
+                            self.set_info_used(info)
+                            rows.extend((info, user, value, int(code), 1)
+                                        for value in self._intern_values(info, values))
+                    self.connection.executemany(UPSERT_CATEGORIES_RATINGS, rows)
+                else:
+                    self.insert_item(item_id=item_id)
+                if not only_info:
+                    self.connection.execute("INSERT OR REPLACE INTO ratings (user, item, code, ts) "
+                                            "VALUES (?, ?, ?, ?)", (user, self.items_map.index(item_id), code,
+                                                                    timestamp))
+                    self.connection.execute("UPDATE users SET rated = 1 WHERE idx = ? AND rated = 0", (user,))
+        except sqlite3.Error as e:
+            e_message = "unable to insert item action: %d" % (__base_error_code__ + 6)
+            raise InsertException(e_message + " : " + str(e))
+        return timestamp
+
+    @write_locked
+    @observable
+    def insert_item_actions_bulk(self, actions, code=3.0, item_meaningful_info=None, only_info=False,
+                                 timestamp=None):
+        """
+        insert many item actions at once in a single transaction, same as calling insert_item_action for
+        each action but the observers are notified once
+
+        exception: raise an InsertException if any error occur
+
+        :param actions: an iterable of (user_id, item_id), (user_id, item_id, code) or
+            (user_id, item_id, code, timestamp) tuples, a dictionary of arrays
+            {"user_id": [...], "item_id": [...], "code": [...], "timestamp": [...]} or a pandas DataFrame with
+            the same columns, "code" and "timestamp" are optional
+        :param code: the code of the actions without one, default value is 3.0
+        :param item_meaningful_info: list of info to be considered, e.g. ['Author', 'tags']
+        :param only_info: should only the info, and not the items, be considered
+        :param timestamp: the time of the actions without one, in seconds since the epoch,
+            if None the current time
+        :return: a tuple (users, timestamps) with the list of the users whose actions have been inserted
+            and the list of the timestamps of the actions, in their order, e.g. to log them
+        """
+        if item_meaningful_info is None:
+            item_meaningful_info = []
+        users, items, codes, timestamps = self._actions_columns(actions, code, timestamp)
+        users_keys = {}  # user id -> normalized user id
+        for user_id in users:
+            if user_id not in users_keys:
+                users_keys[user_id] = self._user_key(user_id)
+        inserted_users = []
+        for user_key in users_keys.values():
+            if user_key not in inserted_users:
+                inserted_users.append(user_key)
+
+        try:
+            with self._transaction():
+                self._intern_many('users', self.users_map, inserted_users)
+                # the attributes of the items are read once, the items which do not exist are inserted
+                items_attributes = {}
+                for item_id in set(items):
+                    items_attributes[item_id] = self._item(self.items_map.index(item_id))
+                    if items_attributes[item_id] is None:
+                        index = self._intern('items_ids', self.items_map, item_id)
+                        self.connection.execute("INSERT INTO items (idx, attributes) VALUES (?, '{}')", (index,))
+
+                categories = {}  # (info, user, value) -> [tot, n]
+                ratings = {}  # (user, item) -> (code, timestamp)
+                for user_id, item_id, code, timestamp in zip(users, items, codes, timestamps):
+                    user = self.users_map.index(users_keys[user_id])
+                    item = items_attributes[item_id]
+                    if item is not None:
+                        for info in item_meaningful_info:
+                            values = item.get(info)
+                            if values is None:
+                                continue
+                            self.set_info_used(info)
+                            for value in self._intern_values(info, values):
+                                counters = categories.setdefault((info, user, value), [0, 0])
+                                counters[0] += int(code)
+                                counters[1] += 1
+                    if not only_info:
+                        ratings[user, self.items_map.index(item_id)] = (code, timestamp)
+                self.connection.executemany(UPSERT_CATEGORIES_RATINGS,
+                                            (k + tuple(v) for k, v in categories.items()))
+                self.connection.executemany("INSERT OR REPLACE INTO ratings (user, item, code, ts) "
+                                            "VALUES (?, ?, ?, ?)", (k + v for k, v in ratings.items()))
+                self.connection.executemany("UPDATE users SET rated = 1 WHERE idx = ? AND rated = 0",
+                                            ((u,) for u in set(u for u, _ in ratings)))
+        except sqlite3.Error as e:
+            e_message = "unable to insert item actions: %d" % (__base_error_code__ + 7)
+            raise InsertException(e_message + " : " + str(e))
+        return inserted_users, timestamps
+
+    @write_locked
+    @observable
+    def remove_item_action(self, user_id, item_id):
+        """
+        remove a rating made by a user from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param user_id: user id
+        :param item_id: item id
+        :return: True if the operation was successfully executed or it does not exists, otherwise return False
+        """
+        user = self.users_map.index(self._user_key(user_id))
+        item = self.items_map.index(item_id)
+        if user is None or item is None:
+            return
+        try:
+            with self._transaction():
+                self.connection.execute("DELETE FROM ratings WHERE user = ? AND item = ?", (user, item))
+        except sqlite3.Error as e:
+            e_message = "unable to remove item action: %d" % (__base_error_code__ + 8)
+            raise DeleteException(e_message + " : " + str(e))
+
+    def _ratings(self, rows, rows_keys, columns_keys):
+        table = {}
+        for row, column, code in rows:
+            table.setdefault(rows_keys[row], {})[columns_keys[column]] = code
+        return table
+
+    @read_locked
+    def get_item_actions(self, user_id=None):
+        """
+        get a dictionary with user's actions
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :return: a dictionary with all ratings:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        users = self.users_map.keys()
+        if user_id is not None:
+            user_id = self._user_key(user_id)
+            user = self.users_map.index(user_id)
+            rated = self.connection.execute("SELECT idx FROM users WHERE idx = ? AND rated", (user,)).fetchall()
+            rows = self.connection.execute("SELECT user, item, code FROM ratings WHERE user = ?", (user,))
+        else:
+            rated = self.connection.execute("SELECT idx FROM users WHERE rated").fetchall()
+            rows = self.connection.execute("SELECT user, item, code FROM ratings")
+        item_actions = dict((users[r[0]], {}) for r in rated)
+        item_actions.update(self._ratings(rows.fetchall(), users, self.items_map.keys()))
+        return item_actions
+
+    def get_item_actions_iterator(self):
+        """
+        get an iterator on item actions
+
+        exception: raise a GetException if any error occur
+
+        :return: an iterator on item ratings for each user:
+            user0: { 'item_0':3.0, ..., 'item_N':5.0}
+            ...
+            userN: { 'item_0':3.0, ..., 'item_N':5.0}
+        """
+        users = self.users_map.keys()
+        items = self.items_map.keys()
+        user = None
+        actions = {}
+        # the ratings are clustered by user: the actions of each user are read from the same pages
+        for u, i, code in self.connection.execute("SELECT user, item, code FROM ratings ORDER BY user"):
+            if u != user:
+                if user is not None:
+                    yield users[user], actions
+                user = u
+                actions = {}
+            actions[items[i]] = code
+        if user is not None:
+            yield users[user], actions
+
+    @read_locked
+    def get_item_ratings(self, item_id=None):
+        """
+        get ratings on items made by users
+
+        exception: raise a GetException if any error occur
+
+        :param item_id: an item id, if None returns the ratings for all items
+        :return: a dictionary with ratings for each item
+            item0: { 'user_0':3.0, ..., 'user_N':5.0}
+            ...
+            itemN: { 'user_0':3.0, ..., 'user_N':5.0}
+        """
+        if item_id is not None:
+            rows = self.connection.execute("SELECT item, user, code FROM ratings WHERE item = ?",
+                                           (self.items_map.index(item_id),))
+        else:
+            rows = self.connection.execute("SELECT item, user, code FROM ratings")
+        return self._ratings(rows.fetchall(), self.items_map.keys(), self.users_map.keys())
+
+    @read_locked
+    def get_info_used(self):
+        """
+        get the categories used
+
+        exception: raise a GetException if any error occur
+
+        :return: a set with the name of categories used
+        """
+        return self.info_used
+
+    @write_locked
+    def set_info_used(self, info_used):
+        """
+        insert a new category
+
+        exception: raise an InsertException if any error occur
+
+        :param info_used: the new category to use
+        """
+        if info_used not in self.info_used:
+            with self._transaction():
+                self.connection.execute("INSERT OR IGNORE INTO info_used (info) VALUES (?)", (info_used,))
+            self.info_used.add(info_used)
+
+    @write_locked
+    def remove_info_used(self, info_used=None):
+        """
+        remove a category from the datastore
+
+        exception: raise a DeleteException if any error occur
+
+        :param info_used: the category to be deleted, if None, reset all categories
+        """
+        with self._transaction():
+            if info_used:
+                self.connection.execute("DELETE FROM info_used WHERE info = ?", (info_used,))
+                self.info_used.discard(info_used)
+            else:
+                self.connection.execute("DELETE FROM info_used")
+                self.info_used.clear()
+
+    def _rated_user(self, user_id, e_message):
+        user = self.users_map.index(user_id)
+        if user is None or \
+                self.connection.execute("SELECT rated FROM users WHERE idx = ?", (user,)).fetchone()[0] == 0:
+            raise MergeEntitiesException(e_message + ": %s" % str(user_id))
+        return user
+
+    @write_locked
+    @observable
+    def remove_user(self, user_id):
+        """
+        remove all the actions of a user
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param user_id: user id, raise an error if does not exists
+        """
+        user_id = self._user_key(user_id)
+        user = self._rated_user(user_id, "unable to remove user, id does not exists")
+        with self._transaction():
+            self.connection.execute("DELETE FROM ratings WHERE user = ?", (user,))
+            self.connection.execute("DELETE FROM social WHERE user_id = ?", (user_id,))
+            self.connection.execute("DELETE FROM categories_ratings WHERE user = ?", (user,))
+            self.connection.execute("UPDATE users SET rated = 0 WHERE idx = ?", (user,))
+
+    @write_locked
+    @observable
+    def reconcile_user(self, old_user_id, new_user_id):
+        """
+        merge two users under the new user id, old user id will be removed
+        for each item rated by both users, the rating of old_user_id will be kept as in the mem datastore
+
+        exception: raise a MergeEntitiesException if any error occur
+
+        :param old_user_id: old user id, raise an error if does not exists
+        :param new_user_id: new user id, raise an error if does not exists
+        """
+        old_user_id = self._user_key(old_user_id)
+        new_user_id = self._user_key(new_user_id)
+        old_user = self._rated_user(old_user_id, "unable to reconcile old user id does not exists")
+        new_user = self._rated_user(new_user_id, "unable to reconcile new user id does not exists")
+        if old_user == new_user:
+            e_message = "users to be reconcile are the same: %s" % str(new_user_id)
+            raise MergeEntitiesException(e_message)
+
+        with self._transaction():
+            self.connection.execute("INSERT OR REPLACE INTO ratings (user, item, code, ts) "
+                                    "SELECT ?, item, code, ts FROM ratings WHERE user = ?", (new_user, old_user))
+            self.connection.execute("DELETE FROM ratings WHERE user = ?", (old_user,))
+            # the social actions of the new user are kept
+            self.connection.execute("INSERT OR IGNORE INTO social (user_id, user_id_to, code) "
+                                    "SELECT ?, user_id_to, code FROM social WHERE user_id = ?",
+                                    (new_user_id, old_user_id))
+            self.connection.execute("DELETE FROM social WHERE user_id = ?", (old_user_id,))
+            self.connection.execute("INSERT INTO categories_ratings (info, user, value, tot, n) "
+                                    "SELECT info, ?, value, tot, n FROM categories_ratings WHERE user = ? "
+                                    "ON CONFLICT (info, user, value) DO UPDATE SET tot = tot + excluded.tot, "
+                                    "n = n + excluded.n", (new_user, old_user))
+            self.connection.execute("DELETE FROM categories_ratings WHERE user = ?", (old_user,))
+            self.connection.execute("UPDATE users SET rated = 0 WHERE idx = ?", (old_user,))
+
+    @read_locked
+    def get_user_count(self):
+        """
+        get the number of users who rated items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of users
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM users WHERE rated").fetchone()[0]
+
+    @read_locked
+    def get_items_count(self):
+        """
+        get the number of items
+
+        exception: raise a GetException if any error occur
+
+        :return: the number of items
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    @read_locked
+    def get_social_count(self):
+        """
+        Get the number of social actions
+        :return: number of social actions
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM social").fetchone()[0]
+
+    def get_social_iterator(self):
+        for user, actions in self.get_social_actions().items():
+            yield {user: actions}
+
+    @write_locked
+    @observable
+    def reset(self):
+        """
+        reset all data into the datastore
+
+        exception: raise a DeleteException if any error occur
+        """
+        try:
+            with self._transaction():
+                for table in TABLES:
+                    self.connection.execute("DELETE FROM %s" % table)
+        except sqlite3.Error as e:
+            e_message = "unable to reset the datastore: %d" % (__base_error_code__ + 9)
+            raise DeleteException(e_message + " : " + str(e))
+        self._load_maps()
+
+    @read_locked
+    def get_user_index(self, user_id):
+        """
+        get the integer index of a user
+
+        :param user_id: user id
+        :return: the index of the user, None if the user has never rated an item
+        """
+        return self.users_map.index(self._user_key(user_id))
+
+    @read_locked
+    def get_item_index(self, item_id):
+        """
+        get the integer index of an item
+
+        :param item_id: item id
+        :return: the index of the item, None if the item does not exists
+        """
+        return self.items_map.index(item_id)
+
+    def get_users_map(self):
+        """
+        :return: the IdMap between user ids and integer indices
+        """
+        return self.users_map
+
+    def get_items_map(self):
+        """
+        :return: the IdMap between item ids and integer indices
+        """
+        return self.items_map
+
+    def get_category_values_map(self, info):
+        """
+        :param info: the category e.g. "author"
+        :return: the IdMap between the values of the category and integer indices
+        """
+        return self.categories_maps.setdefault(info, IdMap())
+
+    @staticmethod
+    def _columns(rows, dtypes):
+        if not rows:
+            return tuple(np.empty(0, dtype=dtype) for dtype in dtypes)
+        return tuple(np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes))
+
+    @read_locked
+    def get_item_actions_arrays(self, user_id=None, timestamps=False):
+        """
+        get the users' actions as coordinates of a sparse matrix users x items
+
+        exception: raise a GetException if any error occur
+
+        :param user_id: user id, if None returns actions for all users
+        :param timestamps: return the timestamps of the actions too
+        :return: a tuple (users, items, codes) of numpy arrays, users and items are indices
+            of get_users_map() and get_items_map(), (users, items, codes, timestamps) with timestamps
+        """
+        columns = "user, item, code, ts" if timestamps else "user, item, code"
+        if user_id is not None:
+            rows = self.connection.execute("SELECT %s FROM ratings WHERE user = ?" % columns,
+                                           (self.users_map.index(self._user_key(user_id)),))
+        else:
+            rows = self.connection.execute("SELECT %s FROM ratings" % columns)
+        dtypes = (IdMap.dtype, IdMap.dtype, np.float64) + ((np.float64,) if timestamps else ())
+        return self._columns(rows.fetchall(), dtypes)
+
+    @read_locked
+    def get_categories_user_ratings_arrays(self, info, user_id=None):
+        """
+        get the ratings of users on the values of a category as coordinates of a sparse matrix
+        users x values
+
+        exception: raise a GetException if any error occur
+
+        :param info: the category e.g. "author"
+        :param user_id: user id, if None returns the ratings of all users
+        :return: a tuple (users, values, tot, n) of numpy arrays, users and values are indices
+            of get_users_map() and get_category_values_map(info), tot is the sum of ratings
+            and n the number of ratings
+        """
+        if user_id is not None:
+            rows = self.connection.execute("SELECT user, value, tot, n FROM categories_ratings "
+                                           "WHERE info = ? AND user = ?",
+                                           (info, self.users_map.index(self._user_key(user_id))))
+        else:
+            rows = self.connection.execute("SELECT user, value, tot, n FROM categories_ratings WHERE info = ?",
+                                           (info,))
+        return self._columns(rows.fetchall(), (IdMap.dtype, IdMap.dtype, np.float64, np.float64))
+
+    def _tables(self, connection):
+        """
+        :return: the data of the database in the dictionary serialized by the mem datastore
+        """
+        users = [r[0] for r in connection.execute("SELECT id FROM users ORDER BY idx")]
+        items = [r[0] for r in connection.execute("SELECT id FROM items_ids ORDER BY idx")]
+        data = {'items': dict((items[i], json.loads(a)) for i, a in connection.execute("SELECT idx, attributes "
+                                                                                        "FROM items")),
+                'users_ratings': dict((users[r[0]], {}) for r in connection.execute("SELECT idx FROM users "
+                                                                                    "WHERE rated")),
+                'items_ratings': {},
+                'users_times': {},
+                'user_social': {},
+                'info_used': set(r[0] for r in connection.execute("SELECT info FROM info_used")),
+                'users_map': users,
+                'items_map': items,
+                'categories_maps': {}}
+        for user, item, code, timestamp in connection.execute("SELECT user, item, code, ts FROM ratings"):
+            data['users_ratings'].setdefault(users[user], {})[items[item]] = code
+            data['items_ratings'].setdefault(items[item], {})[users[user]] = code
+            data['users_times'].setdefault(users[user], {})[items[item]] = timestamp
+        for user, user_to, code in connection.execute("SELECT user_id, user_id_to, code FROM social"):
+            data['user_social'].setdefault(user, {})[user_to] = code
+        for info, value in connection.execute("SELECT info, value FROM categories_values ORDER BY info, idx"):
+            data['categories_maps'].setdefault(info, []).append(value)
+        for name in ('tot_categories_user_ratings', 'tot_categories_item_ratings',
+                     'n_categories_user_ratings', 'n_categories_item_ratings'):
+            data[name] = {}
+        for info, user, value, tot, n in connection.execute("SELECT info, user, value, tot, n "
+                                                            "FROM categories_ratings"):
+            user = users[user]
+            value = data['categories_maps'][info][value]
+            data['tot_categories_user_ratings'].setdefault(info, {}).setdefault(user, {})[value] = tot
+            data['n_categories_user_ratings'].setdefault(info, {}).setdefault(user, {})[value] = n
+            data['tot_categories_item_ratings'].setdefault(info, {}).setdefault(value, {})[user] = tot
+            data['n_categories_item_ratings'].setdefault(info, {}).setdefault(value, {})[user] = n
+        return data
+
+    def _write(self, connection, filepath, file_format, generation):
+        if file_format == 'snapshot':
+            data = self._tables(connection)
+            data['generation'] = generation
+            mem_dal.write_tables_snapshot(filepath, data)
+            return
+        # the file is replaced only when complete
+        temporary = filepath + '.tmp'
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        if file_format == 'sqlite':
+            target = sqlite3.connect(temporary)
+            target.executescript(SCHEMA)
+            target.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (generation,))
+            target.commit()
+            target.close()
+            connection.execute("ATTACH DATABASE ? AS target", (temporary,))
+            try:
+                connection.execute("BEGIN")
+                for table in TABLES:
+                    if table != 'meta':
+                        connection.execute("INSERT INTO target.%s SELECT * FROM main.%s" % (table, table))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            finally:
+                connection.execute("DETACH DATABASE target")
+        elif file_format == 'pickle':
+            data = self._tables(connection)
+            data['generation'] = generation
+            with open(temporary, 'wb') as f:
+                pickle.dump(data, f)
+        else:
+            raise BadParametersException("unsupported file format %s, expected pickle, snapshot or sqlite"
+                                         % file_format)
+        _replace(temporary, filepath)
+
+    @read_locked
+    @observable
+    def serialize(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file
+
+        exception: raise a SerializeException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle" or "snapshot", the same files of the mem datastore, so that the data
+            can be moved between the two, or "sqlite", a copy of the database
+        """
+        try:
+            self._store_maps()
+            self._write(self.connection, filepath, file_format, self.lock.generation)
+        except Exception as e:
+            e_message = "unable to serialize data to file: %d" % (__base_error_code__ + 10)
+            raise SerializeException(e_message + " : " + str(e))
+
+    def serialize_background(self, filepath, file_format='pickle'):
+        """
+        dump the datastore on file without blocking the other requests: the file is written by a background
+        thread from a new connection, whose read transaction sees the data of the call while the datastore
+        keeps changing. When the file has been written the observers of serialize are notified by the
+        background thread, with the generation of the data written (see RWLock) in the generation parameter,
+        if any error occur it is logged and the observers get return_value False.
+        With db_path :memory: there is no other connection: the thread holds the lock for reading and
+        the updates wait until the file has been written
+
+        :param filepath: the path of the file
+        :param file_format: "pickle", "snapshot" or "sqlite", see serialize
+        :return: the thread which writes the file, join() waits for the end
+        """
+        with self.lock.reader():
+            generation = self.lock.generation
+            self._store_maps()
+            if self.db_path != ':memory:':
+                connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+                # the snapshot of the data is taken by the first read of the transaction
+                connection.execute("BEGIN")
+                connection.execute("SELECT COUNT(*) FROM info_used").fetchone()
+            else:
+                connection = None
+
+        def write():
+            try:
+                if connection is not None:
+                    try:
+                        if file_format == 'sqlite':
+                            # ATTACH is not allowed in a transaction: the copy is made from the snapshot
+                            # of the transaction of a second connection
+                            self._write_snapshot_copy(connection, filepath, generation)
+                        else:
+                            self._write(connection, filepath, file_format, generation)
+                    finally:
+                        connection.close()
+                else:
+                    with self.lock.reader():
+                        self._write(self.connection, filepath, file_format, generation)
+            except Exception as e:
+                logging.getLogger("csrc").error("[serialize_background] unable to serialize data to file %s: %s",
+                                                filepath, e)
+                return_value = False
+            else:
+                return_value = True
+            self.notify('serialize', filepath=filepath, file_format=file_format,
+                        generation=generation, return_value=return_value)
+
+        worker = threading.Thread(target=write, name="csrec-serialize")
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _write_snapshot_copy(self, connection, filepath, generation):
+        temporary = filepath + '.tmp'
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        target = sqlite3.connect(temporary, isolation_level=None)
+        try:
+            target.executescript(SCHEMA)
+            target.execute("BEGIN")
+            target.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (generation,))
+            for table in TABLES:
+                if table == 'meta':
+                    continue
+                cursor = connection.execute("SELECT * FROM %s" % table)
+                placeholders = ", ".join("?" * len(cursor.description))
+                target.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders), cursor)
+            target.execute("COMMIT")
+        finally:
+            target.close()
+        connection.execute("COMMIT")
+        _replace(temporary, filepath)
+
+    @write_locked
+    @observable
+    def restore(self, filepath, file_format=None, mmap=False):
+        """
+        restore the datastore from file
+
+        exception: raise a RestoreException if any error occur
+
+        :param filepath: the path of the file
+        :param file_format: "pickle", "snapshot" or "sqlite", if None it is detected from the content of the
+            file. Only sqlite files and snapshots should be loaded from untrusted sources
+        :param mmap: memory map the arrays of snapshots while they are copied in the database
+        """
+        try:
+            if file_format is None:
+                with open(filepath, 'rb') as f:
+                    magic = f.read(len(SQLITE_MAGIC))
+                if magic == SQLITE_MAGIC:
+                    file_format = 'sqlite'
+                elif snapshot.is_snapshot(filepath):
+                    file_format = 'snapshot'
+                else:
+                    file_format = 'pickle'
+            if file_format == 'sqlite':
+                self._restore_sqlite(filepath)
+            elif file_format == 'snapshot':
+                self._restore_tables(mem_dal.read_tables_snapshot(filepath, mmap=mmap))
+            elif file_format == 'pickle':
+                with open(filepath, 'rb') as f:
+                    self._restore_tables(pickle.load(f))
+            else:
+                raise BadParametersException("unsupported file format %s, expected pickle, snapshot or sqlite"
+                                             % file_format)
+        except Exception as e:
+            e_message = "unable to load data from file: %d" % (__base_error_code__ + 11)
+            raise RestoreException(e_message + " : " + str(e))
+
+    def _restore_sqlite(self, filepath):
+        self.connection.execute("ATTACH DATABASE ? AS source", (filepath,))
+        try:
+            with self._transaction():
+                for table in TABLES:
+                    # the columns are listed, the ratings of older versions have no timestamp
+                    columns = ", ".join(r[1] for r in self.connection.execute("PRAGMA source.table_info(%s)"
+                                                                              % table))
+                    self.connection.execute("DELETE FROM main.%s" % table)
+                    self.connection.execute("INSERT INTO main.%s (%s) SELECT %s FROM source.%s"
+                                            % (table, columns, columns, table))
+                row = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+                self.connection.execute("DELETE FROM meta WHERE key = 'generation'")
+        finally:
+            self.connection.execute("DETACH DATABASE source")
+        self._add_timestamps()
+        self._load_maps()
+        self.lock.generation = row[0] if row is not None else 0
+
+    def _restore_tables(self, data):
+        """
+        replace the data with the dictionary serialized by the mem datastore
+        """
+        with self._transaction():
+            for table in TABLES:
+                self.connection.execute("DELETE FROM %s" % table)
+            self._load_maps()
+            # the indices of the serialized data are kept and the missing ids are appended
+            users_ratings = data['users_ratings']
+            self._intern_many_ordered('users', self.users_map, data.get('users_map', ()))
+            self._intern_many_ordered('users', self.users_map, users_ratings)
+            self._intern_many_ordered('items_ids', self.items_map, data.get('items_map', ()))
+            self._intern_many_ordered('items_ids', self.items_map, data['items'])
+            self._intern_many_ordered('items_ids', self.items_map, data['items_ratings'])
+            for user_ratings in users_ratings.values():
+                self._intern_many_ordered('items_ids', self.items_map, user_ratings)
+
+            self.connection.executemany("INSERT INTO items (idx, attributes) VALUES (?, ?)",
+                                        ((self.items_map.index(i), json.dumps(a or {}))
+                                         for i, a in data['items'].items()))
+            self.connection.executemany("UPDATE users SET rated = 1 WHERE idx = ?",
+                                        ((self.users_map.index(u),) for u in users_ratings))
+            # the actions without a timestamp, e.g. in files written by older versions, get the current time
+            users_times = data.get('users_times', {})
+            timestamp = time()
+            self.connection.executemany("INSERT INTO ratings (user, item, code, ts) VALUES (?, ?, ?, ?)",
+                                        ((self.users_map.index(u), self.items_map.index(i), c,
+                                          users_times.get(u, {}).get(i, timestamp))
+                                         for u, ratings in users_ratings.items() for i, c in ratings.items()))
+            self.connection.executemany("INSERT INTO social (user_id, user_id_to, code) VALUES (?, ?, ?)",
+                                        ((u, t, c) for u, actions in data['user_social'].items()
+                                         for t, c in actions.items()))
+            self.connection.executemany("INSERT INTO info_used (info) VALUES (?)",
+                                        ((i,) for i in data['info_used']))
+            self.info_used.update(data['info_used'])
+
+            for info, values in data.get('categories_maps', {}).items():
+                self._intern_values(info, values)
+            n_user_ratings = data['n_categories_user_ratings']
+            for info, users_values in data['tot_categories_user_ratings'].items():
+                rows = []
+                for user_id, values in users_values.items():
+                    user = self._intern('users', self.users_map, user_id)
+                    n_values = n_user_ratings.get(info, {}).get(user_id, {})
+                    for value, index in zip(values, self._intern_values(info, list(values))):
+                        rows.append((info, user, index, values[value], n_values.get(value, 0)))
+                self.connection.executemany("INSERT INTO categories_ratings (info, user, value, tot, n) "
+                                            "VALUES (?, ?, ?, ?, ?)", rows)
+        self.lock.generation = data.get('generation', 0)
+
+    def _intern_many_ordered(self, table, ids_map, keys):
+        new = [k for k in keys if k not in ids_map]
+        if new:
+            self.connection.executemany("INSERT OR IGNORE INTO %s (idx, id) VALUES (?, ?)" % table,
+                                        [(ids_map.intern(k), k) for k in new])
@@ -1,7 +1,87 @@
 __author__ = "Angelo Leto"
 __email__ = "angleto@gmail.com"
 
-import math
+import numpy as np
+from scipy import sparse
+
+from csrec.tools.sparse import top_k_rows
+
+
+def _xlogx(x):
+    """
+    :param x: numpy array of non negative numbers
+    :return: x * log(x) element wise, 0 where x is 0
+    """
+    x = np.asarray(x, dtype=np.float64)
+    return x * np.log(np.where(x > 0, x, 1.0))
+
+
+def shannon_entropy(counts, axis=-1):
+    """
+    calculate the shannon entropy, as sum(p * log(p)), of many arrays of counts at once
+
+    :param counts: numpy array of non negative counts
+    :param axis: the axis of the elements of each array
+    :return: numpy array with the entropy of each array of counts, 0 for the arrays of zeros
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=axis)
+    # sum(k/N * log(k/N)) = (sum(k * log(k)) - N * log(N)) / N
+    return np.where(n > 0, (_xlogx(counts).sum(axis=axis) - _xlogx(n)) / np.where(n > 0, n, 1.0), 0.0)
+
+
+def log_likelihood_ratio(k11, k12, k21, k22):
+    """
+    log likelihood ratio of many 2x2 contingency tables at once, element wise on numpy arrays,
+    see http://tdunning.blogspot.it/2008/03/surprise-and-coincidence.html
+
+    :param k11: number of events with A and B, e.g. users who rated both items
+    :param k12: number of events with A and not B
+    :param k21: number of events with B and not A
+    :param k22: number of events without A and B
+    :return: numpy array with the log likelihood ratio of each table, 0 for the tables of zeros
+    """
+    k11, k12, k21, k22 = (np.asarray(k, dtype=np.float64) for k in (k11, k12, k21, k22))
+    # 2 * N * (H(k) - H(rows) - H(columns)), with the counts instead of the probabilities
+    matrix_entropy = _xlogx(k11) + _xlogx(k12) + _xlogx(k21) + _xlogx(k22)
+    rows_entropy = _xlogx(k11 + k12) + _xlogx(k21 + k22)
+    columns_entropy = _xlogx(k11 + k21) + _xlogx(k12 + k22)
+    llr = 2.0 * (matrix_entropy - rows_entropy - columns_entropy + _xlogx(k11 + k12 + k21 + k22))
+    # rounding errors of nearly independent events
+    return np.maximum(llr, 0.0)
+
+
+def llr_similarity(cooccurrence, n_users, max_neighbours=None, min_llr=0.0):
+    """
+    similarity of the keys (e.g. items) from their co-occurrence counts: the log likelihood ratio of the
+    2x2 contingency table of each pair, computed on all the non-zero pairs at once. Only the pairs which
+    co-occur more than expected if they were independent are kept, with at most max_neighbours for each key
+
+    :param cooccurrence: scipy.sparse.csr_matrix keys x keys with the number of users of both keys,
+        the diagonal holds the number of users of each key
+    :param n_users: the number of users
+    :param max_neighbours: number of the most similar keys kept for each key, all if None
+    :param min_llr: minimum log likelihood ratio of the pairs, e.g. 3.84 for a significance of 0.05
+    :return: a scipy.sparse.csr_matrix keys x keys with the log likelihood ratios, without the diagonal
+    """
+    cooccurrence = sparse.csr_matrix(cooccurrence)
+    n = cooccurrence.shape[0]
+    users = cooccurrence.diagonal()
+    rows = np.repeat(np.arange(n), np.diff(cooccurrence.indptr))
+    columns = cooccurrence.indices
+    both = cooccurrence.data
+    # the counts of decayed co-occurrences are not consistent sums, the cells are kept non negative
+    k12 = np.maximum(users[rows] - both, 0.0)
+    k21 = np.maximum(users[columns] - both, 0.0)
+    k22 = np.maximum(n_users - users[rows] - users[columns] + both, 0.0)
+    llr = log_likelihood_ratio(both, k12, k21, k22)
+    keep = (rows != columns) & (both * n_users > users[rows] * users[columns]) & (llr > 0) & (llr >= min_llr)
+    similarity = sparse.csr_matrix((llr[keep], (rows[keep], columns[keep])), shape=(n, n))
+    if max_neighbours is not None:
+        similarity = top_k_rows(similarity, max_neighbours)
+    similarity.sort_indices()
+    return similarity
+
 
 def ShannonEntropy(pArray):
     """
@@ -10,26 +90,12 @@ def ShannonEntropy(pArray):
     :param pArray: array of elements
     :return: the shannon entropy value
     """
-    N = float(sum(pArray))
-    H = 0
-    for i in range(0,len(pArray)):
-        try:
-            H += ( (float(pArray[i])/N) * math.log((float(pArray[i])/N) + (1 if pArray[i] == 0 else 0)) )
-        except:
-            H += 0
-    return H
+    return float(shannon_entropy(pArray))
+
 
 def LogLikelihoodRatio(pKTable):
     """
     :param pKTable: table of 2x2 elements stored in a 4 elements vector, with conditional probability
     :return: the log likelihood ratio, see http://tdunning.blogspot.it/2008/03/surprise-and-coincidence.html
     """
-    try:
-        v = 2 * sum(pKTable) * (ShannonEntropy(pKTable) -
-                                ShannonEntropy([pKTable[0] + pKTable[1], pKTable[2] + pKTable[3]]) -
-                                ShannonEntropy([pKTable[0] + pKTable[2], pKTable[1] + pKTable[3]]))
-    except:
-        v = 0
-    return v
-
-
+    return float(log_likelihood_ratio(*pKTable))
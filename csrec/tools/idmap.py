@@ -0,0 +1,94 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import numpy as np
+
+
+class IdMap(object):
+    """
+    Map between external ids (users, items, values of categories) and dense integer indices.
+    Indices are assigned in order of insertion and never reused, so they are stable for the
+    lifetime of the map and can be used as row/column numbers of sparse matrices.
+    """
+    dtype = np.int32
+
+    def __init__(self, keys=()):
+        self._keys = list(keys)  # index -> key
+        self._index = dict(zip(self._keys, range(len(self._keys))))  # key -> index
+        if len(self._index) != len(self._keys):  # duplicated keys keep the first index
+            keys, self._keys, self._index = self._keys, [], {}
+            for key in keys:
+                self.intern(key)
+
+    def intern(self, key):
+        """
+        get the index of a key, a new index is assigned if the key is not in the map
+
+        :param key: the external id
+        :return: the index of the key
+        """
+        index = self._index.get(key)
+        if index is None:
+            index = len(self._keys)
+            self._index[key] = index
+            self._keys.append(key)
+        return index
+
+    def intern_many(self, keys):
+        """
+        :param keys: an iterable of external ids
+        :return: a numpy array with the indices of the keys
+        """
+        intern = self.intern
+        return np.fromiter((intern(k) for k in keys), dtype=self.dtype)
+
+    def indices(self, keys, count=-1):
+        """
+        :param keys: an iterable of external ids, raise a KeyError if any of them is not in the map
+        :param count: the number of keys, if known
+        :return: a numpy array with the indices of the keys
+        """
+        return np.fromiter(map(self._index.__getitem__, keys), dtype=self.dtype, count=count)
+
+    def index(self, key, default=None):
+        """
+        :param key: the external id
+        :param default: value returned if the key is not in the map
+        :return: the index of the key
+        """
+        return self._index.get(key, default)
+
+    def key(self, index):
+        """
+        :param index: an index
+        :return: the external id with the given index
+        """
+        return self._keys[index]
+
+    def keys(self):
+        """
+        :return: the list of external ids ordered by index
+        """
+        return self._keys
+
+    def copy(self):
+        """
+        :return: a new map with the same indices, which does not change with this one
+        """
+        new = IdMap()
+        new._keys = list(self._keys)
+        new._index = dict(self._index)
+        return new
+
+    def clear(self):
+        self._index.clear()
+        del self._keys[:]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
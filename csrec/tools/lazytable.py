@@ -0,0 +1,133 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import json
+import threading
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
+import numpy as np
+
+
+class EncodedRows(object):
+    """
+    Rows of a table of tables encoded as flat arrays: the row in position p has the elements
+    offsets[p]:offsets[p + 1], each one with the index of the key of its column and its value.
+    """
+    def __init__(self, offsets, columns, data, columns_keys, dtype):
+        """
+        :param offsets: numpy array with the offset of the first element of each row, and the number of elements
+        :param columns: numpy array with the index of the key of the column of each element
+        :param data: numpy array with the value of each element
+        :param columns_keys: list of the keys of the columns by index
+        :param dtype: type of the values of the rows, e.g. float for values stored as small integers
+        """
+        self.offsets = offsets.tolist()
+        self.columns = columns
+        self.data = data
+        self.columns_keys = columns_keys
+        self.dtype = dtype
+
+    def __call__(self, position):
+        """
+        :return: the dictionary {column key: value} of the row in a position
+        """
+        start, end = self.offsets[position], self.offsets[position + 1]
+        keys = self.columns_keys
+        return dict(zip([keys[c] for c in self.columns[start:end].tolist()],
+                        self.data[start:end].astype(self.dtype).tolist()))
+
+
+class EncodedJson(object):
+    """
+    Rows encoded as JSON strings, concatenated: the row in position p is data[offsets[p]:offsets[p + 1]]
+    """
+    def __init__(self, data, offsets):
+        """
+        :param data: numpy array with the UTF-8 bytes of the rows
+        :param offsets: numpy array with the offset of each row, and the length of data
+        """
+        self.data = data.tobytes()
+        self.offsets = offsets.tolist()
+
+    def __call__(self, position):
+        return json.loads(self.data[self.offsets[position]:self.offsets[position + 1]].decode('utf-8'))
+
+
+class LazyTable(MutableMapping):
+    """
+    Table of tables, e.g. the ratings of each user, restored from the arrays of a snapshot: each row is decoded
+    on its first access and then kept as a dictionary, which is changed as the rows of a dictionary of
+    dictionaries. A restore costs the dictionary of the keys of the rows, and the rows which are never read are
+    never decoded. The arrays, e.g. the memory maps of the snapshot, are shared by the copies of the table.
+
+    The rows not decoded yet have not been read or changed since the restore: their elements can be read from
+    the arrays without decoding them, e.g. to build a sparse matrix of the whole table (see encoded_keys).
+    """
+    def __init__(self, keys, positions, decode, coordinates=None):
+        """
+        :param keys: the keys of the rows
+        :param positions: the position of each row, given to decode
+        :param decode: function which returns the row, a dictionary, in a position
+        :param coordinates: a tuple (rows, columns, data) of numpy arrays with the indices of the keys of the row
+            and of the column and the value of each element of the table as restored, or None
+        """
+        self._rows = dict(zip(keys, positions))  # key -> row, or position of the row if not decoded yet
+        self._decode = decode
+        self.coordinates = coordinates
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        row = self._rows[key]
+        if type(row) is int:
+            # the readers decode the rows holding the lock for reading of the datastore, the first one keeps it
+            with self._lock:
+                row = self._rows[key]
+                if type(row) is int:
+                    row = self._rows[key] = self._decode(row)
+        return row
+
+    def __setitem__(self, key, row):
+        self._rows[key] = row
+
+    def __delitem__(self, key):
+        del self._rows[key]
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # pickled as the dictionary of the rows
+        return dict, (list(self.items()),)
+
+    def clear(self):
+        self._rows.clear()
+
+    def encoded_keys(self):
+        """
+        :return: the keys of the rows not decoded yet, their elements are in coordinates as restored
+        """
+        return [key for key, row in self._rows.items() if type(row) is int]
+
+    def copy(self, copy_row=dict):
+        """
+        :param copy_row: function which copies a decoded row
+        :return: a table with the same rows, which does not change with this one
+        """
+        with self._lock:
+            rows = list(self._rows.items())
+        table = LazyTable((), (), self._decode, coordinates=self.coordinates)
+        table._rows = dict((key, row if type(row) is int else copy_row(row)) for key, row in rows)
+        return table
@@ -0,0 +1,176 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import numpy as np
+from scipy import sparse
+
+from csrec.tools.sparse import top_k_rows
+
+# the hash functions are (a * x + b) mod PRIME, the products fit in 64 bits
+PRIME = (1 << 31) - 1
+
+
+def minhash_signatures(matrix, n_hashes=128, seed=0):
+    """
+    MinHash signatures of the rows of a binary matrix: the probability that two rows have the same
+    value of a hash function is the jaccard similarity of their sets of columns.
+    Each hash function reads every non-zero element once, so the cost is n_hashes * nnz
+
+    :param matrix: scipy sparse matrix keys x sets, e.g. items x users, only the non-zero positions are used
+    :param n_hashes: number of hash functions, the length of each signature
+    :param seed: seed of the random hash functions, the signatures are comparable only with the same seed
+    :return: numpy array keys x n_hashes with the signature of each row, PRIME for the empty rows
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    n = matrix.shape[0]
+    random = np.random.RandomState(seed)
+    a = random.randint(1, PRIME, size=n_hashes).astype(np.int64)
+    b = random.randint(0, PRIME, size=n_hashes).astype(np.int64)
+    signatures = np.full((n, n_hashes), PRIME, dtype=np.int64)
+    filled = np.flatnonzero(np.diff(matrix.indptr))
+    if len(filled) == 0:
+        return signatures
+    columns = matrix.indices.astype(np.int64) % PRIME
+    for h in range(n_hashes):
+        hashes = (a[h] * columns + b[h]) % PRIME
+        # the minimum of each non-empty row, the rows are contiguous in the CSR
+        signatures[filled, h] = np.minimum.reduceat(hashes, matrix.indptr[filled])
+    return signatures
+
+
+def _group_pairs(sizes, max_distance=None):
+    """
+    :param sizes: numpy array with the sizes of consecutive groups of elements
+    :param max_distance: each element is paired with at most max_distance following elements of its group,
+        so with at least min(size - 1, max_distance) and at most 2 * max_distance elements. All if None
+    :return: a tuple (first, second) of numpy arrays with the positions of the pairs of elements
+        of the same group, first < second
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    ends = np.repeat(np.cumsum(sizes), sizes)
+    following = ends - np.arange(1, len(ends) + 1)
+    if max_distance is not None:
+        following = np.minimum(following, max_distance)
+    first = np.repeat(np.arange(len(ends)), following)
+    second = np.arange(len(first)) - np.repeat(np.cumsum(following) - following, following) + first + 1
+    return first, second
+
+
+def _group_entries(sources, targets, similarity, members, starts, sizes, max_targets=None):
+    """
+    entries of the similarity matrix from the keys of the groups sources to the keys of the groups targets
+
+    :param sources: numpy array with the indices of the groups of the rows
+    :param targets: numpy array with the indices of the groups of the columns, one for each source
+    :param similarity: numpy array with the similarity of each pair of groups
+    :param members: numpy array with the keys of all the groups, the keys of a group are contiguous
+    :param starts: numpy array with the position of the first key of each group in members
+    :param sizes: numpy array with the number of keys of each group
+    :param max_targets: each key of a source group gets at most max_targets keys of the target group,
+        all if None
+    :return: a tuple (rows, columns, values) of numpy arrays
+    """
+    width = sizes[targets] if max_targets is None else np.minimum(sizes[targets], max_targets)
+    counts = sizes[sources] * width
+    pair = np.repeat(np.arange(len(sources)), counts)
+    offset = np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts)
+    source = offset // width[pair]  # position of the row in its group
+    # the keys of a target group are taken from a different position for each row, so all of them are used
+    target = (source + offset % width[pair]) % sizes[targets][pair]
+    return members[starts[sources][pair] + source], members[starts[targets][pair] + target], similarity[pair]
+
+
+def lsh_candidates(signatures, bands, max_candidates=None, seed=0):
+    """
+    candidate similar pairs by LSH banding: the signatures are split in bands of rows, and the keys with
+    the same values in at least a band are candidates. Two keys with jaccard similarity s are candidates
+    with probability 1 - (1 - s ** r) ** bands, with r = n_hashes / bands
+
+    :param signatures: numpy array keys x n_hashes, see minhash_signatures
+    :param bands: number of bands, it must divide n_hashes
+    :param max_candidates: in each band a key is paired with at most max_candidates keys of its bucket
+        (at most 2 * max_candidates, see _group_pairs), taken in a random order which changes with the band,
+        so the pairs of a large bucket are sampled instead of all listed. All the pairs if None
+    :param seed: seed of the random order of the buckets
+    :return: a tuple (a, b) of numpy arrays with the indices of the pairs of keys, a < b, without duplicates.
+        Empty signatures are never candidates
+    """
+    n, n_hashes = signatures.shape
+    if bands <= 0 or n_hashes % bands:
+        raise ValueError("the number of bands %d must divide the signature length %d" % (bands, n_hashes))
+    rows = n_hashes // bands
+    keys = np.flatnonzero(signatures[:, 0] != PRIME)
+    random = np.random.RandomState(seed)
+    # the values of a band are combined in a single integer, a collision only adds a candidate
+    multipliers = random.randint(1, PRIME, size=rows).astype(np.uint64)
+    pairs = [np.empty(0, dtype=np.int64)]
+    for band in range(bands):
+        block = signatures[keys, band * rows:(band + 1) * rows].astype(np.uint64)
+        buckets = np.unique(block.dot(multipliers), return_inverse=True)[1].ravel()
+        if max_candidates is None:
+            order = np.argsort(buckets, kind='mergesort')
+        else:
+            order = np.lexsort((random.permutation(len(keys)), buckets))
+        sorted_keys = keys[order]
+        first, second = _group_pairs(np.bincount(buckets), max_candidates)
+        first, second = sorted_keys[first], sorted_keys[second]
+        pairs.append(np.minimum(first, second) * n + np.maximum(first, second))
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // n, pairs % n
+
+
+def minhash_similarity(matrix, n_hashes=128, bands=32, max_neighbours=None, seed=0, block_size=100000,
+                       max_candidates=None):
+    """
+    approximate jaccard similarity of the rows of a binary matrix (e.g. items by their users), computed only
+    for the candidate pairs found by LSH banding on the MinHash signatures: the cost is linear in the
+    number of non-zero elements and of candidate pairs, instead of the product of the matrix by itself.
+    The keys with the same signature (e.g. the items of a single user) are a group, and with max_candidates
+    each key gets at most max_candidates keys of its group and of each similar group, so a large group
+    costs its size times max_candidates instead of its size squared
+
+    :param matrix: scipy sparse matrix keys x sets, e.g. items x users
+    :param n_hashes: length of the signatures, the error of the estimated similarity is about 1 / sqrt(n_hashes)
+    :param bands: number of LSH bands, see lsh_candidates: more bands find more pairs with a low similarity
+    :param max_neighbours: number of the most similar keys kept for each key, all if None
+    :param seed: seed of the hash functions
+    :param block_size: number of pairs whose signatures are compared at once
+    :param max_candidates: number of the candidates of a key in each group and LSH bucket, see lsh_candidates,
+        max_neighbours if None, all the candidates if both are None
+    :return: a scipy.sparse.csr_matrix keys x keys with the estimated similarities, without the diagonal,
+        symmetric if all the candidates are used and max_neighbours is None
+    """
+    if max_candidates is None:
+        max_candidates = max_neighbours
+    signatures = minhash_signatures(matrix, n_hashes=n_hashes, seed=seed)
+    n = signatures.shape[0]
+    keys = np.flatnonzero(signatures[:, 0] != PRIME)
+    distinct, group = np.unique(signatures[keys], axis=0, return_inverse=True)
+    group = group.ravel()
+    members = keys[np.argsort(group, kind='mergesort')]
+    sizes = np.bincount(group, minlength=len(distinct))
+    starts = np.cumsum(sizes) - sizes
+    a, b = lsh_candidates(distinct, bands, max_candidates=max_candidates, seed=seed)
+    similarity = np.empty(len(a), dtype=np.float64)
+    for start in range(0, len(a), block_size):
+        end = start + block_size
+        similarity[start:end] = (distinct[a[start:end]] == distinct[b[start:end]]).mean(axis=1)
+    keep = similarity > 0
+    a, b, similarity = a[keep], b[keep], similarity[keep]
+    # the keys of a group are identical for the signatures, the most similar keys of each other
+    first, second = _group_pairs(sizes, max_candidates)
+    rows, columns, values = [members[first], members[second]], [members[second], members[first]], \
+        [np.ones(2 * len(first))]
+    for sources, targets in ((a, b), (b, a)):
+        entries = _group_entries(sources, targets, similarity, members, starts, sizes, max_candidates)
+        rows.append(entries[0])
+        columns.append(entries[1])
+        values.append(entries[2])
+    matrix = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                               shape=(n, n))
+    if max_neighbours is not None:
+        matrix = top_k_rows(matrix, max_neighbours)
+    matrix.sort_indices()
+    return matrix
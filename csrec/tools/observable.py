@@ -2,12 +2,15 @@ __author__ = "elegans.io Ltd"
 __email__ = "info@elegans.io"
 
 import abc
+import inspect
 from functools import wraps
 
 
 def observable(function):
     """
-    observable decorator
+    observable decorator, the observers registered on the function name are called after
+    the function with the function arguments (positional ones are passed by name) and
+    the return value of the function in the return_value parameter
     :param function:
     :return:
     """
@@ -16,14 +19,11 @@ def observable(function):
         return_value = function(*args, **kwargs)
         called_class = args[0]
 
-        try:
-            observers = called_class.observers[function]
-        except KeyError:
-            pass
-        else:
-            for o in observers:
-                kwargs['return_value'] = return_value
-                o(**kwargs)
+        if called_class.observers.get(function.__name__):
+            call_args = inspect.getcallargs(function, *args, **kwargs)
+            del call_args['self']
+            call_args['return_value'] = return_value
+            called_class.notify(function.__name__, **call_args)
         return return_value
     return newf
 
@@ -63,5 +63,16 @@ class Observable(object):
         else:
             return True
 
+    def notify(self, event, **kwargs):
+        """
+        call the observers registered to an event, e.g. when the event completes outside the observed function
+
+        :param event: the name of the observed function
+        :param kwargs: the arguments of the observers
+        :return:
+        """
+        for o in list(self.observers.get(event, ())):
+            o(**kwargs)
+
     def unregister_all(self):
-        self.observers = {}
\ No newline at end of file
+        self.observers = {}
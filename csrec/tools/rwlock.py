@@ -0,0 +1,110 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+class RWLock(object):
+    """
+    Readers/writer lock: many threads can hold the lock for reading at the same time, a single
+    thread can hold it for writing. Waiting writers have the precedence on new readers, so that
+    writes are not starved by a continuous flow of reads.
+
+    The lock is reentrant: a thread can acquire it again for reading or writing while it holds
+    it for writing, and for reading while it holds it for reading. A reader cannot be upgraded
+    to writer.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {}  # thread id -> number of read acquisitions
+        self._writer = None  # thread id of the writer
+        self._writer_count = 0  # number of write acquisitions of the writer
+        self._waiting_writers = 0
+        self.generation = 0  # number of calls of the write_locked methods, i.e. of changes of the data
+
+    def acquire_read(self):
+        me = threading.current_thread().ident
+        with self._condition:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = threading.current_thread().ident
+        with self._condition:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread().ident
+        with self._condition:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("a read lock cannot be upgraded to a write lock")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def release_write(self):
+        with self._condition:
+            self._writer_count -= 1
+            if not self._writer_count:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def reader(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writer(self):
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release_write()
+
+
+def read_locked(function):
+    """
+    decorator for the methods of objects with a lock attribute (RWLock): the method is
+    executed holding the lock for reading
+    """
+    @wraps(function)
+    def newf(self, *args, **kwargs):
+        with self.lock.reader():
+            return function(self, *args, **kwargs)
+    return newf
+
+
+def write_locked(function):
+    """
+    decorator for the methods of objects with a lock attribute (RWLock): the method is
+    executed holding the lock for writing, when applied on top of @observable the observers
+    are called with the lock held. Each call increments the generation of the lock
+    """
+    @wraps(function)
+    def newf(self, *args, **kwargs):
+        with self.lock.writer():
+            self.lock.generation += 1
+            return function(self, *args, **kwargs)
+    return newf
@@ -0,0 +1,168 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# Snapshot file layout:
+#   magic (8 bytes) | version (uint32) | header length (uint32) | header (JSON) | header crc32 (uint32)
+#   followed by the raw data of each array, aligned to ALIGNMENT bytes.
+# The header holds the metadata and, for each array, its name, dtype, shape, offset and crc32.
+MAGIC = b'CSRECSNP'
+VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sII')
+_CRC = struct.Struct('<I')
+_replace = getattr(os, 'replace', os.rename)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def is_snapshot(filepath):
+    """
+    :param filepath: the path of a file
+    :return: True if the file starts with the magic bytes of a snapshot
+    """
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def fingerprint(filepath):
+    """
+    :param filepath: the path of a file
+    :return: a string which identifies the content of the file: for snapshots the checksum of the header,
+        which holds the checksums of the arrays, for any other file the SHA-1 of the content
+    """
+    with open(filepath, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) == _PREFIX.size and prefix[:len(MAGIC)] == MAGIC:
+            _, version, header_length = _PREFIX.unpack(prefix)
+            f.seek(header_length, 1)
+            crc = f.read(_CRC.size)
+            if len(crc) == _CRC.size:
+                return 'snapshot-%d-%08x' % (version, _CRC.unpack(crc)[0])
+            f.seek(0)
+        digest = hashlib.sha1(prefix)
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+        return 'sha1-' + digest.hexdigest()
+
+
+def _padding(position):
+    return (-position) % ALIGNMENT
+
+
+def write_snapshot(filepath, arrays, metadata=None):
+    """
+    write numpy arrays and metadata in a snapshot file
+
+    :param filepath: the path of the file
+    :param arrays: a dictionary {name: numpy array}
+    :param metadata: a JSON serializable dictionary
+    """
+    arrays = [(name, np.ascontiguousarray(a)) for name, a in sorted(arrays.items())]
+    sections = []
+    offset = 0
+    for name, a in arrays:
+        offset += _padding(offset)
+        sections.append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset,
+                         'nbytes': a.nbytes, 'crc32': zlib.crc32(a.data) & 0xffffffff})
+        offset += a.nbytes
+    header = json.dumps({'metadata': metadata or {}, 'arrays': sections}).encode('utf-8')
+
+    # the file is replaced only when complete: readers, and memory maps of the old file, are not affected
+    temporary = filepath + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(_CRC.pack(zlib.crc32(header) & 0xffffffff))
+        start = _PREFIX.size + len(header) + _CRC.size
+        f.write(b'\0' * _padding(start))
+        start += _padding(start)
+        position = 0
+        for (name, a), section in zip(arrays, sections):
+            f.write(b'\0' * (section['offset'] - position))
+            f.write(a.data)
+            position = section['offset'] + a.nbytes
+    _replace(temporary, filepath)
+
+
+def read_snapshot(filepath, mmap=False, verify=True):
+    """
+    read a snapshot file
+
+    exception: raise a SnapshotError if the file is not a snapshot, has an unsupported version or
+    a wrong checksum
+
+    :param filepath: the path of the file
+    :param mmap: if True the arrays are read-only memory maps of the file, instead of copies in memory
+    :param verify: check the checksum of each array, with mmap=True this reads the whole file
+    :return: a tuple (metadata, arrays) where arrays is a dictionary {name: numpy array}
+    """
+    with open(filepath, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise SnapshotError("truncated snapshot")
+        magic, version, header_length = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise SnapshotError("not a snapshot file")
+        if version > VERSION:
+            raise SnapshotError("unsupported snapshot version %d" % version)
+        header = f.read(header_length)
+        crc = f.read(_CRC.size)
+        if len(crc) < _CRC.size or _CRC.unpack(crc)[0] != zlib.crc32(header) & 0xffffffff:
+            raise SnapshotError("corrupted snapshot header")
+        header = json.loads(header.decode('utf-8'))
+        start = _PREFIX.size + header_length + _CRC.size
+        start += _padding(start)
+
+        arrays = {}
+        for section in header['arrays']:
+            dtype = np.dtype(section['dtype'])
+            shape = tuple(section['shape'])
+            if mmap and section['nbytes']:
+                a = np.memmap(filepath, dtype=dtype, mode='r', offset=start + section['offset'], shape=shape)
+            else:
+                f.seek(start + section['offset'])
+                data = f.read(section['nbytes'])
+                if len(data) < section['nbytes']:
+                    raise SnapshotError("truncated snapshot, array %s" % section['name'])
+                a = np.frombuffer(data, dtype=dtype).reshape(shape)
+            if verify and zlib.crc32(np.ascontiguousarray(a).data) & 0xffffffff != section['crc32']:
+                raise SnapshotError("wrong checksum of array %s" % section['name'])
+            arrays[section['name']] = a
+    return header['metadata'], arrays
+
+
+def encode_strings(keys):
+    """
+    encode a list of ids as arrays: the UTF-8 bytes of all the ids and the offsets of each one.
+    Ids which are not all strings are encoded as JSON
+
+    :param keys: a list of ids
+    :return: a tuple (kind, data, offsets) where kind is "str" or "json"
+    """
+    kind = 'str' if all(isinstance(k, str) for k in keys) else 'json'
+    encoded = [(k if kind == 'str' else json.dumps(k)).encode('utf-8') for k in keys]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return kind, np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(kind, data, offsets):
+    """
+    :return: the list of ids encoded by encode_strings
+    """
+    blob = data.tobytes()
+    offsets = offsets.tolist()
+    keys = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+    if kind == 'json':
+        keys = [json.loads(k) for k in keys]
+    return keys
@@ -0,0 +1,97 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+from bisect import bisect_left, insort
+
+
+class SortedList(object):
+    """
+    List of distinct keys kept sorted while keys are added and removed.
+
+    The keys are split in sorted blocks of load to 2 * load keys, and the last key of each block is kept
+    in maxes: a key is found by binary search on maxes and then in its block, so adding or removing a key
+    costs O(log n) comparisons and moves at most 2 * load references, and the first keys are read in order
+    without sorting.
+    """
+    load = 512
+
+    def __init__(self, keys=()):
+        """
+        :param keys: iterable with the initial keys, already sorted and distinct
+        """
+        keys = list(keys)
+        self.blocks = [keys[i:i + self.load] for i in range(0, len(keys), self.load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self._len = len(keys)
+
+    def _split(self, b):
+        block = self.blocks[b]
+        if len(block) > 2 * self.load:
+            self.blocks.insert(b + 1, block[self.load:])
+            del block[self.load:]
+            self.maxes.insert(b, block[-1])
+
+    def add(self, key):
+        """
+        :param key: a key not in the list
+        """
+        blocks, maxes = self.blocks, self.maxes
+        if not maxes:
+            blocks.append([key])
+            maxes.append(key)
+        else:
+            b = bisect_left(maxes, key)
+            if b == len(maxes):  # after the last key
+                b -= 1
+                blocks[b].append(key)
+                maxes[b] = key
+            else:
+                insort(blocks[b], key)
+            self._split(b)
+        self._len += 1
+
+    def remove(self, key):
+        """
+        exception: raise a ValueError if the key is not in the list
+        :param key: a key in the list
+        """
+        blocks, maxes = self.blocks, self.maxes
+        b = bisect_left(maxes, key)
+        block = blocks[b] if b < len(maxes) else []
+        i = bisect_left(block, key)
+        if i == len(block) or block[i] != key:
+            raise ValueError("%r is not in the list" % (key,))
+        del block[i]
+        self._len -= 1
+        if not block:
+            del blocks[b]
+            del maxes[b]
+        elif i == len(block):
+            maxes[b] = block[-1]
+        if 0 < len(block) < self.load // 2 and len(blocks) > 1:
+            # the block is merged with the previous one, the first block with the next one
+            b = max(b, 1)
+            blocks[b - 1].extend(blocks[b])
+            del blocks[b]
+            del maxes[b - 1]
+            self._split(b - 1)
+
+    def head(self, n=None):
+        """
+        :param n: number of keys, all the keys if None
+        :return: list with the first n keys
+        """
+        keys = []
+        for block in self.blocks:
+            if n is not None and len(keys) >= n:
+                break
+            keys.extend(block)
+        return keys if n is None else keys[:n]
+
+    def __iter__(self):
+        for block in self.blocks:
+            for key in block:
+                yield key
+
+    def __len__(self):
+        return self._len
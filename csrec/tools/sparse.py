@@ -0,0 +1,113 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import numpy as np
+from scipy import sparse
+
+
+def csr_from_arrays(rows, columns, data, shape, dtype=np.float64):
+    """
+    build a CSR matrix from lists of arrays of coordinates (COO format)
+
+    :param rows: list of arrays with the rows indices
+    :param columns: list of arrays with the columns indices
+    :param data: list of arrays with the values
+    :param shape: the shape of the matrix
+    :param dtype: the type of the values
+    :return: a scipy.sparse.csr_matrix
+    """
+    if not data:
+        return sparse.csr_matrix(shape, dtype=dtype)
+    matrix = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                               shape=shape, dtype=dtype)
+    return matrix.tocsr()
+
+
+def binarize(matrix):
+    """
+    :param matrix: a scipy sparse matrix
+    :return: a CSR matrix with 1 where matrix is not 0
+    """
+    binary = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    binary.data = (binary.data != 0).astype(np.float64)
+    binary.eliminate_zeros()
+    return binary
+
+
+def csr_vector(indices, data, size, dtype=np.float64):
+    """
+    build a sparse row vector
+
+    :param indices: array with the indices of the non-zero elements
+    :param data: array with the values of the non-zero elements
+    :param size: the length of the vector
+    :param dtype: the type of the values
+    :return: a scipy.sparse.csr_matrix with shape (1, size)
+    """
+    indptr = np.array([0, len(indices)], dtype=np.int64)
+    return sparse.csr_matrix((np.asarray(data, dtype=dtype), np.asarray(indices), indptr), shape=(1, size))
+
+
+def resize_csr(matrix, shape):
+    """
+    :param matrix: a scipy.sparse.csr_matrix
+    :param shape: the new shape, not smaller than the shape of the matrix
+    :return: a csr_matrix with the same elements and the new shape, data and indices are not copied
+    """
+    if matrix.shape == tuple(shape):
+        return matrix
+    indptr = np.empty(shape[0] + 1, dtype=matrix.indptr.dtype)
+    indptr[:len(matrix.indptr)] = matrix.indptr
+    indptr[len(matrix.indptr):] = matrix.indptr[-1]
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape, copy=False)
+
+
+def csr_to_arrays(matrix):
+    """
+    :param matrix: a scipy.sparse.csr_matrix
+    :return: a dictionary with the arrays of the matrix, indices and indptr have the same type
+        so that csr_from_buffers does not copy them
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+    return {'data': matrix.data, 'indices': matrix.indices.astype(index_dtype, copy=False),
+            'indptr': matrix.indptr.astype(index_dtype, copy=False),
+            'shape': np.array(matrix.shape, dtype=np.int64)}
+
+
+def csr_from_buffers(arrays):
+    """
+    :param arrays: a dictionary with the arrays of a matrix, as from csr_to_arrays, e.g. memory mapped
+    :return: a scipy.sparse.csr_matrix using the arrays without copies
+    """
+    shape = tuple(int(n) for n in arrays['shape'])
+    matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def top_k_rows(matrix, k):
+    """
+    keep the k largest elements of each row, ties are taken in order of column
+
+    :param matrix: a scipy sparse matrix
+    :param k: number of elements kept for each row
+    :return: a scipy.sparse.csr_matrix with at most k elements in each row
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    lengths = np.diff(matrix.indptr)
+    if k <= 0 or not matrix.nnz:
+        return sparse.csr_matrix(matrix.shape, dtype=matrix.dtype)
+    if lengths.max() <= k:
+        return matrix
+    rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+    # elements of each row by decreasing value, then their rank in the row
+    order = np.lexsort((-matrix.data, rows))
+    rank = np.empty(matrix.nnz, dtype=np.int64)
+    rank[order] = np.arange(matrix.nnz) - matrix.indptr[rows[order]]
+    keep = rank < k
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(np.minimum(lengths, k), out=indptr[1:])
+    return sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
@@ -0,0 +1,53 @@
+import logging
+import random
+import sys
+import time
+
+import numpy as np
+from csrec import Recommender
+from csrec.tools.minhash import minhash_similarity
+
+# Recall of the similar pairs of items found by MinHash/LSH, against the exact jaccard similarity,
+# for a few numbers of LSH bands with signatures of 128 hashes (or the length given on the command line)
+n_hashes = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+thresholds = (0.2, 0.5, 0.8)
+
+engine = Recommender(log_level=logging.WARNING)
+
+n_books = 20000
+n_users = 20000
+n_purchases = 200000
+
+books = dict((str(b), {}) for b in range(0, n_books + 1))
+engine.db.insert_items_bulk(books)
+
+purchases = []
+while len(purchases) < n_purchases:
+    book_n = np.random.zipf(1.2)
+    user_n = np.random.zipf(1.1)
+    if book_n <= n_books and user_n <= n_users:
+        purchases.append((str(user_n), str(book_n), float(random.randrange(1, 6))))
+engine.db.insert_item_actions_bulk(purchases)
+items_users = engine._items_cooccurrence.users_matrix(len(engine.db.get_users_map())).T.tocsr()
+print("Info: %d actions of %d users on %d items" % (len(purchases), engine.db.get_user_count(),
+                                                    np.count_nonzero(np.diff(items_users.indptr))))
+
+# exact jaccard similarity: |A & B| / (|A| + |B| - |A & B|) from the co-occurrence counts
+start = time.time()
+counts = items_users.dot(items_users.T).tocoo()
+users = np.diff(items_users.indptr)
+keep = counts.row < counts.col
+rows, columns, both = counts.row[keep], counts.col[keep], counts.data[keep]
+exact = both / (users[rows] + users[columns] - both)
+print("Info: exact similarity of %d pairs in %.2fs" % (len(both), time.time() - start))
+
+for bands in [b for b in (8, 16, 32, 64) if n_hashes % b == 0]:
+    start = time.time()
+    approximate = minhash_similarity(items_users, n_hashes=n_hashes, bands=bands)
+    elapsed = time.time() - start
+    found = np.asarray(approximate[rows, columns]).ravel() > 0
+    recall = ", ".join("%.3f (>= %.1f)" % (found[exact >= t].mean() if (exact >= t).any() else 1.0, t)
+                       for t in thresholds)
+    error = np.abs(np.asarray(approximate[rows[found], columns[found]]).ravel() - exact[found]).mean()
+    print("Info: %d bands of %d rows in %.2fs, %d pairs, recall %s, mean error %.3f" %
+          (bands, n_hashes // bands, elapsed, approximate.nnz // 2, recall, error))
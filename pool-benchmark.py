@@ -0,0 +1,55 @@
+import logging
+import math
+import multiprocessing
+import random
+import sys
+import time
+
+import numpy as np
+from csrec import Recommender, ScoringPool
+
+# Throughput of the recommendations computed by a ScoringPool with 1, 2, 4, ... worker processes,
+# up to the number of cores (or the number given on the command line)
+max_processes = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+
+engine = Recommender(log_level=logging.WARNING)
+
+n_books = 20000
+n_users = 20000
+n_purchases = 200000
+n_authors = 500
+authors = ['A' + str(i) for i in range(1, n_authors + 1)]
+
+books = {}
+for b in range(0, n_books + 1):
+    books[str(b)] = {'author': authors[int(math.sqrt(random.randrange(0, n_authors) ** 2))]}
+engine.db.insert_items_bulk(books)
+
+purchases = []
+while len(purchases) < n_purchases:
+    book_n = np.random.zipf(1.2)
+    user_n = np.random.zipf(1.1)
+    if book_n <= n_books and user_n <= n_users:
+        purchases.append((str(user_n), str(book_n), float(random.randrange(1, 6))))
+start = time.time()
+engine.db.insert_item_actions_bulk(purchases, item_meaningful_info=['author'])
+engine.refresh_model()
+print("Info: %d actions of %d users, model built in %.2fs" % (len(purchases), engine.db.get_user_count(),
+                                                             time.time() - start))
+
+users = list(engine.db.get_item_actions().keys())
+start = time.time()
+for user_id in users:
+    engine.get_recommendations(user_id, fast=True)
+single = len(users) / (time.time() - start)
+print("Info: get_recommendations in this process: %.1f users/s" % single)
+
+processes = 1
+while processes <= max_processes:
+    with ScoringPool(engine, processes=processes) as pool:
+        pool.get_recommendations_bulk(users[:processes * 64])  # the workers map the model
+        start = time.time()
+        pool.get_recommendations_bulk(users)
+        throughput = len(users) / (time.time() - start)
+    print("Info: %d processes: %.1f users/s (x%.2f)" % (processes, throughput, throughput / single))
+    processes *= 2
@@ -16,7 +16,7 @@ long_description = open('README.md').read()
 
 def setup_package():
 
-    build_requires = ['numpy', 'pandas']
+    build_requires = ['numpy', 'scipy', 'pandas']
 
     metadata = dict(
         name='csrec',
@@ -64,7 +64,7 @@ def setup_package():
         # You can just specify the packages manually here if your project is
         # simple. Or you can use find_packages().
         #packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
-        packages=['csrec'],
+        packages=['csrec', 'csrec.tools'],
 
         # List run-time dependencies here.  These will be installed by pip when your
         # project is installed. For an analysis of "install_requires" vs pip's
@@ -73,6 +73,11 @@ def setup_package():
         # See also https://github.com/scipy/scipy/blob/master/setup.py (malemi)
         install_requires=build_requires,
 
+        # optional dependencies of the datastores, e.g. pip install csrec[redis]
+        extras_require={
+            'redis': ['redis>=3.5'],
+        },
+
         # List additional groups of dependencies here (e.g. development dependencies).
         # You can install these using the following syntax, for example:
         # $ pip install -e .[dev,test]
@@ -0,0 +1,82 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import copy
+import gc
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from csrec import Recommender
+from csrec.action_log import ActionLog
+
+
+class ActionLogTest(unittest.TestCase):
+    """
+    The changes logged after a snapshot are replayed on recovery, and the log is never left open
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.directory, 'actions.log')
+        self.snapshot_path = os.path.join(self.directory, 'data.snapshot')
+        self.engine = Recommender(log_level=logging.WARNING, dal_params={'log_path': self.log_path})
+        self.engine.db.reset()
+
+    def tearDown(self):
+        self.engine.db.action_log.detach(self.engine.db)
+        self.engine.db.action_log.close()
+        self.engine.db.action_log = None
+        self.engine.db.reset()
+        shutil.rmtree(self.directory)
+
+    def fill(self):
+        db = self.engine.db
+        db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3)}) for i in range(10)))
+        for n in range(30):
+            db.insert_item_action('u%d' % (n % 7), 'i%d' % (n % 10), code=1 + n % 5, item_meaningful_info=['author'])
+
+    def tables(self):
+        db = self.engine.db
+        return copy.deepcopy((db.get_items(), db.get_item_actions(), db.get_item_ratings()))
+
+    def recover(self, snapshot_path):
+        """
+        :return: the number of changes replayed on the reset datastore and the ResourceWarnings raised
+        """
+        db = self.engine.db
+        log = db.action_log
+        log.detach(db)
+        db.reset()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            n = ActionLog(self.log_path).recover(db, snapshot_path)
+            gc.collect()
+        log.attach(db)
+        return n, [w for w in caught if issubclass(w.category, ResourceWarning)]
+
+    def test_recover(self):
+        self.fill()
+        self.engine.db.action_log.compact(self.engine.db, self.snapshot_path)
+        self.engine.db.insert_item_action('u9', 'i1', code=5)
+        self.engine.db.action_log.sync()
+        tables = self.tables()
+        n, resource_warnings = self.recover(self.snapshot_path)
+        self.assertEqual(n, 1)
+        self.assertEqual(resource_warnings, [])
+        self.assertEqual(tables, self.tables())
+
+    def test_different_snapshot(self):
+        # the changes are not read, the log is closed anyway
+        self.fill()
+        self.engine.db.action_log.compact(self.engine.db, self.snapshot_path)
+        n, resource_warnings = self.recover(None)
+        self.assertEqual(n, 0)
+        self.assertEqual(resource_warnings, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import random
+import threading
+import unittest
+
+import numpy as np
+from csrec import Recommender
+
+
+class ConcurrencyTest(unittest.TestCase):
+    """
+    Writers insert actions while readers score users: no update is lost, the tables of the datastore
+    hold every action and the co-occurrence matrices updated on each action are the same of a full rebuild
+    """
+    n_items = 200
+    n_writers = 8
+    n_readers = 6
+    n_actions = 400
+    n_users = 50  # users of each writer, the writers never write the same user
+
+    def setUp(self):
+        self.engine = Recommender(log_level=logging.WARNING)
+        for i in range(self.n_items):
+            self.engine.db.insert_item('i%d' % i, {'author': ['a%d' % (i % 13)]})
+
+    def tearDown(self):
+        self.engine.db.reset()
+
+    def run_threads(self, write, read):
+        errors = []
+        stop = threading.Event()
+
+        def writer(w):
+            try:
+                write(w)
+            except Exception as e:
+                errors.append(e)
+
+        def reader(n):
+            rnd = random.Random(100 + n)
+            try:
+                while not stop.is_set():
+                    read(rnd)
+            except Exception as e:
+                errors.append(e)
+
+        writers = [threading.Thread(target=writer, args=(w,)) for w in range(self.n_writers)]
+        readers = [threading.Thread(target=reader, args=(n,)) for n in range(self.n_readers)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def expected_actions(self, w):
+        """
+        :return: the actions of the writer w as a list of (user_id, item_id, code)
+        """
+        rnd = random.Random(w)
+        return [('w%d_u%d' % (w, k % self.n_users), 'i%d' % rnd.randrange(self.n_items), rnd.randint(1, 5))
+                for k in range(self.n_actions)]
+
+    def read(self, rnd):
+        user_id = 'w%d_u%d' % (rnd.randrange(self.n_writers), rnd.randrange(self.n_users))
+        self.engine.get_recommendations(user_id, fast=True)
+        if rnd.random() < 0.1:
+            self.engine.get_recommendations_bulk(['w0_u%d' % j for j in range(10)], fast=True)
+
+    def assert_consistent(self):
+        engine = self.engine
+        # the last code of each user and item, the actions of a user are written by one thread in order
+        expected = {}
+        for w in range(self.n_writers):
+            for user_id, item_id, code in self.expected_actions(w):
+                expected.setdefault(user_id, {})[item_id] = code
+        self.assertEqual(engine.db.get_item_actions(), expected)
+        self.assertEqual(engine.db.get_user_count(), len(expected))
+        items_ratings = {}
+        for user_id, actions in expected.items():
+            for item_id, code in actions.items():
+                items_ratings.setdefault(item_id, {})[user_id] = code
+        self.assertEqual(engine.db.get_item_ratings(), items_ratings)
+
+        items = engine._items_cooccurrence.tocsr().copy()
+        popularity = engine.get_popular_items()
+        categories = dict((info, c.tocsr().copy()) for info, c in engine._categories_cooccurrence.items())
+        engine._create_cooccurrence()
+        self.assertEqual((items != engine._items_cooccurrence.tocsr()).nnz, 0)
+        self.assertEqual(sorted(categories), sorted(engine._categories_cooccurrence))
+        for info, matrix in categories.items():
+            rebuilt = engine._categories_cooccurrence[info].tocsr()
+            self.assertEqual(matrix.shape, rebuilt.shape)
+            self.assertTrue(np.allclose(matrix.toarray(), rebuilt.toarray()))
+        # ties are ordered by item index, the index updated on each action is the same of the rebuilt one
+        _, rated_items, codes = engine.db.get_item_actions_arrays()
+        sums = np.bincount(rated_items, weights=codes, minlength=len(engine.db.get_items_map()))
+        items_map = engine.db.get_items_map()
+        self.assertEqual(popularity, engine.get_popular_items())
+        self.assertEqual([sums[items_map.index(i)] for i in popularity],
+                         sorted([sums[items_map.index(i)] for i in popularity], reverse=True))
+
+    def test_insert_item_action(self):
+        def write(w):
+            for user_id, item_id, code in self.expected_actions(w):
+                self.engine.db.insert_item_action(user_id, item_id, code=code, item_meaningful_info=['author'])
+
+        self.run_threads(write, self.read)
+        self.assert_consistent()
+
+    def test_insert_item_actions_bulk(self):
+        def write(w):
+            actions = self.expected_actions(w)
+            for start in range(0, len(actions), 50):
+                self.engine.db.insert_item_actions_bulk(actions[start:start + 50], item_meaningful_info=['author'])
+
+        self.run_threads(write, self.read)
+        self.assert_consistent()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import tracemalloc
+import unittest
+
+import numpy as np
+from scipy import sparse
+from csrec.tools.minhash import minhash_similarity
+
+
+class MinHashTest(unittest.TestCase):
+    """
+    The items of a group of identical signatures, or of a large LSH bucket, get a bounded number of candidates
+    """
+    n_items = 3000
+    max_memory = 64 << 20  # all the pairs of the items would take hundreds of MB
+
+    def assert_bounded(self, matrix, k):
+        tracemalloc.start()
+        try:
+            similarity = minhash_similarity(matrix, max_neighbours=k, block_size=1000)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, self.max_memory)
+        self.assertLessEqual(np.diff(similarity.indptr).max(), k)
+        return similarity
+
+    def test_single_user(self):
+        # all the items are rated by the same user, their similarity is 1
+        matrix = sparse.csr_matrix(np.ones((self.n_items, 1)))
+        similarity = self.assert_bounded(matrix, 10)
+        self.assertTrue((np.diff(similarity.indptr) == 10).all())
+        self.assertTrue((similarity.data == 1.0).all())
+        self.assertEqual(similarity.diagonal().sum(), 0)
+
+    def test_common_user(self):
+        # each item has a user of its own and a user common to all, the signatures share many LSH buckets
+        rows = np.repeat(np.arange(self.n_items), 2)
+        columns = np.column_stack([np.zeros(self.n_items, dtype=int), np.arange(1, self.n_items + 1)]).ravel()
+        matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(self.n_items, self.n_items + 1))
+        self.assert_bounded(matrix, 10)
+
+    def test_uncapped(self):
+        rnd = np.random.RandomState(0)
+        dense = (rnd.rand(300, 40) > 0.8).astype(float)
+        dense[:20] = dense[0]
+        matrix = sparse.csr_matrix(dense)
+        similarity = minhash_similarity(matrix)
+        self.assertEqual(abs(similarity - similarity.T).max(), 0)
+        self.assertTrue((similarity[0, 1:20].toarray() == 1.0).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from csrec import Recommender
+from csrec.popularity import DecayedPopularity
+
+
+class PopularityTest(unittest.TestCase):
+    """
+    The popularity index updated on each action is the same of the index built from scratch, whatever
+    built it last: ties are ordered by item index
+    """
+    n_items = 60
+    n_users = 40
+
+    def setUp(self):
+        self.engine = Recommender(log_level=logging.WARNING)
+        self.engine.db.insert_items_bulk(dict(('i%d' % i, {}) for i in range(self.n_items)))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.engine.db.reset()
+        shutil.rmtree(self.directory)
+
+    def actions(self, seed):
+        rnd = random.Random(seed)
+        # few items and codes, so that many items have the same popularity
+        return [('u%d' % rnd.randrange(self.n_users), 'i%d' % rnd.randrange(self.n_items // 3), rnd.randint(1, 3))
+                for _ in range(200)]
+
+    def assert_rebuilt(self):
+        popular_items = self.engine.get_popular_items()
+        self.engine._create_cooccurrence()
+        self.assertEqual(popular_items, self.engine.get_popular_items())
+        return popular_items
+
+    def test_incremental(self):
+        for n, (user_id, item_id, code) in enumerate(self.actions(0)):
+            self.engine.db.insert_item_action(user_id, item_id, code=code)
+            if n % 50 == 0:
+                self.engine.db.remove_item_action('u%d' % (n % self.n_users), 'i%d' % (n % 7))
+        self.engine.db.remove_item('i3')
+        self.engine.db.insert_item('i%d' % self.n_items, {'author': 'a'})
+        self.assert_rebuilt()
+
+    def test_bulk(self):
+        # the first bulk insert rebuilds the index, the others update it
+        self.engine.db.insert_item_actions_bulk(self.actions(1))
+        popular_items = self.assert_rebuilt()
+        self.engine.db.insert_item_actions_bulk([('v%d' % n, 'i%d' % (n % 5), 1) for n in range(3)])
+        self.assertNotEqual(popular_items, self.engine.get_popular_items())
+        self.assert_rebuilt()
+
+    def test_codes(self):
+        # the popularity is the sum of the codes, as computed from the table of the actions
+        for user_id, item_id, code in self.actions(4):
+            self.engine.db.insert_item_action(user_id, item_id, code=code)
+        self.engine.db.insert_item_action('u0', 'i%d' % (self.n_items - 1), code=1000)
+        sums = pd.DataFrame(self.engine.db.get_item_actions()).T.fillna(0).sum()
+        popular_items = self.engine.get_popular_items()
+        self.assertEqual(popular_items[0], 'i%d' % (self.n_items - 1))
+        self.assertEqual(sorted(sums.index), sorted(popular_items[:len(sums)]))
+        self.assertEqual([sums[i] for i in popular_items[:len(sums)]], sorted(sums, reverse=True))
+
+    def test_restore(self):
+        for user_id, item_id, code in self.actions(2):
+            self.engine.db.insert_item_action(user_id, item_id, code=code)
+        popular_items = self.engine.get_popular_items()
+        for name in ('with_model', 'without_model'):
+            path = os.path.join(self.directory, name)
+            self.engine.db.serialize(path)
+            if name == 'without_model':
+                os.remove(Recommender.model_path(path))
+            self.engine.db.restore(path)
+            self.assertEqual(popular_items, self.engine.get_popular_items())
+
+
+class DecayedPopularityTest(PopularityTest):
+    """
+    Same tests of PopularityTest with the decayed popularity
+    """
+
+    def setUp(self):
+        self.engine = Recommender(log_level=logging.WARNING, half_life=3600.0)
+        self.engine.db.insert_items_bulk(dict(('i%d' % i, {}) for i in range(self.n_items)))
+        self.directory = tempfile.mkdtemp()
+
+    def assert_rebuilt(self):
+        # the counts are compared with an index built from the same co-occurrence: a rebuild of the
+        # co-occurrence sums the weights in another order, and moves the base time
+        engine = self.engine
+        popular_items = engine.get_popular_items()
+        users, items, codes, timestamps = engine.db.get_item_actions_arrays(timestamps=True)
+        rebuilt = DecayedPopularity(engine._items_cooccurrence)
+        rebuilt.build(users, items, codes, engine._items_popularity.catalogue, timestamps=timestamps)
+        self.assertEqual(engine._items_popularity.popular_items().tolist(), rebuilt.popular_items().tolist())
+        return popular_items
+
+    def test_rebase(self):
+        for user_id, item_id, code in self.actions(3):
+            self.engine.db.insert_item_action(user_id, item_id, code=code)
+        cooccurrence = self.engine._items_cooccurrence
+        cooccurrence.rebase(cooccurrence.t0 + 7200.0)
+        self.engine.db.insert_item_action('u0', 'i%d' % (self.n_items - 1), code=1)
+        self.assertEqual(self.engine._items_popularity.t0, cooccurrence.t0)
+        self.assert_rebuilt()
+
+
+if __name__ == '__main__':
+    unittest.main()
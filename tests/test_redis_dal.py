@@ -0,0 +1,135 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from csrec import Recommender
+from csrec.tools.sparse import resize_csr
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is needed to test the redis datastore")
+class SharedStoreTest(unittest.TestCase):
+    """
+    Two workers, e.g. the processes of a web application, sharing the same redis server:
+    each one sees the changes of the other when it refreshes its model
+    """
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.a = self.worker()
+        self.b = self.worker()
+
+    def tearDown(self):
+        for worker in (self.a, self.b):
+            worker.stop_refresher()
+
+    def worker(self):
+        return Recommender(dal_name='redis', dal_params={'client': fakeredis.FakeStrictRedis(server=self.server)},
+                           log_level=logging.WARNING)
+
+    def fill(self, worker):
+        worker.db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3)}) for i in range(10)))
+        worker.db.insert_item_actions_bulk([('u1', 'i0', 5), ('u1', 'i1', 4), ('u2', 'i0', 5), ('u2', 'i2', 3),
+                                            ('u3', 'i1', 2), ('u3', 'i4', 5), ('x', 'i0', 4)],
+                                           item_meaningful_info=['author'])
+
+    def assert_same_matrix(self, matrix, other):
+        """
+        the keys interned by a process (e.g. the values of the categories of new items) are read by the others
+        when they need them, the rows and the columns of keys without data are empty
+        """
+        shape = tuple(max(n, m) for n, m in zip(matrix.shape, other.shape))
+        self.assertEqual((resize_csr(matrix, shape) != resize_csr(other, shape)).nnz, 0)
+
+    def assert_same_model(self, worker, other):
+        """
+        the matrices and the popularity of worker are the same of a worker which reads the whole store
+        """
+        self.assertEqual(worker.db.get_item_actions(), other.db.get_item_actions())
+        self.assertEqual(len(worker.db.get_items_map()), len(other.db.get_items_map()))
+        self.assert_same_matrix(worker._items_cooccurrence.tocsr(), other._items_cooccurrence.tocsr())
+        self.assertEqual(sorted(worker._categories_cooccurrence), sorted(other._categories_cooccurrence))
+        for info, cooccurrence in worker._categories_cooccurrence.items():
+            self.assert_same_matrix(cooccurrence.tocsr(), other._categories_cooccurrence[info].tocsr())
+        self.assertEqual(worker.get_popular_items(), other.get_popular_items())
+        for user_id in worker.db.get_item_actions():
+            self.assertEqual(worker.get_recommendations(user_id), other.get_recommendations(user_id))
+
+    def test_refresh_model(self):
+        self.fill(self.a)
+        self.b.refresh_model()
+        self.assertNotEqual(self.b.get_recommendations('x'), [])
+        self.assert_same_model(self.b, self.a)
+        self.assert_same_model(self.b, self.worker())
+
+    def test_refresher(self):
+        self.fill(self.a)
+        self.b.start_refresher(interval=0.05)
+        deadline = time.time() + 5.0
+        while self.b.get_recommendations('x') == [] and time.time() < deadline:
+            time.sleep(0.05)
+        self.b.stop_refresher()
+        self.b.refresh_model()  # a refresh could still be running when the refresher stopped
+        self.assert_same_model(self.b, self.a)
+
+    def test_both_workers_write(self):
+        self.fill(self.a)
+        self.b.db.insert_item_action('u4', 'i5', 5, item_meaningful_info=['author'])
+        self.b.db.insert_item_action('u4', 'i0', 3, item_meaningful_info=['author'])
+        self.a.db.remove_item_action('u1', 'i1')
+        self.a.db.insert_item('i20', {'author': 'a9'})
+        self.b.db.reconcile_user('u2', 'u3')
+        for worker in (self.a, self.b):
+            worker.refresh_model()
+        fresh = self.worker()
+        self.assert_same_model(self.a, fresh)
+        self.assert_same_model(self.b, fresh)
+
+    def test_synchronize(self):
+        self.assertFalse(self.a.db.synchronize())
+        self.fill(self.a)
+        self.assertFalse(self.a.db.synchronize())  # only its own changes
+        self.assertTrue(self.b.db.synchronize())
+        self.assertFalse(self.b.db.synchronize())
+        self.a.db.reset()
+        self.assertTrue(self.b.db.synchronize())
+
+    def test_serialize(self):
+        # the files are the same of the mem datastore, the action log is compacted in a snapshot
+        self.fill(self.a)
+        directory = tempfile.mkdtemp()
+        mem = Recommender(log_level=logging.WARNING)
+        try:
+            for file_format in ('pickle', 'snapshot'):
+                path = os.path.join(directory, 'data.' + file_format)
+                self.a.db.serialize(path, file_format=file_format)
+                mem.db.restore(path)
+                self.assert_same_model(mem, self.a)
+                self.server = fakeredis.FakeServer()
+                restored = self.worker()
+                restored.db.restore(path)
+                self.assert_same_model(restored, self.a)
+        finally:
+            mem.db.reset()
+            shutil.rmtree(directory)
+
+    def test_reset(self):
+        self.fill(self.a)
+        self.b.refresh_model()
+        self.a.db.reset()
+        self.b.refresh_model()
+        self.assertEqual(self.b.db.get_user_count(), 0)
+        self.assertEqual(self.b.get_recommendations('x'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import unittest
+
+from csrec import Recommender
+
+
+class RefresherTest(unittest.TestCase):
+    """
+    The background refresher counts the actions inserted, one by one or in bulk
+    """
+
+    def setUp(self):
+        self.engine = Recommender(log_level=logging.WARNING)
+        self.engine.db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3)}) for i in range(100)))
+        # no refresh is triggered during the test
+        self.engine.start_refresher(interval=None, n_actions=10 ** 6)
+
+    def tearDown(self):
+        self.engine.stop_refresher()
+        self.engine.db.reset()
+
+    def test_notify_action(self):
+        refresher = self.engine._refresher
+        db = self.engine.db
+        # most of the users are new: the co-occurrence is built again
+        db.insert_item_actions_bulk([('u%d' % (n % 20), 'i%d' % n, 3) for n in range(100)])
+        self.assertEqual(refresher._new_actions, 100)
+        # few users: the co-occurrence is updated for each user
+        db.insert_item_actions_bulk([('u%d' % (n % 2), 'i%d' % n, 4) for n in range(50)])
+        self.assertEqual(refresher._new_actions, 150)
+        db.insert_item_action('u3', 'i1', code=5)
+        db.remove_item_action('u3', 'i1')
+        self.assertEqual(refresher._new_actions, 152)
+
+
+if __name__ == '__main__':
+    unittest.main()
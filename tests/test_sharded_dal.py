@@ -0,0 +1,155 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from csrec import Recommender
+
+
+class ShardedStoreTest(unittest.TestCase):
+    """
+    The sharded datastore, with the shards in this process, holds the same data, and gives the same
+    recommendations, of the mem datastore after the same changes, and the files written by each one
+    are restored by the other
+    """
+    processes = False
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mem = Recommender(log_level=logging.WARNING)
+        self.mem.db.reset()
+        self.children = set(multiprocessing.active_children())
+        self.sharded = self.worker()
+
+    def tearDown(self):
+        self.sharded.db.close()
+        self.mem.db.reset()
+        shutil.rmtree(self.directory)
+
+    def worker(self):
+        return Recommender(dal_name='sharded', dal_params={'shards': 3, 'processes': self.processes},
+                           log_level=logging.WARNING)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def insert(self, engine):
+        db = engine.db
+        db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3)}) for i in range(10)))
+        db.insert_item('i10', {'author': 'a9'})
+        db.insert_item_actions_bulk([('u%d' % (n % 7), 'i%d' % (n % 11), 1 + n % 5, 10.0 + n) for n in range(40)],
+                                    item_meaningful_info=['author'])
+        db.insert_item_action('x', 'i10', code=5, item_meaningful_info=['author'], timestamp=60.0)
+        db.insert_item_action('x', 'i0', code=3, item_meaningful_info=['author'], timestamp=61.0)
+        db.insert_social_action('u1', 'u2', code=4)
+        db.insert_social_action('u2', 'u3')
+
+    def remove(self, engine):
+        db = engine.db
+        db.remove_item_action('u1', 'i1')
+        db.remove_item_action('x', 'i10')
+        db.remove_social_action('u2', 'u3')
+        db.remove_user('u5')
+        db.remove_item('i9')
+
+    @staticmethod
+    def rows(table):
+        """
+        the mem datastore keeps the rows left empty, e.g. the social actions of a reconciled user
+        """
+        return dict((k, row) for k, row in table.items() if row)
+
+    @staticmethod
+    def actions(db, user_id):
+        """
+        :return: {item_id: (code, timestamp)} from the arrays of the actions of a user
+        """
+        _, items, codes, timestamps = db.get_item_actions_arrays(user_id, timestamps=True)
+        items_map = db.get_items_map()
+        return dict((items_map.key(i), (c, t)) for i, c, t in zip(items.tolist(), codes.tolist(),
+                                                                  timestamps.tolist()))
+
+    def assert_same_store(self, engine, other):
+        db, other_db = engine.db, other.db
+        self.assertEqual(db.get_items(), other_db.get_items())
+        self.assertEqual(db.get_item_actions(), other_db.get_item_actions())
+        self.assertEqual(db.get_item_ratings(), other_db.get_item_ratings())
+        self.assertEqual(self.rows(db.get_social_actions()), self.rows(other_db.get_social_actions()))
+        self.assertEqual(db.get_info_used(), other_db.get_info_used())
+        self.assertEqual(db.get_user_count(), other_db.get_user_count())
+        self.assertEqual(db.get_items_count(), other_db.get_items_count())
+        for user_id in db.get_item_actions():
+            self.assertEqual(self.actions(db, user_id), self.actions(other_db, user_id))
+        self.assertEqual(engine.get_popular_items(), other.get_popular_items())
+        for user_id in db.get_item_actions():
+            self.assertEqual(engine.get_recommendations(user_id), other.get_recommendations(user_id))
+
+    def test_insert(self):
+        for engine in (self.mem, self.sharded):
+            self.insert(engine)
+        self.assertNotEqual(self.sharded.get_recommendations('x'), [])
+        self.assert_same_store(self.sharded, self.mem)
+
+    def test_remove(self):
+        for engine in (self.mem, self.sharded):
+            self.insert(engine)
+            self.remove(engine)
+        self.assert_same_store(self.sharded, self.mem)
+
+    def test_reconcile(self):
+        # users on different shards, and on the same shard
+        for engine in (self.mem, self.sharded):
+            self.insert(engine)
+            engine.db.reconcile_user('u2', 'u3')
+            engine.db.reconcile_user('u0', 'u1')
+        self.assertNotEqual(self.sharded.db._shard('u2'), self.sharded.db._shard('u3'))
+        self.assertEqual(self.sharded.db._shard('u0'), self.sharded.db._shard('u1'))
+        self.assert_same_store(self.sharded, self.mem)
+
+    def test_serialize(self):
+        for engine in (self.mem, self.sharded):
+            self.insert(engine)
+            self.remove(engine)
+        for file_format in ('pickle', 'snapshot'):
+            path = self.path('sharded.' + file_format)
+            self.sharded.db.serialize(path, file_format=file_format)
+            restored = self.worker()
+            try:
+                restored.db.restore(path)
+                self.assert_same_store(restored, self.mem)
+            finally:
+                restored.db.close()
+            # the files are the same of the mem datastore
+            mem_path = self.path('mem.' + file_format)
+            self.mem.db.serialize(mem_path, file_format=file_format)
+            self.sharded.db.restore(mem_path)
+            self.assert_same_store(self.sharded, self.mem)
+            self.mem.db.restore(path)
+            self.assert_same_store(self.mem, self.sharded)
+
+    def test_close(self):
+        self.insert(self.sharded)
+        self.sharded.db.close()
+        self.assertEqual(set(multiprocessing.active_children()), self.children)
+
+
+class ProcessShardedStoreTest(ShardedStoreTest):
+    """
+    Same tests of ShardedStoreTest with each shard in its own process
+    """
+    processes = True
+
+    def test_close(self):
+        processes = [shard.process for shard in self.sharded.db._shards]
+        self.assertEqual(set(multiprocessing.active_children()) - self.children, set(processes))
+        ShardedStoreTest.test_close(self)
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+
+if __name__ == '__main__':
+    unittest.main()
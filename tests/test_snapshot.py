@@ -0,0 +1,131 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from csrec import Recommender
+from csrec.tools.lazytable import LazyTable
+
+
+class SnapshotTest(unittest.TestCase):
+    """
+    The tables of the mem datastore restored from a snapshot hold the same data of the tables written,
+    the rows are decoded when read and the arrays of the whole tables are read without decoding them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.snapshot')
+        self.engine = Recommender(log_level=logging.WARNING)
+        self.engine.db.reset()
+
+    def tearDown(self):
+        self.engine.db.reset()
+        shutil.rmtree(self.directory)
+
+    def fill(self):
+        db = self.engine.db
+        db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3), 'tags': ['t%d' % (i % 4), 't5']})
+                                  for i in range(10)))
+        db.insert_item_actions_bulk([('u%d' % (n % 7), 'i%d' % (n % 11), 1 + n % 5, 1.5e9 + n / 8.0)
+                                     for n in range(40)], item_meaningful_info=['author', 'tags'])
+        db.insert_item_action('u9', 'i3', code=2.5, item_meaningful_info=['author'], timestamp=20.0)
+        db.insert_social_action('u1', 'u2', code=4)
+        db.insert_social_action(3, 'u3')
+
+    def change(self):
+        db = self.engine.db
+        db.insert_item_action('u1', 'i4', code=5, item_meaningful_info=['author'], timestamp=30.0)
+        db.remove_item_action('u2', 'i2')
+        db.reconcile_user('u3', 'u4')
+        db.remove_item('i9')
+
+    def tables(self):
+        db = self.engine.db
+        return copy.deepcopy((db.get_items(), db.get_item_actions(), db.get_item_ratings(), db.get_social_actions(),
+                              db.get_info_used(), db.get_tot_categories_user_ratings(),
+                              db.get_n_categories_user_ratings(), db.get_tot_categories_item_ratings(),
+                              db.get_n_categories_item_ratings()))
+
+    def arrays(self):
+        """
+        :return: the elements of the arrays of the whole tables, by ids
+        """
+        db = self.engine.db
+        users, items = db.get_users_map(), db.get_items_map()
+        arrays = {'actions': sorted((users.key(u), items.key(i), c, t) for u, i, c, t in
+                                    zip(*[a.tolist() for a in db.get_item_actions_arrays(timestamps=True)]))}
+        for info in ('author', 'tags'):
+            values = db.get_category_values_map(info)
+            arrays[info] = sorted((users.key(u), values.key(v), tot, n) for u, v, tot, n in
+                                  zip(*[a.tolist() for a in db.get_categories_user_ratings_arrays(info)]))
+        return arrays
+
+    def restore(self):
+        db = self.engine.db
+        db.reset()
+        db.restore(self.path)
+        self.assertIsInstance(db.users_ratings_tbl, LazyTable)
+
+    def test_restore(self):
+        self.fill()
+        tables, arrays = self.tables(), self.arrays()
+        self.engine.db.serialize(self.path, file_format='snapshot')
+        self.restore()
+        # the arrays are read from the snapshot, also after the rows have been decoded
+        self.assertEqual(arrays, self.arrays())
+        self.assertEqual(tables, self.tables())
+        self.assertEqual(arrays, self.arrays())
+
+    def test_changes(self):
+        self.fill()
+        self.change()
+        tables, arrays = self.tables(), self.arrays()
+        self.engine.db.reset()
+        self.fill()
+        self.engine.db.serialize(self.path, file_format='snapshot')
+        self.restore()
+        self.change()
+        self.assertEqual(tables, self.tables())
+        self.assertEqual(arrays, self.arrays())
+
+    def test_freeze(self):
+        # the copy of the restored tables written by serialize_background does not change with them
+        self.fill()
+        self.engine.db.serialize(self.path, file_format='snapshot')
+        tables = self.tables()
+        self.restore()
+        path = os.path.join(self.directory, 'background.snapshot')
+        frozen = self.engine.db._freeze()
+        self.change()
+        frozen._serialize(path, 'snapshot')
+        self.engine.db.restore(path)
+        self.assertEqual(tables, self.tables())
+
+    def test_model(self):
+        # the values of the categories of the items are mapped from the model, and copied on the first change
+        self.fill()
+        users = list(self.engine.db.get_item_actions())
+        recommendations = [self.engine.get_recommendations(user_id) for user_id in users]
+        self.engine.db.serialize(self.path, file_format='snapshot')
+        self.engine.db.reset()
+        self.engine.db.restore(self.path, mmap=True)
+        self.assertEqual(sorted(self.engine._items_categories), ['author', 'tags'])
+        self.assertEqual(recommendations, [self.engine.get_recommendations(user_id) for user_id in users])
+        db = self.engine.db
+        db.insert_item('i20', {'author': 'a1', 'tags': ['t9']})
+        db.remove_item('i0')
+        for info, values in (('author', ['a1']), ('tags', ['t9'])):
+            index = self.engine._get_items_categories(info).index
+            values_map = db.get_category_values_map(info)
+            self.assertEqual([values_map.key(v) for v in index[db.get_item_index('i20')] if v >= 0], values)
+            self.assertTrue((index[db.get_item_index('i0')] == -1).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
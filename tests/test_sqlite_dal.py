@@ -0,0 +1,135 @@
+__author__ = "elegans.io Ltd"
+__email__ = "info@elegans.io"
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from csrec import Recommender
+from csrec.action_log import ActionLog
+
+
+class SqliteStoreTest(unittest.TestCase):
+    """
+    The sqlite datastore holds the same data, and gives the same recommendations, of the mem datastore
+    after the same changes, and the files written by each one are restored by the other
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mem = Recommender(log_level=logging.WARNING)
+        self.mem.db.reset()
+        self.sqlite = self.worker('data.sqlite')
+
+    def tearDown(self):
+        self.mem.db.reset()
+        shutil.rmtree(self.directory)
+
+    def worker(self, name):
+        return Recommender(dal_name='sqlite', dal_params={'db_path': os.path.join(self.directory, name)},
+                           log_level=logging.WARNING)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def change(self, engine):
+        db = engine.db
+        db.insert_items_bulk(dict(('i%d' % i, {'author': 'a%d' % (i % 3)}) for i in range(10)))
+        db.insert_item('i10', {'author': 'a9'})
+        db.insert_item_actions_bulk([('u1', 'i0', 5, 10.0), ('u1', 'i1', 4, 11.0), ('u2', 'i0', 5, 12.0),
+                                     ('u2', 'i2', 3, 13.0), ('u3', 'i1', 2, 14.0), ('u3', 'i4', 5, 15.0),
+                                     ('x', 'i0', 4, 16.0)], item_meaningful_info=['author'])
+        db.insert_item_action('u4', 'i10', code=5, item_meaningful_info=['author'], timestamp=17.0)
+        db.insert_item_action('u4', 'i0', code=3, item_meaningful_info=['author'], timestamp=18.0)
+        db.insert_item_action('u5', 'i3', code=1, timestamp=19.0)
+        db.remove_item_action('u1', 'i1')
+        db.insert_social_action('u1', 'u2', code=4)
+        db.insert_social_action('u2', 'u3')
+        db.remove_social_action('u2', 'u3')
+        db.reconcile_user('u2', 'u3')
+        db.remove_user('u5')
+        db.remove_item('i9')
+
+    @staticmethod
+    def rows(table):
+        """
+        the mem datastore keeps the rows left empty, e.g. the social actions of a reconciled user
+        """
+        return dict((k, row) for k, row in table.items() if row)
+
+    @staticmethod
+    def actions(db, user_id):
+        """
+        :return: {item_id: (code, timestamp)} from the arrays of the actions of a user
+        """
+        _, items, codes, timestamps = db.get_item_actions_arrays(user_id, timestamps=True)
+        items_map = db.get_items_map()
+        return dict((items_map.key(i), (c, t)) for i, c, t in zip(items.tolist(), codes.tolist(),
+                                                                  timestamps.tolist()))
+
+    def assert_same_store(self, engine, other):
+        db, other_db = engine.db, other.db
+        self.assertEqual(db.get_items(), other_db.get_items())
+        self.assertEqual(db.get_item_actions(), other_db.get_item_actions())
+        self.assertEqual(db.get_item_ratings(), other_db.get_item_ratings())
+        self.assertEqual(self.rows(db.get_social_actions()), self.rows(other_db.get_social_actions()))
+        self.assertEqual(db.get_info_used(), other_db.get_info_used())
+        self.assertEqual(db.get_user_count(), other_db.get_user_count())
+        self.assertEqual(db.get_items_count(), other_db.get_items_count())
+        for user_id in ('u1', 'u3', 'u4', 'x'):
+            self.assertEqual(self.actions(db, user_id), self.actions(other_db, user_id))
+        self.assertEqual(engine.get_popular_items(), other.get_popular_items())
+        for user_id in db.get_item_actions():
+            self.assertEqual(engine.get_recommendations(user_id), other.get_recommendations(user_id))
+
+    def test_changes(self):
+        for engine in (self.mem, self.sqlite):
+            self.change(engine)
+        self.assertNotEqual(self.sqlite.get_recommendations('x'), [])
+        self.assert_same_store(self.sqlite, self.mem)
+
+    def test_serialize(self):
+        for engine in (self.mem, self.sqlite):
+            self.change(engine)
+        for file_format in ('pickle', 'snapshot', 'sqlite'):
+            path = self.path('sqlite.' + file_format)
+            self.sqlite.db.serialize(path, file_format=file_format)
+            restored = self.worker('restored.%s.sqlite' % file_format)
+            restored.db.restore(path)
+            self.assert_same_store(restored, self.mem)
+        # the files are the same of the mem datastore
+        for file_format in ('pickle', 'snapshot'):
+            path = self.path('mem.' + file_format)
+            self.mem.db.serialize(path, file_format=file_format)
+            restored = self.worker('restored.mem.%s.sqlite' % file_format)
+            restored.db.restore(path)
+            self.assert_same_store(restored, self.sqlite)
+            self.mem.db.restore(self.path('sqlite.' + file_format))
+            self.assert_same_store(self.mem, self.sqlite)
+
+    def test_serialize_background(self):
+        self.change(self.sqlite)
+        path = self.path('background.snapshot')
+        self.sqlite.db.serialize_background(path, file_format='snapshot').join()
+        restored = self.worker('restored.sqlite')
+        restored.db.restore(path, mmap=True)
+        self.assert_same_store(restored, self.sqlite)
+
+    def test_action_log(self):
+        # the log is compacted in the default format, a snapshot
+        db = self.sqlite.db
+        log = ActionLog(self.path('actions.log'))
+        log.attach(db)
+        self.change(self.sqlite)
+        log.compact(db, self.path('data.snapshot'))
+        db.insert_item_action('u9', 'i1', code=5, item_meaningful_info=['author'])
+        log.detach(db)
+        log.close()
+        recovered = self.worker('recovered.sqlite')
+        self.assertEqual(ActionLog(self.path('actions.log')).recover(recovered.db, self.path('data.snapshot')), 1)
+        self.assert_same_store(recovered, self.sqlite)
+
+
+if __name__ == '__main__':
+    unittest.main()